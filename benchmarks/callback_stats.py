@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2018, 2019 Damir Jelić <poljar@termina.org.uk>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER
+# RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF
+# CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Benchmark the overhead of the callback statistics.
+
+An empty callback wrapped by utf8_decode is called with the statistics
+disabled and enabled, the difference is the cost the instrumentation adds to
+every weechat callback.
+
+Run it from the repository root using the mock weechat module:
+
+    python -m benchmarks.callback_stats [call-count]
+"""
+
+from __future__ import print_function, unicode_literals
+
+import sys
+import time
+
+from matrix.stats import CALLBACK_STATS
+from matrix.utf import utf8_decode
+
+
+@utf8_decode
+def empty_cb(data, buffer):
+    return 0
+
+
+def measure(calls):
+    start = time.time()
+
+    for _ in range(calls):
+        empty_cb("", "0x1")
+
+    return (time.time() - start) / calls
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    disabled = measure(calls)
+    CALLBACK_STATS.enable()
+    enabled = measure(calls)
+    CALLBACK_STATS.disable()
+
+    print("{} calls".format(calls))
+    print("{:<20} {:>8.3f} us per call".format("stats disabled",
+                                              disabled * 1000000))
+    print("{:<20} {:>8.3f} us per call".format("stats enabled",
+                                              enabled * 1000000))
+
+
+if __name__ == "__main__":
+    main()
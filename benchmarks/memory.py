@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2018, 2019 Damir Jelić <poljar@termina.org.uk>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER
+# RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF
+# CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Benchmark the memory used by nicklist users and formatted strings.
+
+Reports the bytes allocated per user object and per formatted span. The
+nicks and user ids of the users are created up front and not counted, the
+numbers for the spans include their text and the Formatted object holding
+them.
+
+Run it from the repository root using the mock weechat module (needs Python
+3 for tracemalloc):
+
+    python -m benchmarks.memory [object-count]
+"""
+
+from __future__ import print_function, unicode_literals
+
+import sys
+import tracemalloc
+
+import matrix.globals as G
+from matrix._weechat import MockConfig
+from matrix.buffer import RoomUser
+from matrix.colors import Formatted
+
+G.CONFIG = MockConfig()
+
+
+def measure(create, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [create(i) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # Don't count the list holding the objects.
+    return (after - before - sys.getsizeof(objects)) / float(count)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    nicks = ["user{}".format(i) for i in range(count)]
+    user_ids = ["@{}:example.org".format(nick) for nick in nicks]
+
+    per_user = measure(
+        lambda i: RoomUser(nicks[i], user_ids[i], i % 3 * 50, 1), count
+    )
+
+    # A message with a couple of differently formatted spans.
+    line = "**bold** *italic* `code` \x0304red\x03 plain text"
+    spans = len(Formatted.from_input_line(line).substrings)
+    per_message = measure(
+        lambda i: Formatted.from_input_line(line), count // 10
+    )
+
+    print("{:.1f} bytes per user".format(per_user))
+    print("{:.1f} bytes per formatted span ({} spans per message)".format(
+        per_message / spans, spans
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2018, 2019 Damir Jelić <poljar@termina.org.uk>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER
+# RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF
+# CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Benchmark loading the members of a big room into a room buffer.
+
+Run it from the repository root using the mock weechat module:
+
+    python -m benchmarks.nicklist_load [member-count]
+"""
+
+from __future__ import print_function, unicode_literals
+
+import sys
+import time
+
+from nio.rooms import MatrixRoom
+
+import matrix.globals as G
+from matrix._weechat import MockConfig
+from matrix.buffer import RoomBuffer
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+G.CONFIG = MockConfig()
+
+
+def create_room(member_count):
+    room = MatrixRoom("!bench:example.org", "@alice:example.org")
+
+    for i in range(member_count):
+        # Every tenth user shares a localpart with a user on another server
+        # so nick disambiguation is exercised as well.
+        if i % 10:
+            user_id = "@user{}:example.org".format(i)
+        else:
+            user_id = "@user{}:example.com".format(i + 1)
+
+        room.add_member(user_id, None, None)
+
+    return room
+
+
+def load_members(room, force_add):
+    room_buffer = RoomBuffer(
+        room, "bench", urlparse("https://example.org"), None
+    )
+
+    for user_id in room.users:
+        room_buffer.unhandled_users.add(user_id)
+
+    start = time.time()
+
+    while room_buffer.unhandled_users:
+        user_id = room_buffer.unhandled_users.pop()
+        room_buffer.add_user(user_id, 0, True, force_add)
+
+    return time.time() - start, room_buffer
+
+
+def main():
+    member_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    room = create_room(member_count)
+
+    for force_add in (False, True):
+        elapsed, room_buffer = load_members(room, force_add)
+        print(
+            "{} members, force_add={}: {:.3f}s ({} displayed, {} inactive)"
+            .format(
+                len(room.users),
+                force_add,
+                elapsed,
+                len(room_buffer.displayed_nicks),
+                len(room_buffer.inactive_users),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
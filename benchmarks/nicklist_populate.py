@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2018, 2019 Damir Jelić <poljar@termina.org.uk>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER
+# RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF
+# CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Benchmark the time until the nicklist of a big room is fully populated.
+
+The mock weechat module doesn't keep a nicklist, so this installs a model of
+the WeeChat one: nick searches walk over every nick and new nicks are inserted
+into a per group linked list that is searched from its head. Besides the
+processing time, the number of nick comparisons WeeChat would do is reported.
+
+Run it from the repository root using the mock weechat module:
+
+    python -m benchmarks.nicklist_populate [member-count]
+"""
+
+from __future__ import print_function, unicode_literals
+
+import random
+import sys
+import time
+
+from nio.rooms import MatrixRoom
+
+import matrix.globals as G
+from matrix._weechat import MockConfig
+from matrix.buffer import RoomBuffer
+from matrix.globals import SERVERS, W
+from matrix.server import (
+    USER_LOADING_INTERVAL,
+    MatrixServer,
+    matrix_load_users_cb,
+)
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+G.CONFIG = MockConfig()
+
+
+class Nicklist(object):
+    def __init__(self):
+        self.groups = {}
+        self.comparisons = 0
+
+    def search_group(self, _buffer, _parent, name):
+        self.groups.setdefault(name, [])
+        return name
+
+    def search_nick(self, _buffer, _group, nick):
+        for nicks in self.groups.values():
+            for other in nicks:
+                self.comparisons += 1
+                if other == nick:
+                    return other
+        return ""
+
+    def add_nick(self, _buffer, group, nick, *_):
+        nicks = self.groups.setdefault(group, [])
+        position = len(nicks)
+
+        for i, other in enumerate(nicks):
+            self.comparisons += 1
+            if nick.lower() < other.lower():
+                position = i
+                break
+
+        nicks.insert(position, nick)
+
+    def __len__(self):
+        return sum(len(nicks) for nicks in self.groups.values())
+
+
+class BenchServer(object):
+    """The parts of a MatrixServer the user loading timer needs."""
+    add_unhandled_users = MatrixServer.add_unhandled_users
+
+    def __init__(self, room_buffer):
+        self.name = "bench"
+        self.room_buffers = {room_buffer.room.room_id: room_buffer}
+        self.lazy_load_hook = "hook"
+        self.user_loading_rate = 2000.0
+
+    def schedule_garbage_collection(self):
+        pass
+
+
+def create_room(member_count):
+    room = MatrixRoom("!bench:example.org", "@alice:example.org")
+    user_ids = ["@user{}:example.org".format(i) for i in range(member_count)]
+    random.shuffle(user_ids)
+
+    for user_id in user_ids:
+        room.add_member(user_id, None, None)
+
+    for i, user_id in enumerate(user_ids[:member_count // 100]):
+        room.users[user_id].power_level = 100 if i % 2 else 50
+
+    return room
+
+
+def install_nicklist():
+    nicklist = Nicklist()
+    W.nicklist_search_group = nicklist.search_group
+    W.nicklist_search_nick = nicklist.search_nick
+    W.nicklist_add_nick = nicklist.add_nick
+    return nicklist
+
+
+def create_buffer(room):
+    room_buffer = RoomBuffer(
+        room, "bench", urlparse("https://example.org"), None
+    )
+    room_buffer.queue_users(room.users)
+    return room_buffer
+
+
+def populate_one_by_one(room):
+    nicklist = install_nicklist()
+    room_buffer = create_buffer(room)
+
+    start = time.time()
+
+    while room_buffer.unhandled_users:
+        room_buffer.add_user(room_buffer.unhandled_users.pop(), 0, True, True)
+
+    return time.time() - start, 0, nicklist
+
+
+def populate_with_timer(room):
+    nicklist = install_nicklist()
+    room_buffer = create_buffer(room)
+    server = BenchServer(room_buffer)
+    SERVERS[server.name] = server
+
+    runs = 0
+    start = time.time()
+
+    while server.lazy_load_hook:
+        matrix_load_users_cb(server.name, 0)
+        runs += 1
+
+    del SERVERS[server.name]
+
+    return time.time() - start, runs, nicklist
+
+
+def main():
+    member_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    room = create_room(member_count)
+    G.CONFIG.network.max_nicklist_users = member_count
+
+    for name, populate in (("one by one", populate_one_by_one),
+                           ("timer", populate_with_timer)):
+        elapsed, runs, nicklist = populate(room)
+        # The timer fires every USER_LOADING_INTERVAL milliseconds, the
+        # nicklist is complete after the last run.
+        until_complete = max(runs - 1, 0) * USER_LOADING_INTERVAL / 1000.0
+        until_complete += elapsed / runs if runs else elapsed
+        print(
+            "{} members, {}: {:.3f}s processing, {} timer runs, "
+            "~{:.1f}s until complete, {} nicks, {} nick comparisons".format(
+                member_count,
+                name,
+                elapsed,
+                runs,
+                until_complete,
+                len(nicklist),
+                nicklist.comparisons,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
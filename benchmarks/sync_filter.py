@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2018, 2019 Damir Jelić <poljar@termina.org.uk>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER
+# RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF
+# CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Benchmark the size and parse time of sync responses for our sync filters.
+
+A stand-in homeserver is started on localhost. It serves the same synthetic
+sync response with presence, read receipts, typing notices and account data
+for every room, applying the subset of the filter API our filters use. The
+response is fetched using the filter the plugin used to send and the filter
+built by MatrixServer.build_sync_filter(). Parsing includes json decoding and
+creating the nio SyncResponse.
+
+Run it from the repository root using the mock weechat module:
+
+    python -m benchmarks.sync_filter [room-count]
+"""
+
+from __future__ import print_function, unicode_literals
+
+import json
+import sys
+import threading
+import time
+
+from nio import SyncResponse
+
+import matrix.globals as G
+from matrix._weechat import MockConfig
+from matrix.server import MatrixServer
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qs, quote, urlparse
+    from urllib.request import urlopen
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urllib import quote
+    from urllib2 import urlopen
+    from urlparse import parse_qs, urlparse
+
+G.CONFIG = MockConfig()
+
+OLD_FILTER = {
+    "room": {
+        "timeline": {"limit": 500},
+        "state": {"lazy_load_members": True}
+    }
+}
+
+CONTACTS = 300
+TIMELINE_EVENTS = 20
+
+
+def event(event_type, content, sender="@bob:example.org", **kwargs):
+    event = {"type": event_type, "content": content}
+    event.update(kwargs)
+
+    if "state_key" in kwargs or event_type.startswith("m.room."):
+        event.update({
+            "sender": sender,
+            "origin_server_ts": 1500000000000,
+        })
+
+    return event
+
+
+def room_response(room_number):
+    members = ["@user{}:example.org".format(i) for i in range(20)]
+
+    timeline = [
+        event("m.room.message", {"msgtype": "m.text",
+                                 "body": "message number {}".format(i)},
+              sender=members[i % len(members)],
+              event_id="$event{}_{}:example.org".format(room_number, i))
+        for i in range(TIMELINE_EVENTS)
+    ]
+
+    receipts = {
+        "$event{}_{}:example.org".format(room_number, i): {
+            "m.read": {member: {"ts": 1500000000000}}
+        }
+        for i, member in enumerate(members)
+    }
+
+    return {
+        "state": {"events": []},
+        "timeline": {
+            "events": timeline,
+            "limited": False,
+            "prev_batch": "p{}".format(room_number),
+        },
+        "ephemeral": {"events": [
+            event("m.receipt", receipts),
+            event("m.typing", {"user_ids": members[:2]}),
+        ]},
+        "account_data": {"events": [
+            event("m.fully_read", {"event_id": timeline[-1]["event_id"]}),
+            event("m.tag", {"tags": {"u.work": {"order": 0.5}}}),
+            event("im.vector.setting.breadcrumbs",
+                  {"recent_rooms": ["!room{}:example.org".format(i)
+                                    for i in range(20)]}),
+        ]},
+        "unread_notifications": {"highlight_count": 0,
+                                 "notification_count": 5},
+    }
+
+
+def sync_response(rooms):
+    return {
+        "next_batch": "s1",
+        "rooms": {
+            "join": {
+                "!room{}:example.org".format(i): room_response(i)
+                for i in range(rooms)
+            },
+            "invite": {},
+            "leave": {},
+        },
+        "presence": {"events": [
+            event("m.presence", {"presence": "online",
+                                 "last_active_ago": 1000,
+                                 "currently_active": True},
+                  sender="@contact{}:example.org".format(i))
+            for i in range(CONTACTS)
+        ]},
+        "account_data": {"events": [
+            event("m.push_rules", {"global": {
+                "override": [{"rule_id": "rule{}".format(i),
+                              "actions": ["notify"], "enabled": True}
+                             for i in range(50)]
+            }}),
+            event("m.direct", {"@contact{}:example.org".format(i):
+                               ["!room{}:example.org".format(i)]
+                               for i in range(CONTACTS // 10)}),
+        ]},
+        "to_device": {"events": []},
+        "device_lists": {"changed": [], "left": []},
+        "device_one_time_keys_count": {},
+    }
+
+
+def filter_events(events, event_filter):
+    types = event_filter.get("types")
+    not_types = event_filter.get("not_types", [])
+
+    return [
+        event for event in events
+        if "*" not in not_types
+        and event["type"] not in not_types
+        and (types is None or event["type"] in types)
+    ]
+
+
+def apply_filter(response, sync_filter):
+    """Apply the parts of the filter API that our filters use."""
+    response = json.loads(json.dumps(response))
+    room_filter = sync_filter.get("room", {})
+    timeline_filter = room_filter.get("timeline", {})
+
+    for key in ("presence", "account_data"):
+        response[key]["events"] = filter_events(
+            response[key]["events"], sync_filter.get(key, {})
+        )
+
+    for room in response["rooms"]["join"].values():
+        for key in ("ephemeral", "account_data"):
+            room[key]["events"] = filter_events(
+                room[key]["events"], room_filter.get(key, {})
+            )
+
+        timeline = room["timeline"]
+        limit = timeline_filter.get("limit", len(timeline["events"]))
+        timeline["events"] = timeline["events"][-limit:]
+
+    return response
+
+
+def start_homeserver(response):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            sync_filter = json.loads(query["filter"][0])
+            body = json.dumps(apply_filter(response, sync_filter))
+            body = body.encode("utf-8")
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+
+def measure(server, sync_filter, runs=5):
+    url = "http://127.0.0.1:{}/_matrix/client/r0/sync?filter={}".format(
+        server.server_address[1], quote(json.dumps(sync_filter))
+    )
+
+    body = urlopen(url).read()
+    start = time.time()
+
+    for _ in range(runs):
+        SyncResponse.from_dict(json.loads(body.decode("utf-8")))
+
+    return len(body), (time.time() - start) / runs
+
+
+class BenchServer(object):
+    build_sync_filter = MatrixServer.build_sync_filter
+
+
+def main():
+    rooms = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    homeserver = start_homeserver(sync_response(rooms))
+    new_filter = BenchServer().build_sync_filter(500)
+
+    print("{} rooms, {} contacts".format(rooms, CONTACTS))
+
+    for name, sync_filter in (("old filter", OLD_FILTER),
+                              ("new filter", new_filter)):
+        size, parse_time = measure(homeserver, sync_filter)
+        print("{:<24} {:>9} bytes {:>8.1f} ms parse time".format(
+            name, size, parse_time * 1000
+        ))
+
+    homeserver.shutdown()
+
+
+if __name__ == "__main__":
+    main()
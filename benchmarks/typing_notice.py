@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2018, 2019 Damir Jelić <poljar@termina.org.uk>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER
+# RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF
+# CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Benchmark the handling of a keystroke in a room buffer.
+
+Every keystroke in a room buffer ends up in
+MatrixServer.room_send_typing_notice(). Besides the time spent per keystroke
+this reports how often the typing notice conditions had to be evaluated by
+weechat, each of those is a round trip from Python to C and back.
+
+Run it from the repository root using the mock weechat module:
+
+    python -m benchmarks.typing_notice [keystroke-count]
+"""
+
+from __future__ import print_function, unicode_literals
+
+import sys
+import time
+
+from nio.rooms import MatrixRoom
+
+import matrix.globals as G
+from matrix._weechat import MockConfig
+from matrix.buffer import RoomBuffer
+from matrix.config import Condition
+from matrix.globals import W
+from matrix.server import MatrixServer
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+G.CONFIG = MockConfig()
+
+TEXT = "hello world, this is a message that is being typed "
+KEYSTROKE = [0]
+EVALUATIONS = [0]
+STRING_EVAL_EXPRESSION = W.string_eval_expression
+
+
+class BenchClient(object):
+    logged_in = True
+
+    @staticmethod
+    def room_typing(room_id, typing_state=True, timeout=0):
+        return None, b""
+
+
+class BenchServer(object):
+    """The parts of a MatrixServer a typing notice needs."""
+    room_send_typing_notice = MatrixServer.room_send_typing_notice
+
+    def __init__(self):
+        self.connected = True
+        self.client = BenchClient()
+
+    def send(self, request):
+        pass
+
+
+def bench(server, room_buffer, keystrokes):
+    start = time.time()
+
+    for i in range(keystrokes):
+        KEYSTROKE[0] = i
+        server.room_send_typing_notice(room_buffer)
+
+    return time.time() - start
+
+
+def buffer_get_string(_ptr, name):
+    if name == "input":
+        return TEXT[:KEYSTROKE[0] % len(TEXT)]
+    return ""
+
+
+def counting_eval(*args):
+    EVALUATIONS[0] += 1
+    return STRING_EVAL_EXPRESSION(*args)
+
+
+def main():
+    keystrokes = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    room = MatrixRoom("!bench:example.org", "@alice:example.org")
+    room_buffer = RoomBuffer(
+        room, "bench", urlparse("https://example.org"), None
+    )
+    server = BenchServer()
+
+    W.string_eval_expression = counting_eval
+    W.buffer_get_string = buffer_get_string
+
+    for cached in (False, True):
+        condition = Condition("${typing_enabled}", "typing_enabled")
+        # An uncached condition is evaluated by weechat on every keystroke,
+        # like expressions that reference other variables are.
+        condition.cacheable = cached
+        G.CONFIG.typing_notice_conditions = condition
+        EVALUATIONS[0] = 0
+
+        elapsed = bench(server, room_buffer, keystrokes)
+
+        print(
+            "{} keystrokes, {}: {:.2f}us per keystroke, {} condition "
+            "evaluations".format(
+                keystrokes,
+                "cached" if cached else "uncached",
+                elapsed / keystrokes * 1e6,
+                EVALUATIONS[0],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
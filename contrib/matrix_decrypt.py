@@ -16,27 +16,156 @@
 # CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
 # CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
+import os
+import time
 import argparse
+import hashlib
 import requests
 import tempfile
 import subprocess
+from binascii import Error as BinAsciiError
 
 from urllib.parse import urlparse, parse_qs
-from nio.crypto import decrypt_attachment
 
+import unpaddedbase64
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Util import Counter
 
-def save_file(data):
-    """Save data to a temporary file and return its name."""
-    tmp_dir = tempfile.gettempdir()
+CHUNK_SIZE = 1 << 16
 
-    with tempfile.NamedTemporaryFile(
-        prefix='plumber-',
-        dir=tmp_dir,
-        delete=False
-    ) as f:
-        f.write(data)
-        f.flush()
-        return f.name
+# Partial downloads of processes that got killed are removed once they are
+# older than this (in seconds).
+PARTIAL_FILE_AGE = 24 * 60 * 60
+
+
+class DecryptionError(Exception):
+    pass
+
+
+def default_cache_dir():
+    cache_home = (os.environ.get("XDG_CACHE_HOME")
+                  or os.path.expanduser("~/.cache"))
+    return os.path.join(cache_home, "weechat-matrix", "media")
+
+
+class MediaCache(object):
+    """Decrypted attachments keyed by their URL and the hash of their
+    content.
+
+    Every file is stored under a name derived from its key, opening a file
+    updates its modification time. Once the files take up more than max_size
+    bytes the least recently used ones are removed.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, url, hash):
+        name = "{}{}\0{}".format(url.netloc, url.path, hash)
+        return os.path.join(
+            self.directory,
+            hashlib.sha256(name.encode("utf-8")).hexdigest()
+        )
+
+    def get(self, path):
+        """Return the path if the file is cached, None otherwise."""
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+
+        return path
+
+    def evict(self, keep=None):
+        """Remove the least recently used files until the cache fits its
+        size, the file at the keep path is never removed."""
+        files = []
+        now = time.time()
+
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+
+            if entry.name.endswith(".part"):
+                if now - stat.st_mtime > PARTIAL_FILE_AGE:
+                    remove(entry.path)
+                continue
+
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+
+        for _, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+
+            if path == keep:
+                continue
+
+            remove(path)
+            total -= size
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def download(session, http_url, key, hash, iv, path):
+    """Download an encrypted attachment and write its plaintext to path.
+
+    The ciphertext is decrypted and hashed while it is downloaded, only a
+    chunk of it is held in memory at a time. The plaintext is written to a
+    partial file which is moved to path once the hash is verified.
+    """
+    try:
+        byte_key = unpaddedbase64.decode_base64(key)
+        # Drop last 8 bytes, which are 0
+        byte_iv = unpaddedbase64.decode_base64(iv)[:8]
+        expected_hash = unpaddedbase64.decode_base64(hash)
+        counter = Counter.new(64, prefix=byte_iv, initial_value=0)
+        cipher = AES.new(byte_key, AES.MODE_CTR, counter=counter)
+    except (BinAsciiError, TypeError, ValueError) as e:
+        raise DecryptionError("Invalid decryption argument: {}".format(e))
+
+    sha256 = SHA256.new()
+
+    # The decrypted files are only readable by us, mkstemp() creates them
+    # with 0600 permissions.
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    fd, partial_path = tempfile.mkstemp(
+        dir=os.path.dirname(path),
+        suffix=".part"
+    )
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            with session.get(http_url, stream=True) as response:
+                if not response.ok:
+                    raise DecryptionError("Error downloading file")
+
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    sha256.update(chunk)
+                    f.write(cipher.decrypt(chunk))
+
+        if sha256.digest() != expected_hash:
+            raise DecryptionError("Mismatched SHA-256 digest")
+
+        os.replace(partial_path, path)
+
+    except requests.exceptions.RequestException as e:
+        remove(partial_path)
+        raise DecryptionError("Error downloading file: {}".format(e))
+
+    except BaseException:
+        remove(partial_path)
+        raise
 
 
 def main():
@@ -47,12 +176,20 @@ def main():
     parser.add_argument('--plumber',
                         help='program that gets called with the '
                              'dowloaded file')
+    parser.add_argument('--cache-dir',
+                        default=default_cache_dir(),
+                        help='directory in which decrypted files are kept')
+    parser.add_argument('--cache-size',
+                        type=int,
+                        default=512,
+                        help='maximum size of the cached files in MiB, with '
+                             '0 only the most recently opened file is kept')
 
     args = parser.parse_args()
     url = urlparse(args.url)
     query = parse_qs(url.query)
 
-    if not query["key"] or not query["iv"] or not query["hash"]:
+    if not query.get("key") or not query.get("iv") or not query.get("hash"):
         print("Missing decryption argument")
         return -1
 
@@ -62,16 +199,23 @@ def main():
 
     http_url = "https://{}{}".format(url.netloc, url.path)
 
-    request = requests.get(http_url)
+    cache = MediaCache(args.cache_dir, args.cache_size << 20)
+    file_name = cache.path(url, hash)
+
+    if not cache.get(file_name):
+        try:
+            download(requests.Session(), http_url, key, hash, iv, file_name)
+        except (DecryptionError, OSError) as e:
+            print(e)
+            return -2
 
-    if not request.ok:
-        print("Error downloading file")
-        return -2
+        cache.evict(keep=file_name)
 
     plumber = args.plumber or "/usr/bin/rifle"
-    plaintext = decrypt_attachment(request.content, key, hash, iv)
-    file_name = save_file(plaintext)
 
+    # The file isn't removed once the plumber exits, even if the cache size is
+    # 0, plumbers like rifle return before the file is opened. It's removed by
+    # the eviction run of the next download instead.
     subprocess.run([plumber, "{file}".format(file=file_name)])
 
     return 0
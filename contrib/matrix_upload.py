@@ -15,21 +15,72 @@
 
 
 import os
+import sys
 import json
+import fcntl
+import hashlib
+import tempfile
 import magic
 import requests
 import argparse
-from urllib.parse import urlparse
-from itertools import zip_longest
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import quote, urlparse
 import urllib3
 
+import unpaddedbase64
+from Crypto import Random
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Util import Counter
+
 from nio import Api, UploadResponse, UploadError
-from nio.crypto import encrypt_attachment
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
 
 from json.decoder import JSONDecodeError
 
 urllib3.disable_warnings()
 
+# The file is read in chunks of 1/64th of its size within these bounds, large
+# chunks keep the per chunk overhead of encrypting and sending low.
+MIN_CHUNK_SIZE = 1 << 20
+MAX_CHUNK_SIZE = 4 << 20
+
+# Progress is reported at most this often (in seconds) unless the upload
+# advanced by more than PROGRESS_STEP percent since the last report.
+PROGRESS_INTERVAL = 0.5
+PROGRESS_STEP = 5
+
+# Failed requests are retried after RETRY_DELAY seconds, the delay doubles
+# with every attempt up to MAX_RETRY_DELAY.
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+# Create-then-put upload endpoints (MSC2246, part of the spec since v1.7).
+ASYNC_UPLOAD_PATHS = (
+    "/_matrix/media/v1/create",
+    "/_matrix/media/v3/upload"
+)
+UNSTABLE_ASYNC_UPLOAD_PATHS = (
+    "/_matrix/media/unstable/fi.mau.msc2246/create",
+    "/_matrix/media/unstable/fi.mau.msc2246/upload"
+)
+SUPPORTED_UPLOAD_PATHS = {}
+
+# Image modes the formats we write can store, other modes are converted to
+# the mode in the second position first.
+SAVE_MODES = {
+    "JPEG": (("RGB", "L"), "RGB"),
+    "PNG": (("1", "L", "LA", "P", "RGB", "RGBA"), "RGBA"),
+}
+
 
 def to_stdout(message):
     print(json.dumps(message), flush=True)
@@ -45,6 +96,22 @@ def error(e):
     os.sys.exit()
 
 
+class UploadFailed(Exception):
+    pass
+
+
+class UploadCancelled(Exception):
+    pass
+
+
+class TransientError(UploadFailed):
+    """A failure that might go away if the request is retried."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
 def mime_from_file(file):
     try:
         t = magic.from_file(file, mime=True)
@@ -65,23 +132,51 @@ def mime_from_file(file):
     return t
 
 
+def chunk_size(totalsize):
+    return min(max(totalsize // 64, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+
+
 class Upload(object):
-    def __init__(self, file, chunksize=1 << 13):
+    def __init__(self, file, chunksize=None, report=to_stdout):
         self.file = file
+        self.report = report
         self.filename = os.path.basename(file)
-        self.chunksize = chunksize
         self.totalsize = os.path.getsize(file)
+        self.chunksize = chunksize or chunk_size(self.totalsize)
         self.mimetype = mime_from_file(file)
         self.readsofar = 0
+        self.reported = 0
+        self.reported_time = 0
+        # An event that is set once the upload should be stopped.
+        self.cancelled = None
+
+    def check_cancelled(self):
+        if self.cancelled and self.cancelled.is_set():
+            raise UploadCancelled()
 
     def send_progress(self):
+        now = time.monotonic()
+        step = self.totalsize * PROGRESS_STEP / 100
+
+        if (self.readsofar < self.totalsize
+                and now - self.reported_time < PROGRESS_INTERVAL
+                and self.readsofar - self.reported < step):
+            return
+
+        self.reported = self.readsofar
+        self.reported_time = now
+
         message = {
             "type": "progress",
             "data": self.readsofar
         }
-        to_stdout(message)
+        self.report(message)
 
     def __iter__(self):
+        # Every attempt to send the file starts from the beginning.
+        self.readsofar = 0
+        self.reported = 0
+
         with open(self.file, 'rb') as file:
             while True:
                 data = file.read(self.chunksize)
@@ -89,6 +184,7 @@ class Upload(object):
                 if not data:
                     break
 
+                self.check_cancelled()
                 self.readsofar += len(data)
                 self.send_progress()
 
@@ -98,39 +194,117 @@ class Upload(object):
         return self.totalsize
 
 
-def chunk_bytes(iterable, n):
-    args = [iter(iterable)] * n
-    return (
-        bytes(
-            (filter(lambda x: x is not None, chunk))
-        ) for chunk in zip_longest(*args)
-    )
+class StreamingEncryptor(object):
+    """Encrypt a file for an encrypted attachment one chunk at a time.
+
+    The file is read into a single fixed-size buffer which is encrypted in
+    place with AES-CTR, the SHA-256 hash of the ciphertext is updated as we
+    go. The memory used doesn't depend on the size of the file.
+
+    The decryption info is available in file_keys once the whole file has
+    been encrypted, it has the same format as the one
+    nio.crypto.encrypt_attachment() returns.
+
+    A key and IV can be passed in to produce the same ciphertext as an
+    earlier attempt to upload the file.
+    """
+
+    def __init__(self, file, chunksize, key=None, iv=None):
+        self.file = file
+        self.buffer = bytearray(chunksize)
+
+        self.key = key or Random.new().read(32)
+        # 8 bytes IV, the other 8 bytes of the counter block are the counter.
+        self.iv = iv or Random.new().read(8)
+        self.sha256 = None
+        self.complete = False
+
+    def __iter__(self):
+        """Yield the ciphertext of the file.
+
+        The yielded memoryview slices all point into the same buffer, a slice
+        is only valid until the next one is requested. Every iteration
+        starts encrypting from the beginning of the file.
+        """
+        view = memoryview(self.buffer)
+
+        counter = Counter.new(64, prefix=self.iv, initial_value=0)
+        cipher = AES.new(self.key, AES.MODE_CTR, counter=counter)
+        self.sha256 = SHA256.new()
+        self.complete = False
+
+        with open(self.file, "rb") as file:
+            while True:
+                length = file.readinto(self.buffer)
+
+                if not length:
+                    break
+
+                chunk = view[:length]
+                cipher.encrypt(chunk, output=chunk)
+                self.sha256.update(chunk)
+
+                yield chunk
+
+        self.complete = True
+
+    def finish(self):
+        """Encrypt the rest of the file if the last iteration was cut short,
+        the hash needs the whole ciphertext."""
+        if not self.complete:
+            for _ in self:
+                pass
+
+    @property
+    def file_keys(self):
+        return {
+            "v": "v2",
+            "key": {
+                "kty": "oct",
+                "alg": "A256CTR",
+                "ext": True,
+                "k": unpaddedbase64.encode_base64(self.key, urlsafe=True),
+                "key_ops": ["encrypt", "decrypt"],
+            },
+            # Send the IV concatenated with the counter.
+            "iv": unpaddedbase64.encode_base64(self.iv + b"\x00" * 8),
+            "hashes": {
+                "sha256": unpaddedbase64.encode_base64(self.sha256.digest())
+            },
+        }
 
 
 class EncryptedUpload(Upload):
-    def __init__(self, file, chunksize=1 << 13):
-        super().__init__(file, chunksize)
+    def __init__(self, file, chunksize=None, report=to_stdout, key=None,
+                 iv=None):
+        super().__init__(file, chunksize, report)
         self.source_mimetype = self.mimetype
         self.mimetype = "application/octet-stream"
+        self.encryptor = StreamingEncryptor(
+            self.file,
+            self.chunksize,
+            key,
+            iv
+        )
 
-        with open(self.filename, "rb") as file:
-            self.ciphertext, self.file_keys = encrypt_attachment(file.read())
-
-    def send_progress(self):
-        message = {
-            "type": "progress",
-            "data": self.readsofar
-        }
-        to_stdout(message)
+    @property
+    def file_keys(self):
+        self.encryptor.finish()
+        return self.encryptor.file_keys
 
     def __iter__(self):
-        for chunk in chunk_bytes(self.ciphertext, self.chunksize):
+        self.readsofar = 0
+        self.reported = 0
+
+        for chunk in self.encryptor:
+            self.check_cancelled()
             self.readsofar += len(chunk)
             self.send_progress()
             yield chunk
 
     def __len__(self):
-        return len(self.ciphertext)
+        # AES-CTR doesn't pad, the ciphertext is as long as the file.
+        return self.totalsize
 
 
 class IterableToFileAdapter(object):
@@ -145,131 +319,882 @@ class IterableToFileAdapter(object):
         return self.length
 
 
-def upload_process(args):
-    file_path = os.path.expanduser(args.file)
-    thumbnail = None
+def proxies_from_args(args):
+    if not args.proxy_address:
+        return {}
 
-    try:
-        if args.encrypt:
-            upload = EncryptedUpload(file_path)
+    user = args.proxy_user or ""
 
-            if upload.source_mimetype.startswith("image"):
-                # TODO create a thumbnail
-                thumbnail = None
-        else:
-            upload = Upload(file_path)
+    if args.proxy_password:
+        user += ":{}".format(args.proxy_password)
 
-    except (FileNotFoundError, OSError, IOError) as e:
-        error(e)
+    if user:
+        user += "@"
+
+    return {
+        "https": "{}://{}{}:{}/".format(
+            args.proxy_type,
+            user,
+            args.proxy_address,
+            args.proxy_port
+        )
+    }
+
+
+def new_session(pool_size=1):
+    session = requests.Session()
+    session.trust_env = False
+
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_size
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+class Checkpoint(object):
+    """The state of an upload that is kept in the state directory until the
+    upload succeeds.
+
+    It contains the content URI reserved for the file using the create-then-
+    put upload API and, for encrypted uploads, the key and IV the file is
+    encrypted with. Uploading the same unmodified file again after a failure
+    reuses them, so the upload ends up at the same URI even if the upload
+    process was restarted in between.
+    """
+
+    def __init__(self, state_dir, file_path, encrypt):
+        self.path = None
+        self.data = {}
+
+        if not state_dir:
+            return
+
+        stat = os.stat(file_path)
+        file_id = "{}:{}:{}:{}".format(
+            os.path.abspath(file_path),
+            stat.st_size,
+            stat.st_mtime_ns,
+            encrypt
+        )
+        name = hashlib.sha256(file_id.encode("utf-8")).hexdigest()
+        self.path = os.path.join(state_dir, "uploads", name + ".json")
+
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        expires = self.data.get("unused_expires_at")
+
+        # The server forgets reserved URIs that weren't used in time.
+        if expires and expires < time.time() * 1000:
+            self.remove()
+
+    def save(self, **values):
+        self.data.update(values)
+
+        if not self.path:
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + ".tmp"
+
+        with open(temp_path, "w") as f:
+            json.dump(self.data, f)
+
+        os.replace(temp_path, self.path)
+
+    def remove(self):
+        self.data = {}
+
+        if not self.path:
+            return
+
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class UploadCache(object):
+    """The content URIs of earlier uploads keyed by the hash of the file.
+
+    The cache is a JSON file in the state directory shared by all the upload
+    processes of a server, a lock file serializes the access to it. Once it
+    holds more than size entries the least recently used ones are evicted.
+    """
+
+    def __init__(self, state_dir, size):
+        self.path = os.path.join(state_dir, "upload_cache.json")
+        self.size = size
+
+    @staticmethod
+    def key(file_path, encrypt, reuse_encrypted, room_id):
+        """Get the cache key of a file, None if the upload shouldn't use the
+        cache.
 
+        Encrypted uploads are only reused if reuse_encrypted allows it,
+        either within the same room or within all the rooms of the server.
+        """
+        if encrypt and reuse_encrypted == "never":
+            return None
+
+        sha256 = hashlib.sha256()
+
+        with open(file_path, "rb") as file:
+            for chunk in iter(lambda: file.read(MIN_CHUNK_SIZE), b""):
+                sha256.update(chunk)
+
+        key = sha256.hexdigest()
+
+        if not encrypt:
+            return key
+
+        if reuse_encrypted == "room":
+            return "{}:encrypted:{}".format(key, room_id)
+
+        return "{}:encrypted".format(key)
+
+    @contextmanager
+    def entries(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            try:
+                with open(self.path) as f:
+                    entries = json.load(f, object_pairs_hook=OrderedDict)
+            except (OSError, ValueError):
+                entries = OrderedDict()
+
+            yield entries
+
+            while len(entries) > self.size:
+                entries.popitem(last=False)
+
+            temp_path = self.path + ".tmp"
+
+            with open(temp_path, "w") as f:
+                json.dump(entries, f)
+
+            os.replace(temp_path, self.path)
+
+    def get(self, key):
+        with self.entries() as entries:
+            entry = entries.pop(key, None)
+
+            if entry:
+                entries[key] = entry
+
+            return entry
+
+    def put(self, key, entry):
+        with self.entries() as entries:
+            entries.pop(key, None)
+            entries[key] = entry
+
+
+def homeserver_url(homeserver):
     try:
-        url = urlparse(args.homeserver)
+        url = urlparse(homeserver)
     except ValueError as e:
-        error(e)
+        raise UploadFailed(e)
+
+    if not url.scheme:
+        homeserver = "https://{}".format(homeserver)
+
+    return homeserver.rstrip("/")
+
+
+def send_request(session, method, url, **kwargs):
+    """Send a request, connection errors and rate limiting or server errors
+    raise a TransientError."""
+    try:
+        response = session.request(method, url, **kwargs)
+    except (requests.exceptions.RequestException, OSError) as e:
+        raise TransientError(e)
+
+    if response.status_code == 429 or response.status_code >= 500:
+        retry_after = None
+
+        try:
+            retry_after = response.json()["retry_after_ms"] / 1000
+        except (ValueError, KeyError, TypeError):
+            pass
+
+        raise TransientError(
+            "{} {}".format(response.status_code, response.text),
+            retry_after
+        )
+
+    return response
+
+
+def with_retries(send, retries, report):
+    """Call send until it doesn't raise a TransientError, at most retries
+    more times, waiting longer after every failed attempt."""
+    delay = RETRY_DELAY
+    attempt = 0
+
+    while True:
+        try:
+            return send()
+        except TransientError as e:
+            if attempt >= retries:
+                raise UploadFailed(e)
+
+            attempt += 1
+            wait = e.retry_after if e.retry_after is not None else delay
+
+            report({
+                "type": "status",
+                "status": "retrying",
+                "attempt": attempt,
+                "delay": wait,
+                "message": str(e)
+            })
+
+            time.sleep(wait)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+
+def async_upload_paths(session, base_url, options):
+    """Get the create and upload paths of the create-then-put upload API if
+    the homeserver advertises it."""
+    if base_url in SUPPORTED_UPLOAD_PATHS:
+        return SUPPORTED_UPLOAD_PATHS[base_url]
+
+    try:
+        response = session.get(
+            base_url + "/_matrix/client/versions",
+            verify=(not options.insecure),
+            proxies=proxies_from_args(options),
+            timeout=30
+        )
+        versions = response.json()
+    except (requests.exceptions.RequestException, OSError, ValueError):
+        return None
+
+    paths = None
 
-    upload_url = ("https://{}".format(args.homeserver)
-                  if not url.scheme else args.homeserver)
-    _, api_path, _ = Api.upload(args.access_token, upload.filename)
-    upload_url += api_path
+    if versions.get("unstable_features", {}).get("fi.mau.msc2246"):
+        paths = UNSTABLE_ASYNC_UPLOAD_PATHS
 
-    headers = {
-        "Content-type": upload.mimetype,
+    for version in versions.get("versions", []):
+        try:
+            major, minor = version.lstrip("v").split(".")[:2]
+        except ValueError:
+            continue
+
+        if (major.isdigit() and minor.isdigit()
+                and (int(major), int(minor)) >= (1, 7)):
+            paths = ASYNC_UPLOAD_PATHS
+
+    # The worker uploads many files to the same homeserver.
+    SUPPORTED_UPLOAD_PATHS[base_url] = paths
+
+    return paths
+
+
+class PreparedImage(object):
+    """An image that is ready to be uploaded together with its thumbnail.
+
+    The image is downscaled and recompressed if the file is bigger than
+    options.downscale_above bytes, a thumbnail is created if the image is
+    bigger than options.thumbnail_size pixels. The path points to the file
+    that should be uploaded instead of the original one, info and
+    thumbnail_info hold the image info for the event content. The temporary
+    files have to be removed using cleanup().
+
+    The thumbnail and the downscaled image are optional, if creating them
+    fails the original file is uploaded without a thumbnail.
+    """
+
+    errors = (OSError, ValueError, KeyError)
+
+    def __init__(self, file_path, options):
+        self.path = file_path
+        self.info = {}
+        self.thumbnail = None
+        self.thumbnail_info = None
+        self.temp_files = []
+
+        try:
+            self.prepare(options)
+        except BaseException:
+            self.cleanup()
+            raise
+
+    def prepare(self, options):
+        try:
+            with Image.open(self.path) as original:
+                original_format = original.format
+                animated = getattr(original, "is_animated", False)
+                image = ImageOps.exif_transpose(original)
+        except self.errors + (Image.DecompressionBombError,):
+            return
+
+        if (original_format and not animated and options.downscale_above
+                and os.path.getsize(self.path) > options.downscale_above):
+            try:
+                image = self.downscale(image, original_format, options)
+            except self.errors:
+                pass
+
+        self.info = {"w": image.width, "h": image.height}
+
+        if (options.thumbnail_size
+                and max(image.size) > options.thumbnail_size):
+            try:
+                self.create_thumbnail(image, options.thumbnail_size)
+            except self.errors:
+                self.thumbnail = None
+                self.thumbnail_info = None
+
+    def create_thumbnail(self, image, size):
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size))
+        thumbnail_format = (
+            "JPEG" if thumbnail.mode in ("RGB", "L", "CMYK") else "PNG"
+        )
+
+        path = self.save(thumbnail, thumbnail_format)
+        self.thumbnail_info = {
+            "w": thumbnail.width,
+            "h": thumbnail.height,
+            "mimetype": "image/" + thumbnail_format.lower(),
+            "size": os.path.getsize(path),
+        }
+        self.thumbnail = path
+
+    def downscale(self, image, image_format, options):
+        scaled = image.copy()
+
+        if options.downscale_size:
+            scaled.thumbnail((options.downscale_size, options.downscale_size))
+
+        path = self.save(scaled, image_format)
+
+        # Recompressing doesn't always help, keep the original then.
+        if os.path.getsize(path) >= os.path.getsize(self.path):
+            return image
+
+        self.path = path
+        return scaled
+
+    def save(self, image, image_format):
+        modes, fallback_mode = SAVE_MODES.get(image_format, ((), None))
+
+        if fallback_mode and image.mode not in modes:
+            image = image.convert(fallback_mode)
+
+        fd, path = tempfile.mkstemp(suffix="." + image_format.lower())
+        os.close(fd)
+        self.temp_files.append(path)
+
+        image.save(path, image_format, quality=85, optimize=True)
+
+        return path
+
+    def cleanup(self):
+        for path in self.temp_files:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def new_upload(file_path, encrypt, options, report, checkpoint=None,
+               cancelled=None):
+    if not encrypt:
+        upload = Upload(file_path, options.chunk_size, report)
+    else:
+        key = checkpoint.data.get("key") if checkpoint else None
+        iv = checkpoint.data.get("iv") if checkpoint else None
+
+        upload = EncryptedUpload(
+            file_path,
+            options.chunk_size,
+            report,
+            unpaddedbase64.decode_base64(key) if key else None,
+            unpaddedbase64.decode_base64(iv) if iv else None,
+        )
+
+    upload.cancelled = cancelled
+
+    return upload
+
+
+def send_upload(session, options, access_token, upload, checkpoint, report):
+    """Send the file of the upload, returns its content URI."""
+    base_url = homeserver_url(options.homeserver)
+    request_args = {
+        "verify": not options.insecure,
+        "proxies": proxies_from_args(options),
     }
 
-    proxies = {}
+    paths = async_upload_paths(session, base_url, options)
+
+    if paths:
+        return put_upload(
+            session,
+            base_url,
+            paths,
+            access_token,
+            upload,
+            checkpoint,
+            request_args,
+            options.retries,
+            report
+        )
+
+    return post_upload(
+        session,
+        base_url,
+        access_token,
+        upload,
+        request_args,
+        options.retries,
+        report
+    )
+
 
-    if args.proxy_address:
-        user = args.proxy_user or ""
+def upload_file(session, options, access_token, file_path, encrypt,
+                room_id=None, report=to_stdout, cancelled=None):
+    """Upload a single file and report its progress.
 
-        if args.proxy_password:
-            user += ":{}".format(args.proxy_password)
+    The options are the parsed command line arguments, they contain the
+    homeserver and connection, chunk size, retry, cache, image and state
+    directory settings. If the file was uploaded before and the cache has its
+    content URI nothing is transferred. Images are prepared before the
+    upload, their thumbnail is uploaded alongside them. Raises UploadFailed
+    if the file can't be read or the upload fails and UploadCancelled if the
+    cancelled event gets set while the file is sent.
+    """
+    cache = None
+    cache_key = None
+    image = None
 
-        if user:
-            user += "@"
+    try:
+        checkpoint = Checkpoint(options.state_dir, file_path, encrypt)
 
-        proxies = {
-            "https": "{}://{}{}:{}/".format(
-                args.proxy_type,
-                user,
-                args.proxy_address,
-                args.proxy_port
+        if options.state_dir and options.cache_size:
+            cache = UploadCache(options.state_dir, options.cache_size)
+            cache_key = UploadCache.key(
+                file_path,
+                encrypt,
+                options.reuse_encrypted,
+                room_id
             )
-        }
+
+        upload = new_upload(file_path, encrypt, options, report, checkpoint,
+                            cancelled)
+
+    except (FileNotFoundError, OSError, IOError) as e:
+        raise UploadFailed(e)
+
+    mimetype = (upload.source_mimetype if isinstance(upload, EncryptedUpload)
+                else upload.mimetype)
 
     message = {
         "type": "status",
         "status": "started",
         "total": upload.totalsize,
         "file_name": upload.filename,
+        "mimetype": mimetype,
     }
 
-    if isinstance(upload, EncryptedUpload):
-        message["mimetype"] = upload.source_mimetype
-    else:
-        message["mimetype"] = upload.mimetype
+    report(message)
 
-    to_stdout(message)
+    entry = None
 
-    session = requests.Session()
-    session.trust_env = False
+    if cache_key:
+        try:
+            entry = cache.get(cache_key)
+        except OSError:
+            pass
+
+    if entry:
+        report({"type": "progress", "data": upload.totalsize})
+
+        message = {
+            "type": "status",
+            "status": "done",
+            "url": entry["content_uri"],
+            "info": entry.get("info", {}),
+            "cached": True
+        }
+
+        if encrypt:
+            message["file_keys"] = entry["file_keys"]
+
+        report(message)
+        return
 
     try:
-        r = session.post(
-            url=upload_url,
-            auth=None,
-            headers=headers,
+        if Image and mimetype.startswith("image/"):
+            image = PreparedImage(file_path, options)
+
+            if image.path != file_path:
+                upload = new_upload(image.path, encrypt, options, report,
+                                    checkpoint, cancelled)
+                upload.filename = os.path.basename(file_path)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            thumbnail = None
+            thumbnail_uri = None
+
+            if image and image.thumbnail:
+                # The thumbnail is small, its progress isn't reported.
+                thumbnail = new_upload(image.thumbnail, encrypt, options,
+                                       lambda message: None,
+                                       cancelled=cancelled)
+                thumbnail_uri = executor.submit(
+                    send_upload, session, options, access_token, thumbnail,
+                    Checkpoint(None, image.thumbnail, encrypt),
+                    lambda message: None
+                )
+
+            content_uri = send_upload(session, options, access_token, upload,
+                                      checkpoint, report)
+
+            info = {
+                "mimetype": mimetype,
+                "size": upload.totalsize,
+            }
+
+            if image:
+                info.update(image.info)
+
+            try:
+                thumbnail_uri = (thumbnail_uri.result() if thumbnail_uri
+                                 else None)
+            except (UploadFailed, UploadCancelled, OSError):
+                # The upload is still fine without a thumbnail.
+                thumbnail_uri = None
+
+            if thumbnail_uri:
+                if encrypt:
+                    info["thumbnail_file"] = dict(
+                        thumbnail.file_keys,
+                        url=thumbnail_uri,
+                        mimetype=image.thumbnail_info["mimetype"]
+                    )
+                else:
+                    info["thumbnail_url"] = thumbnail_uri
+
+                info["thumbnail_info"] = image.thumbnail_info
+
+    except (FileNotFoundError, OSError, IOError) as e:
+        raise UploadFailed(e)
+
+    finally:
+        if image:
+            image.cleanup()
+
+    message = {
+        "type": "status",
+        "status": "done",
+        "url": content_uri,
+        "info": info,
+    }
+
+    if isinstance(upload, EncryptedUpload):
+        message["file_keys"] = upload.file_keys
+
+    checkpoint.remove()
+
+    if cache_key:
+        entry = {"content_uri": content_uri, "info": info}
+
+        if encrypt:
+            entry["file_keys"] = message["file_keys"]
+
+        try:
+            cache.put(cache_key, entry)
+        except OSError:
+            pass
+
+    report(message)
+
+
+def post_upload(session, base_url, access_token, upload, request_args,
+                retries, report):
+    """Upload the file in a single request, returns the content URI."""
+    _, api_path, _ = Api.upload(access_token, upload.filename)
+
+    def send():
+        return send_request(
+            session,
+            "POST",
+            base_url + api_path,
+            headers={"Content-type": upload.mimetype},
             data=IterableToFileAdapter(upload),
-            verify=(not args.insecure),
-            proxies=proxies
+            **request_args
         )
-    except (requests.exceptions.RequestException, OSError) as e:
-        error(e)
+
+    r = with_retries(send, retries, report)
 
     try:
         json_response = json.loads(r.content)
     except JSONDecodeError:
-        error(r.content)
+        raise UploadFailed(r.content)
 
     response = UploadResponse.from_dict(json_response)
 
     if isinstance(response, UploadError):
-        error(str(response))
+        raise UploadFailed(str(response))
 
-    message = {
-        "type": "status",
-        "status": "done",
-        "url": response.content_uri
-    }
+    return response.content_uri
 
-    if isinstance(upload, EncryptedUpload):
-        message["file_keys"] = upload.file_keys
 
-    to_stdout(message)
+def put_upload(session, base_url, paths, access_token, upload, checkpoint,
+               request_args, retries, report):
+    """Reserve a content URI and upload the file to it, returns the content
+    URI.
 
-    return 0
+    The URI and the encryption keys are checkpointed before the file is sent.
+    If the server already has the content for the URI an earlier attempt
+    succeeded even if we didn't get the response.
+    """
+    create_path, upload_path = paths
+    headers = {"Authorization": "Bearer {}".format(access_token)}
 
+    content_uri = checkpoint.data.get("content_uri")
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Encrypt and upload matrix attachments"
+    if not content_uri:
+        def create():
+            return send_request(
+                session,
+                "POST",
+                base_url + create_path,
+                headers=headers,
+                **request_args
+            )
+
+        r = with_retries(create, retries, report)
+
+        try:
+            response = r.json()
+            content_uri = response["content_uri"]
+        except (ValueError, KeyError, TypeError):
+            raise UploadFailed(r.text)
+
+        values = {
+            "content_uri": content_uri,
+            "unused_expires_at": response.get("unused_expires_at"),
+        }
+
+        if isinstance(upload, EncryptedUpload):
+            values["key"] = unpaddedbase64.encode_base64(
+                upload.encryptor.key
+            )
+            values["iv"] = unpaddedbase64.encode_base64(upload.encryptor.iv)
+
+        try:
+            checkpoint.save(**values)
+        except OSError:
+            # The upload works without a checkpoint, it just can't be
+            # resumed by another process.
+            pass
+
+    try:
+        server_name, media_id = content_uri[len("mxc://"):].split("/", 1)
+    except ValueError:
+        raise UploadFailed("Invalid content URI {}".format(content_uri))
+
+    url = "{}{}/{}/{}?filename={}".format(
+        base_url,
+        upload_path,
+        quote(server_name),
+        quote(media_id),
+        quote(upload.filename)
     )
-    parser.add_argument("file", help="the file that will be uploaded")
+
+    def send():
+        return send_request(
+            session,
+            "PUT",
+            url,
+            headers=dict(headers, **{"Content-type": upload.mimetype}),
+            data=IterableToFileAdapter(upload),
+            **request_args
+        )
+
+    r = with_retries(send, retries, report)
+
+    if r.status_code == 200:
+        return content_uri
+
+    try:
+        errcode = r.json().get("errcode")
+    except (ValueError, AttributeError):
+        errcode = None
+
+    if errcode == "M_CANNOT_OVERWRITE_MEDIA":
+        return content_uri
+
+    if errcode == "M_NOT_FOUND":
+        # The reserved URI expired, the next attempt will create a new one.
+        checkpoint.remove()
+
+    raise UploadFailed("{} {}".format(r.status_code, r.text))
+
+
+def upload_process(args):
+    try:
+        upload_file(
+            new_session(),
+            args,
+            args.access_token,
+            os.path.expanduser(args.file),
+            args.encrypt,
+            args.room_id
+        )
+    except UploadFailed as e:
+        error(e)
+
+    return 0
+
+
+def worker_process(args):
+    """Upload the files of the jobs we receive on stdin until it's closed.
+
+    Every job is a JSON object on a line of its own containing the id of the
+    upload, the file, the access token, the room and whether the file should
+    be encrypted. The uploads share a session, so connections to the homeserver
+    are kept alive and reused, and up to args.concurrency of them run at the
+    same time. Every message we print contains the id of the upload it
+    belongs to.
+
+    A line containing only a cancel key with the id of an upload stops that
+    upload, nothing is printed for it anymore.
+    """
+    session = new_session(args.concurrency)
+    stdout_lock = threading.Lock()
+    cancelled = {}
+
+    def run(job):
+        def report(message):
+            message["id"] = job["id"]
+
+            with stdout_lock:
+                to_stdout(message)
+
+        event = cancelled[job["id"]]
+
+        try:
+            if event.is_set():
+                return
+
+            upload_file(
+                session,
+                args,
+                job["access_token"],
+                os.path.expanduser(job["file"]),
+                job.get("encrypt", False),
+                job.get("room_id"),
+                report,
+                event
+            )
+        except UploadCancelled:
+            pass
+        except Exception as e:
+            # An exception would otherwise be stored in the future nobody
+            # looks at, report it instead so the upload isn't stuck.
+            report({
+                "type": "status",
+                "status": "error",
+                "message": str(e)
+            })
+        finally:
+            del cancelled[job["id"]]
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for line in sys.stdin:
+            try:
+                job = json.loads(line)
+            except JSONDecodeError:
+                continue
+
+            if "cancel" in job:
+                # The upload might have finished in the meantime.
+                event = cancelled.get(job["cancel"])
+
+                if event:
+                    event.set()
+
+                continue
+
+            cancelled[job["id"]] = threading.Event()
+            executor.submit(run, job)
+
+    return 0
+
+
+def add_common_arguments(parser):
     parser.add_argument(
-        "homeserver",
+        "--state-dir",
         type=str,
-        help="the address of the homeserver"
+        help=("directory in which the state of unfinished uploads is kept so "
+              "they can be resumed")
     )
     parser.add_argument(
-        "access_token",
-        type=str,
-        help="the access token to use for the upload"
+        "--chunk-size",
+        type=int,
+        help=("size of the chunks the file is read in, by default it depends "
+              "on the size of the file")
     )
     parser.add_argument(
-        "--encrypt",
-        action="store_const",
-        const=True,
-        default=False,
-        help="encrypt the file before uploading it"
+        "--retries",
+        type=int,
+        default=5,
+        help="number of times a failed request is retried"
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=0,
+        help=("number of uploaded files whose content URI is kept in the "
+              "state directory so uploading them again can be skipped, 0 "
+              "disables the cache")
+    )
+    parser.add_argument(
+        "--thumbnail-size",
+        type=int,
+        default=0,
+        help=("create a thumbnail no bigger than this many pixels for images "
+              "that are bigger, 0 disables thumbnails (requires Pillow)")
+    )
+    parser.add_argument(
+        "--downscale-above",
+        type=int,
+        default=0,
+        help=("downscale and recompress images whose file is bigger than "
+              "this many bytes, 0 disables it (requires Pillow)")
+    )
+    parser.add_argument(
+        "--downscale-size",
+        type=int,
+        default=2048,
+        help="the size in pixels images are downscaled to"
+    )
+    parser.add_argument(
+        "--reuse-encrypted",
+        choices=[
+            "never",
+            "room",
+            "server"
+        ],
+        default="never",
+        help=("whether the cache is used for encrypted uploads, within the "
+              "same room or within all the rooms of the server")
     )
     parser.add_argument(
         "--insecure",
@@ -310,6 +1235,63 @@ def main():
         help="password that will be used for authentication on the proxy"
     )
 
+
+def worker_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="matrix_upload --worker",
+        description=("Encrypt and upload matrix attachments read as JSON "
+                     "jobs from stdin")
+    )
+    parser.add_argument(
+        "homeserver",
+        type=str,
+        help="the address of the homeserver"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=2,
+        help="the number of uploads that run at the same time"
+    )
+    add_common_arguments(parser)
+
+    args = parser.parse_args(argv)
+    worker_process(args)
+
+
+def main():
+    if sys.argv[1:2] == ["--worker"]:
+        worker_main(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(
+        description="Encrypt and upload matrix attachments"
+    )
+    parser.add_argument("file", help="the file that will be uploaded")
+    parser.add_argument(
+        "homeserver",
+        type=str,
+        help="the address of the homeserver"
+    )
+    parser.add_argument(
+        "access_token",
+        type=str,
+        help="the access token to use for the upload"
+    )
+    parser.add_argument(
+        "--encrypt",
+        action="store_const",
+        const=True,
+        default=False,
+        help="encrypt the file before uploading it"
+    )
+    parser.add_argument(
+        "--room-id",
+        type=str,
+        help="the room the file is uploaded to"
+    )
+    add_common_arguments(parser)
+
     args = parser.parse_args()
     upload_process(args)
 
@@ -59,6 +59,7 @@ from matrix.bar_items import (
     matrix_bar_item_lag,
     matrix_bar_item_name,
     matrix_bar_item_plugin,
+    matrix_bar_item_redraw_cb,
     matrix_bar_nicklist_count,
     matrix_bar_typing_notices_cb
 )
@@ -85,20 +86,23 @@ from matrix.completion import (init_completion, matrix_command_completion_cb,
                                matrix_server_completion_cb,
                                matrix_user_completion_cb,
                                matrix_own_devices_completion_cb,
-                               matrix_room_completion_cb)
-from matrix.config import (MatrixConfig, config_log_category_cb,
-                           config_log_level_cb, config_server_buffer_cb,
-                           matrix_config_reload_cb, config_pgup_cb)
+                               matrix_room_completion_cb,
+                               matrix_lazy_room_completion_cb)
+from matrix.config import (MatrixConfig, debug_buffer,
+                           matrix_config_change_cb, matrix_config_reload_cb)
 from matrix.globals import SCRIPT_NAME, SERVERS, W
 from matrix.server import (MatrixServer, create_default_server,
                            matrix_config_server_change_cb,
                            matrix_config_server_read_cb,
-                           matrix_config_server_write_cb, matrix_timer_cb,
+                           matrix_config_server_write_cb,
                            send_cb, matrix_load_users_cb)
+from matrix.scheduler import matrix_scheduler_cb
 from matrix.utf import utf8_decode
 from matrix.utils import server_buffer_prnt, server_buffer_set_title
 
-from matrix.uploads import UploadsBuffer, upload_cb
+from matrix.uploads import (UploadsBuffer, upload_cb, upload_worker_cb,
+                            matrix_uploads_buffer_input_cb,
+                            matrix_uploads_buffer_close_cb)
 
 try:
     from urllib.parse import urlunparse
@@ -546,16 +550,7 @@ class WeechatHandler(StreamHandler):
         )
 
     def write(self, item):
-        buf = ""
-
-        if G.CONFIG.network.debug_buffer:
-            if not G.CONFIG.debug_buffer:
-                G.CONFIG.debug_buffer = W.buffer_new(
-                    "Matrix Debug", "", "", "debug_buffer_close_cb", "")
-
-            buf = G.CONFIG.debug_buffer
-
-        W.prnt(buf, item)
+        W.prnt(debug_buffer(), item)
 
 
 def buffer_switch_cb(_, _signal, buffer_ptr):
@@ -564,8 +559,9 @@ def buffer_switch_cb(_, _signal, buffer_ptr):
     This function is called every time we switch a buffer. The pointer of
     the new buffer is given to us by weechat.
 
-    If it is one of our room buffers we check if the members for the room
-    aren't fetched and fetch them now if they aren't.
+    If it is one of our room buffers we render the events that were deferred
+    while the buffer was hidden and check if the members for the room aren't
+    fetched and fetch them now if they aren't.
 
     Read receipts are send out from here as well.
     """
@@ -580,6 +576,8 @@ def buffer_switch_cb(_, _signal, buffer_ptr):
         if not room_buffer:
             continue
 
+        room_buffer.render_deferred_events()
+
         last_event_id = room_buffer.last_event_id
 
         if room_buffer.should_send_read_marker:
@@ -597,7 +595,12 @@ def buffer_switch_cb(_, _signal, buffer_ptr):
         # The buffer is empty and we are seeing it for the first time.
         # Let us fetch some messages from the room history so it doesn't feel so
         # empty.
-        if room_buffer.first_view and room_buffer.weechat_buffer.num_lines < 10:
+        # Events that were skipped while the buffer was muted or while
+        # catching up are fetched as well.
+        if room_buffer.gap_batch or (
+            room_buffer.first_view
+            and room_buffer.weechat_buffer.num_lines < 10
+        ):
             # TODO we may want to fetch 10 - num_lines messages here for
             # consistency reasons.
             server.room_get_messages(room_buffer.room.room_id)
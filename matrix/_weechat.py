@@ -2,6 +2,9 @@ import datetime
 import random
 import string
 
+WEECHAT_RC_OK = 0
+WEECHAT_RC_ERROR = -1
+
 WEECHAT_BASE_COLORS = {
     "black":        "0",
     "red":          "1",
@@ -36,6 +39,7 @@ class MockConfig(object):
         'color': {
             'error_message_bg': "",
             'error_message_fg': "",
+            'nick_prefixes': {},
             'quote_bg': "",
             'quote_fg': "",
             'unconfirmed_message_bg': "",
@@ -63,20 +67,33 @@ class MockConfig(object):
             'server_buffer': None,
             'new_channel_position': None,
             'markdown_input': True,
+            'lazy_room_buffers': False,
+            'deferred_rendering': False,
         },
         'network': {
+            'catch_up_events': 0,
             'debug_buffer': None,
             'debug_category': None,
             'debug_level': None,
+            'callback_stats': False,
+            'slow_callback_threshold': 0,
             'fetch_backlog_on_pgup': None,
             'lag_min_show': None,
             'lag_reconnect': None,
             'lazy_load_room_users': None,
             'max_initial_sync_events': None,
-            'max_nicklist_users': None,
+            'max_concurrent_uploads': 4,
+            'max_finished_uploads': 50,
+            'max_nicklist_users': 5000,
             'print_unconfirmed_messages': None,
             'read_markers_conditions': None,
+            'reuse_encrypted_uploads': 0,
+            'skip_muted_rooms': False,
             'typing_notice_conditions': None,
+            'upload_cache_size': 0,
+            'upload_downscale_above': 0,
+            'upload_downscale_size': 0,
+            'upload_thumbnail_size': 0,
             'autoreconnect_delay_growing': None,
             'autoreconnect_delay_max': None,
         },
@@ -179,7 +196,7 @@ def prefix(prefix_string):
     }
 
     if prefix_string in prefix_to_symbol:
-        return prefix_to_symbol[prefix]
+        return prefix_to_symbol[prefix_string]
 
     return ""
 
@@ -248,6 +265,10 @@ def nicklist_add_nick(*_, **__):
     return
 
 
+def nicklist_search_group(*_, **__):
+    return ""
+
+
 def nicklist_remove_nick(*_, **__):
     return
 
@@ -256,5 +277,23 @@ def nicklist_search_nick(*args, **kwargs):
     return buffer_new(args, kwargs)
 
 
+def hook_timer(*_, **__):
+    return buffer_new()
+
+
+def unhook(*_, **__):
+    return
+
+
+def string_eval_expression(expression, _pointers, extra_vars, options):
+    for key, value in extra_vars.items():
+        expression = expression.replace("${" + key + "}", value)
+
+    if options.get("type") == "condition":
+        return "0" if expression in ("", "0") else "1"
+
+    return expression
+
+
 def string_remove_color(message, _):
     return message
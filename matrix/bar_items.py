@@ -16,11 +16,76 @@
 
 from __future__ import unicode_literals
 
+from typing import Any, Dict, List, Optional
+
 from . import globals as G
 from .globals import SERVERS, W
 from .utf import utf8_decode
 
 
+class RedrawScheduler(object):
+    """Coalesces bar item updates.
+
+    Updating a bar item makes weechat run its callback right away. Instead of
+    that, items are marked as dirty and every dirty item is updated once,
+    from a timer that fires on the next iteration of the weechat main loop.
+    """
+
+    _missing = object()
+
+    def __init__(self):
+        self.dirty = []  # type: List[str]
+        self.values = {}  # type: Dict[Any, Any]
+        self.hook = None  # type: Optional[str]
+
+    def update(self, *items):
+        # type: (str) -> None
+        """Mark the given bar items as dirty."""
+        for item in items:
+            if item not in self.dirty:
+                self.dirty.append(item)
+
+        if self.dirty and not self.hook:
+            self.hook = W.hook_timer(1, 0, 1, "matrix_bar_item_redraw_cb", "")
+
+    def update_if_changed(self, key, value, *items):
+        # type: (Any, Any, str) -> None
+        """Mark the given bar items as dirty if the value they show for the
+        given key changed since the last call."""
+        if self.values.get(key, self._missing) == value:
+            return
+
+        self.values[key] = value
+        self.update(*items)
+
+    def forget(self, *prefix):
+        # type: (Any) -> None
+        """Forget the values of all the keys starting with the given
+        elements, e.g. the ones of a room that was left."""
+        length = len(prefix)
+
+        for key in [key for key in self.values if key[:length] == prefix]:
+            del self.values[key]
+
+    def flush(self):
+        # type: () -> None
+        """Update all the dirty bar items."""
+        self.hook = None
+        dirty, self.dirty = self.dirty, []
+
+        for item in dirty:
+            W.bar_item_update(item)
+
+
+REDRAW = RedrawScheduler()
+
+
+@utf8_decode
+def matrix_bar_item_redraw_cb(data, remaining_calls):
+    REDRAW.flush()
+    return W.WEECHAT_RC_OK
+
+
 @utf8_decode
 def matrix_bar_item_plugin(data, item, window, buffer, extra_info):
     # pylint: disable=unused-argument
@@ -17,13 +17,26 @@
 
 from __future__ import unicode_literals
 
+import heapq
+import re
 import time
 import attr
 import pprint
 from builtins import super
 from functools import partial
 from collections import deque
-from typing import Dict, List, NamedTuple, Optional, Set
+from typing import (
+    Any,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Pattern,
+    Set,
+    Tuple,
+)
 from uuid import UUID
 
 from nio import (
@@ -33,6 +46,7 @@ from nio import (
     RedactionEvent,
     RoomAliasEvent,
     RoomEncryptionEvent,
+    RoomInfo,
     RoomMemberEvent,
     RoomMessage,
     RoomMessageEmote,
@@ -43,6 +57,7 @@ from nio import (
     RoomMessageUnknown,
     RoomNameEvent,
     RoomTopicEvent,
+    MatrixRoom,
     MegolmEvent,
     Event,
     OlmTrustError,
@@ -53,12 +68,15 @@ from nio import (
 )
 
 from . import globals as G
+from .bar_items import REDRAW
 from .colors import Formatted
 from .config import RedactType, NewChannelPosition
 from .globals import SCRIPT_NAME, SERVERS, W, TYPING_NOTICE_TIMEOUT
 from .utf import utf8_decode
 from .message_renderer import Render
+from .users import UserRegistry
 from .utils import (
+    OrderedSet,
     server_ts_to_weechat,
     shorten_sender,
     string_strikethrough,
@@ -66,7 +84,7 @@ from .utils import (
 )
 
 
-@attr.s
+@attr.s(slots=True)
 class OwnMessages(object):
     sender = attr.ib(type=str)
     age = attr.ib(type=int)
@@ -77,11 +95,11 @@ class OwnMessages(object):
 
 
 class OwnMessage(OwnMessages):
-    pass
+    __slots__ = ()
 
 
 class OwnAction(OwnMessage):
-    pass
+    __slots__ = ()
 
 
 @utf8_decode
@@ -139,11 +157,21 @@ def room_buffer_close_cb(server_name, buffer):
         room_id = room_buffer.room.room_id
         server.buffers.pop(room_id, None)
         server.room_buffers.pop(room_id, None)
+        REDRAW.forget("typing", server_name, room_id)
 
     return W.WEECHAT_RC_OK
 
 
 class WeechatUser(object):
+    __slots__ = (
+        "nick",
+        "host",
+        "prefix",
+        "color",
+        "join_time",
+        "speaking_time",
+    )
+
     def __init__(self, nick, host=None, prefix="", join_time=None):
         # type: (str, str, str, int) -> None
         self.nick = nick
@@ -175,6 +203,8 @@ class WeechatUser(object):
 
 
 class RoomUser(WeechatUser):
+    __slots__ = ()
+
     def __init__(self, nick, user_id=None, power_level=0, join_time=None):
         # type: (str, str, int, int) -> None
         prefix = self._get_prefix(power_level)
@@ -257,6 +287,8 @@ class WeechatChannelBuffer(object):
     }
 
     class Line(object):
+        __slots__ = ("_ptr",)
+
         def __init__(self, pointer):
             self._ptr = pointer
 
@@ -375,15 +407,14 @@ class WeechatChannelBuffer(object):
             self.number = cur_num + 1
         elif new_channel_position == NewChannelPosition.NEAR_SERVER:
             server = G.SERVERS[server_name]
-            last_similar_buffer_num = max(
-                (room.weechat_buffer.number for room
-                    in server.room_buffers.values()),
-                default=W.buffer_get_integer(server.server_buffer, "number")
-            )
-            self.number = last_similar_buffer_num + 1
+            self.number = server.last_room_buffer_number() + 1
 
         self.name = ""
         self.users = {}  # type: Dict[str, WeechatUser]
+        # Min-heap of (speaking time, nick) pairs, the least recently active
+        # user is always on top. Entries aren't removed when a user speaks
+        # again or leaves, outdated ones are skipped when popping.
+        self.user_activity = []  # type: List[Tuple[float, str]]
         self.smart_filtered_nicks = set()  # type: Set[str]
 
         self.topic_author = ""
@@ -539,6 +570,64 @@ class WeechatChannelBuffer(object):
 
         return tags
 
+    def _push_user_activity(self, user):
+        # type: (WeechatUser) -> None
+        heapq.heappush(
+            self.user_activity,
+            (user.speaking_time or 0, user.nick)
+        )
+
+        # Don't let outdated entries pile up in busy rooms.
+        if len(self.user_activity) > 2 * len(self.users) + 100:
+            self.user_activity = [
+                (u.speaking_time or 0, u.nick) for u in self.users.values()
+            ]
+            heapq.heapify(self.user_activity)
+
+    def _update_speaking_time(self, user, date):
+        # type: (WeechatUser, int) -> None
+        user.update_speaking_time(date)
+
+        if self.users.get(user.nick) is user:
+            self._push_user_activity(user)
+
+    def peek_stale_user(self, before):
+        # type: (float) -> Optional[Tuple[float, str]]
+        """Get the speaking time and nick of the least recently active user.
+
+        Only users that didn't speak since the given time are returned,
+        None is returned if there are no such users.
+        """
+        while self.user_activity:
+            speaking_time, nick = self.user_activity[0]
+            user = self.users.get(nick)
+
+            if not user or (user.speaking_time or 0) != speaking_time:
+                heapq.heappop(self.user_activity)
+                continue
+
+            if speaking_time >= before:
+                return None
+
+            return speaking_time, nick
+
+        return None
+
+    def pop_stale_user(self, before):
+        # type: (float) -> Optional[str]
+        """Pop the nick of the least recently active user.
+
+        Only users that didn't speak since the given time are returned,
+        None is returned if there are no such users.
+        """
+        stale_user = self.peek_stale_user(before)
+
+        if not stale_user:
+            return None
+
+        heapq.heappop(self.user_activity)
+        return stale_user[1]
+
     def _get_user(self, nick):
         # type: (str) -> WeechatUser
         if nick in self.users:
@@ -576,7 +665,7 @@ class WeechatChannelBuffer(object):
         tags = self._message_tags(user, tags_type) + (extra_tags or [])
         self._print_message(user, message, date, tags, extra_prefix)
 
-        user.update_speaking_time(date)
+        self._update_speaking_time(user, date)
         self.unmask_smart_filtered_nick(nick)
 
     def notice(self, nick, message, date, extra_tags=None, extra_prefix=""):
@@ -613,7 +702,7 @@ class WeechatChannelBuffer(object):
         tags = self._message_tags(user, "notice") + (extra_tags or [])
         self.print_date_tags(data, date, tags)
 
-        user.update_speaking_time(date)
+        self._update_speaking_time(user, date)
         self.unmask_smart_filtered_nick(nick)
 
     def _format_action(self, user, message):
@@ -654,7 +743,7 @@ class WeechatChannelBuffer(object):
         tags = self._message_tags(user, tags_type) + (extra_tags or [])
         self._print_action(user, message, date, tags, extra_prefix)
 
-        user.update_speaking_time(date)
+        self._update_speaking_time(user, date)
         self.unmask_smart_filtered_nick(nick)
 
     @staticmethod
@@ -677,24 +766,29 @@ class WeechatChannelBuffer(object):
 
         return G.CONFIG.color.nick_prefixes.get(prefix, "")
 
-    def _add_user_to_nicklist(self, user):
-        # type: (WeechatUser) -> None
+    def _add_user_to_nicklist(self, user, group=None):
+        # type: (WeechatUser, Optional[str]) -> None
         nick_pointer = W.nicklist_search_nick(self._ptr, "", user.nick)
 
         if not nick_pointer:
-            group = W.nicklist_search_group(
-                self._ptr, "", self._get_nicklist_group(user)
-            )
-            prefix = user.prefix if user.prefix else " "
-            W.nicklist_add_nick(
-                self._ptr,
-                group,
-                user.nick,
-                user.color,
-                prefix,
-                self._get_prefix_color(user.prefix),
-                1,
-            )
+            if not group:
+                group = W.nicklist_search_group(
+                    self._ptr, "", self._get_nicklist_group(user)
+                )
+            self._add_nick(user, group)
+
+    def _add_nick(self, user, group):
+        # type: (WeechatUser, str) -> None
+        prefix = user.prefix if user.prefix else " "
+        W.nicklist_add_nick(
+            self._ptr,
+            group,
+            user.nick,
+            user.color,
+            prefix,
+            self._get_prefix_color(user.prefix),
+            1,
+        )
 
     def _membership_message(self, user, message_type):
         # type: (WeechatUser, str) -> str
@@ -728,6 +822,7 @@ class WeechatChannelBuffer(object):
         # type: (WeechatUser, int, Optional[bool], Optional[List[str]]) -> None
         self._add_user_to_nicklist(user)
         self.users[user.nick] = user
+        self._push_user_activity(user)
 
         if len(self.users) > 2:
             W.buffer_set(self._ptr, "localvar_set_type", "channel")
@@ -742,6 +837,39 @@ class WeechatChannelBuffer(object):
             self.print_date_tags(msg, date, tags)
             self.add_smart_filtered_nick(user.nick)
 
+    def join_many(self, users):
+        # type: (List[WeechatUser]) -> None
+        """Add multiple users to the buffer without printing join messages.
+
+        WeeChat keeps the nicks of a nicklist group in a sorted linked list
+        and looks for the insertion point starting from the head of the list.
+        The users are grouped by their nicklist group and added in reverse
+        sorted order, so every nick is inserted at the head of its group. The
+        nicklist search is skipped for nicks that the buffer doesn't know
+        about yet since those can't be in the nicklist.
+        """
+        groups = {}  # type: Dict[str, List[WeechatUser]]
+
+        for user in users:
+            if user.nick in self.users:
+                self._add_user_to_nicklist(user)
+            else:
+                group_name = self._get_nicklist_group(user)
+                groups.setdefault(group_name, []).append(user)
+
+            self.users[user.nick] = user
+            self._push_user_activity(user)
+
+        for group_name, group_users in groups.items():
+            group = W.nicklist_search_group(self._ptr, "", group_name)
+            group_users.sort(key=lambda u: u.nick.lower(), reverse=True)
+
+            for user in group_users:
+                self._add_nick(user, group)
+
+        if len(self.users) > 2:
+            W.buffer_set(self._ptr, "localvar_set_type", "channel")
+
     def invite(self, nick, date, extra_tags=None):
         # type: (str, int, Optional[List[str]]) -> None
         user = self._get_user(nick)
@@ -756,6 +884,32 @@ class WeechatChannelBuffer(object):
         if nick_pointer:
             W.nicklist_remove_nick(self._ptr, nick_pointer)
 
+    def move_users_in_nicklist(self, users):
+        # type: (List[WeechatUser]) -> None
+        """Move users to the nicklist group that matches their prefix.
+
+        There is no way to change the group of a nick without removing it from
+        the nicklist. All the nicks are removed first and then re-added group
+        by group, so every group pointer is only searched for once.
+        """
+        if not users:
+            return
+
+        for user in users:
+            self.remove_user_from_nicklist(user)
+
+        groups = {}  # type: Dict[str, str]
+
+        for user in sorted(users, key=self._get_nicklist_group):
+            group_name = self._get_nicklist_group(user)
+
+            if group_name not in groups:
+                groups[group_name] = W.nicklist_search_group(
+                    self._ptr, "", group_name
+                )
+
+            self._add_user_to_nicklist(user, groups[group_name])
+
     def _leave(self, nick, date, message, leave_type, extra_tags=None):
         # type: (str, int, bool, str, List[str]) -> None
         user = self._get_user(nick)
@@ -804,7 +958,7 @@ class WeechatChannelBuffer(object):
         )
 
         self.print_date_tags(data, date, tags)
-        user.update_speaking_time(date)
+        self._update_speaking_time(user, date)
         self.unmask_smart_filtered_nick(nick)
 
     @property
@@ -863,6 +1017,12 @@ class WeechatChannelBuffer(object):
     def number(self, n):
         W.buffer_set(self._ptr, "number", str(n))
 
+    @property
+    def displayed(self):
+        # type: () -> bool
+        """Is the buffer displayed in any window."""
+        return W.buffer_get_integer(self._ptr, "num_displayed") > 0
+
     def find_lines(self, predicate, max_lines=None):
         lines = []
         count = 0
@@ -876,9 +1036,110 @@ class WeechatChannelBuffer(object):
         return lines
 
 
+def highlight_pattern(own_user_id):
+    # type: (str) -> Pattern
+    """Get a pattern matching our nick or our user id as a whole word, the
+    same as the highlight words of our buffers do."""
+    return re.compile(
+        r"(?<!\w)(?:{}|{})(?!\w)".format(
+            re.escape(own_user_id),
+            re.escape(shorten_sender(own_user_id))
+        ),
+        re.IGNORECASE | re.UNICODE
+    )
+
+
+def count_unread(room, events):
+    # type: (MatrixRoom, Iterable[Event]) -> Tuple[int, int]
+    """Count the messages of other users in a list of timeline events and how
+    many of them mention our nick.
+
+    Returns a tuple of the message and highlight counts.
+    """
+    own_user_id = room.own_user_id
+    pattern = highlight_pattern(own_user_id)
+    unread = 0
+    highlights = 0
+
+    for event in events:
+        if not isinstance(event, RoomMessage) or event.sender == own_user_id:
+            continue
+
+        unread += 1
+        body = getattr(event, "body", None)
+
+        if body and pattern.search(body):
+            highlights += 1
+
+    return unread, highlights
+
+
+@attr.s(slots=True)
+class LazyRoom(object):
+    """A joined room that doesn't have a weechat buffer (yet).
+
+    Only the number of unread messages and highlights is counted for such
+    rooms, the buffer is created once the room needs attention or once it's
+    explicitly opened.
+    """
+
+    room = attr.ib()
+    unread_count = attr.ib(default=0, type=int)
+    highlight_count = attr.ib(default=0, type=int)
+
+    @property
+    def is_direct(self):
+        # type: () -> bool
+        return self.room.member_count <= 2
+
+    @property
+    def hotlist_priority(self):
+        # type: () -> Optional[str]
+        if self.highlight_count:
+            return "3"
+        if self.unread_count:
+            return "2" if self.is_direct else "1"
+        return None
+
+    def handle_joined_room(self, info):
+        # type: (RoomInfo) -> bool
+        """Count the unread messages and highlights in the timeline of the
+        room.
+
+        Returns True if the room needs a buffer.
+        """
+        events = info.timeline.events
+
+        for event in info.account_data:
+            if not isinstance(event, FullyReadEvent):
+                continue
+
+            # Everything up to the read marker has been read, possibly on
+            # another client.
+            self.unread_count = 0
+            self.highlight_count = 0
+
+            for i, timeline_event in enumerate(events):
+                if timeline_event.event_id == event.event_id:
+                    events = events[i + 1:]
+                    break
+
+        unread, highlights = count_unread(self.room, events)
+        self.unread_count += unread
+        self.highlight_count += highlights
+
+        return bool(
+            self.highlight_count or (self.unread_count and self.is_direct)
+        )
+
+
 class RoomBuffer(object):
-    def __init__(self, room, server_name, homeserver, prev_batch):
+    def __init__(self, room, server_name, homeserver, prev_batch,
+                 user_registry=None):
         self.room = room
+        self.user_registry = (
+            UserRegistry() if user_registry is None else user_registry
+        )
         self.homeserver = homeserver
         self._backlog_pending = False
         self.prev_batch = prev_batch
@@ -887,13 +1148,24 @@ class RoomBuffer(object):
         self.members_fetched = False
         self.first_view = True
         self.first_backlog_request = True
-        self.unhandled_users = []   # type: List[str]
-        self.inactive_users = []
+        self.unhandled_users = OrderedSet()  # type: OrderedSet
+        self._unhandled_users_sorted = True
+        self.inactive_users = OrderedSet()   # type: OrderedSet
 
         self.sent_messages_queue = dict()  # type: Dict[UUID, OwnMessage]
         self.printed_before_ack_queue = list()  # type: List[UUID]
         self.undecrypted_events = deque(maxlen=5000)
 
+        # Timeline events that weren't rendered yet because the buffer isn't
+        # displayed, see the deferred_rendering option.
+        self.deferred_events = deque()  # type: Deque[Tuple[Event, Any]]
+
+        # The token from which the events that were skipped while catching up
+        # can be fetched, and the id of the last event that was printed
+        # before the skipped events, see the catch_up_events option.
+        self.gap_batch = None  # type: Optional[str]
+        self.gap_stop_event_id = None  # type: Optional[str]
+
         self.typing_notice_time = None
         self._typing = False
         self.typing_enabled = True
@@ -908,7 +1180,16 @@ class RoomBuffer(object):
 
         # This dict remembers the connection from a user_id to the name we
         # displayed in the buffer
-        self.displayed_nicks = {}
+        self.displayed_nicks = {}  # type: Dict[str, str]
+        # The reverse mapping of displayed_nicks, from a displayed nick to the
+        # user_id it belongs to.
+        self.displayed_users = {}  # type: Dict[str, str]
+
+        # The power levels that are reflected in the nicklist, a new power
+        # levels event is diffed against these so only the users whose level
+        # changed need to be touched.
+        self.power_levels = {}  # type: Dict[str, int]
+        self.users_default_level = 0
         user = shorten_sender(self.room.own_user_id)
 
         self.weechat_buffer = WeechatChannelBuffer(
@@ -933,9 +1214,11 @@ class RoomBuffer(object):
 
     @backlog_pending.setter
     def backlog_pending(self, value):
+        if value == self._backlog_pending:
+            return
+
         self._backlog_pending = value
-        W.bar_item_update("buffer_modes")
-        W.bar_item_update("matrix_modes")
+        REDRAW.update("buffer_modes", "matrix_modes")
 
     @property
     def warning_prefix(self):
@@ -1009,12 +1292,9 @@ class RoomBuffer(object):
     def read_markers_enabled(self):
         # type: () -> bool
         """Check if read receipts are enabled for this room."""
-        return bool(int(W.string_eval_expression(
-            G.CONFIG.network.read_markers_conditions,
-            {},
-            {"markers_enabled": str(int(self._read_markers_enabled))},
-            {"type": "condition"}
-        )))
+        return G.CONFIG.read_markers_conditions.evaluate(
+            self._read_markers_enabled
+        )
 
     @read_markers_enabled.setter
     def read_markers_enabled(self, value):
@@ -1029,16 +1309,84 @@ class RoomBuffer(object):
         return user_id
 
     def add_user(self, user_id, date, is_state, force_add=False):
+        buffer_user = self._create_user(user_id, date, is_state, force_add)
+
+        if buffer_user:
+            self.weechat_buffer.join(buffer_user, date, not is_state)
+
+    def add_users(self, user_ids):
+        # type: (List[str]) -> None
+        """Add users from the room state to the buffer in bulk."""
+        users = []
+
+        for user_id in user_ids:
+            buffer_user = self._create_user(user_id, 0, True)
+
+            if buffer_user:
+                users.append(buffer_user)
+
+        self.weechat_buffer.join_many(users)
+
+    def queue_users(self, user_ids):
+        # type: (Iterable[str]) -> None
+        """Queue users to be lazily added to the nicklist."""
+        self.unhandled_users.update(user_ids)
+        self._unhandled_users_sorted = False
+
+    def _nicklist_sort_key(self, user_id):
+        user = self.room.users.get(user_id)
+
+        if not user:
+            return ("", user_id)
+
+        # The prefix decides the nicklist group, the order of the groups
+        # themselves doesn't matter.
+        prefix = RoomUser._get_prefix(user.power_level)
+
+        info = self.user_registry.get(user_id, user.display_name)
+
+        return (prefix, (info.short_name or user_id[1:]).lower())
+
+    def add_unhandled_users(self, n):
+        # type: (int) -> int
+        """Add up to n queued users to the buffer.
+
+        The queue is sorted by nicklist group and nick the first time it is
+        used after new users were queued, in the reverse order WeeChat sorts
+        its nicklist. Every batch then only contains nicks that sort before
+        the ones already added, which keeps WeeChat's insertion cheap.
+
+        Returns the number of users that were taken off the queue.
+        """
+        if not self._unhandled_users_sorted:
+            self.unhandled_users = OrderedSet(sorted(
+                self.unhandled_users,
+                key=self._nicklist_sort_key,
+                reverse=True
+            ))
+            self._unhandled_users_sorted = True
+
+        batch = []
+
+        while self.unhandled_users and len(batch) < n:
+            batch.append(self.unhandled_users.pop())
+
+        self.add_users(batch)
+
+        return len(batch)
+
+    def _create_user(self, user_id, date, is_state, force_add=False):
+        # type: (str, int, bool, bool) -> Optional[RoomUser]
         # User is already added don't add him again.
         if user_id in self.displayed_nicks:
-            return
+            return None
 
         try:
             user = self.room.users[user_id]
         except KeyError:
             # No user found, he must have left already in an event that is
             # yet to come, so do nothing
-            return
+            return None
 
         # Adding users to the nicklist is a O(1) + search time
         # operation (the nicks are added to a linked list sorted).
@@ -1051,38 +1399,18 @@ class RoomBuffer(object):
         if is_state and not force_add and user.power_level <= 0:
             if (len(self.displayed_nicks) >=
                     G.CONFIG.network.max_nicklist_users):
-                self.inactive_users.append(user_id)
-                return
+                self.inactive_users.add(user_id)
+                return None
 
-        try:
-            self.inactive_users.remove(user_id)
-        except ValueError:
-            pass
+        self.inactive_users.discard(user_id)
 
-        short_name = shorten_sender(user.user_id)
-
-        # TODO handle this special case for discord bridge users and
-        # freenode bridge users better
-        if (user.user_id.startswith("@_discord_") or
-                user.user_id.startswith("@_slack_") or
-                user.user_id.startswith("@whatsapp_") or
-                user.user_id.startswith("@facebook_") or
-                user.user_id.startswith("@telegram_") or
-                user.user_id.startswith("@_telegram_") or
-                user.user_id.startswith("@_xmpp_")):
-            if user.display_name:
-                short_name = user.display_name[0:50]
-        elif user.user_id.startswith("@twilio_"):
-            short_name = shorten_sender(user.user_id[7:])
-        elif user.user_id.startswith("@freenode_"):
-            short_name = shorten_sender(user.user_id[9:])
-        elif user.user_id.startswith("@_ircnet_"):
-            short_name = shorten_sender(user.user_id[8:])
-        elif user.user_id.startswith("@gitter_"):
-            short_name = shorten_sender(user.user_id[7:])
+        info = self.user_registry.get(user_id, user.display_name)
+        # Use the registry's copy of the user id so it's shared between rooms.
+        user_id = info.user_id
+        short_name = info.short_name
 
         # TODO make this configurable
-        if not short_name or short_name in self.displayed_nicks.values():
+        if not short_name or short_name in self.displayed_users:
             # Use the full user id, but don't include the @
             nick = user_id[1:]
         else:
@@ -1090,12 +1418,54 @@ class RoomBuffer(object):
 
         buffer_user = RoomUser(nick, user_id, user.power_level, date)
         self.displayed_nicks[user_id] = nick
+        self.displayed_users[nick] = user_id
 
         if self.room.own_user_id == user_id:
             buffer_user.color = "weechat.color.chat_nick_self"
             user.nick_color = "weechat.color.chat_nick_self"
 
-        self.weechat_buffer.join(buffer_user, date, not is_state)
+        return buffer_user
+
+    def garbage_collect_users(self, before, deadline):
+        # type: (float, float) -> bool
+        """Remove inactive users from the nicklist.
+
+        Users that didn't speak since the given time are removed, least
+        recently active first, until no more than max_nicklist_users users
+        are left. Returns False if the deadline was reached before that.
+        """
+        while (len(self.displayed_nicks) >
+                G.CONFIG.network.max_nicklist_users):
+            if time.time() >= deadline:
+                return False
+
+            nick = self.weechat_buffer.pop_stale_user(before)
+
+            if nick is None:
+                break
+
+            self.evict_user(nick)
+
+        return True
+
+    def evict_user(self, nick):
+        # type: (str) -> None
+        """Remove a user from the nicklist, the user is added back lazily
+        once it becomes active again."""
+        user_id = self.displayed_users.get(nick)
+        self.weechat_buffer.part(nick, 0, False)
+
+        if user_id:
+            self.remove_displayed_nick(user_id)
+            self.inactive_users.add(user_id)
+
+    def remove_displayed_nick(self, user_id):
+        # type: (str) -> None
+        """Forget the nick that was displayed for the given user_id."""
+        nick = self.displayed_nicks.pop(user_id, None)
+
+        if self.displayed_users.get(nick) == user_id:
+            del self.displayed_users[nick]
 
     def handle_membership_events(self, event, is_state):
         date = server_ts_to_weechat(event.server_timestamp)
@@ -1104,7 +1474,7 @@ class RoomBuffer(object):
             if (event.state_key not in self.displayed_nicks
                     and event.state_key not in self.inactive_users):
                 if len(self.room.users) > 100:
-                    self.unhandled_users.append(event.state_key)
+                    self.queue_users([event.state_key])
                     return
 
                 self.add_user(event.state_key, date, is_state)
@@ -1114,17 +1484,18 @@ class RoomBuffer(object):
 
         elif event.content["membership"] == "leave":
             if event.state_key in self.unhandled_users:
-                self.unhandled_users.remove(event.state_key)
+                self.unhandled_users.discard(event.state_key)
                 return
 
+            self.inactive_users.discard(event.state_key)
+
             nick = self.find_nick(event.state_key)
             if event.sender == event.state_key:
                 self.weechat_buffer.part(nick, date, not is_state)
             else:
                 self.weechat_buffer.kick(nick, date, not is_state)
 
-            if event.state_key in self.displayed_nicks:
-                del self.displayed_nicks[event.state_key]
+            self.remove_displayed_nick(event.state_key)
 
             # We left the room, remember the event id of our leave, if we
             # rejoin we get events that came before this event as well as
@@ -1253,20 +1624,49 @@ class RoomBuffer(object):
 
         return tags
 
+    def _changed_power_levels(self):
+        # type: () -> Set[str]
+        """Get the user ids whose power level changed since the last call."""
+        power_levels = self.room.power_levels
+        users = dict(power_levels.users)
+        default_level = power_levels.defaults.users_default
+
+        # A changed default level potentially changes the level of everyone.
+        if default_level != self.users_default_level:
+            changed = set(self.displayed_nicks)
+        else:
+            old_users = self.power_levels
+            changed = {
+                user_id for user_id in set(old_users) | set(users)
+                if old_users.get(user_id) != users.get(user_id)
+            }
+
+        self.power_levels = users
+        self.users_default_level = default_level
+
+        return changed
+
     def _handle_power_level(self, _):
-        for user_id in self.room.power_levels.users:
-            if user_id in self.displayed_nicks:
-                nick = self.find_nick(user_id)
+        moved_users = []
 
-                user = self.weechat_buffer.users[nick]
-                user.power_level = self.room.power_levels.get_user_level(
-                    user_id
-                )
+        for user_id in self._changed_power_levels():
+            nick = self.displayed_nicks.get(user_id)
 
-                # There is no way to change the group of a user without
-                # removing him from the nicklist
-                self.weechat_buffer.remove_user_from_nicklist(user)
-                self.weechat_buffer._add_user_to_nicklist(user)
+            if nick is None:
+                continue
+
+            user = self.weechat_buffer.users.get(nick)
+
+            if not user:
+                continue
+
+            old_group = self.weechat_buffer._get_nicklist_group(user)
+            user.power_level = self.room.power_levels.get_user_level(user_id)
+
+            if self.weechat_buffer._get_nicklist_group(user) != old_group:
+                moved_users.append(user)
+
+        self.weechat_buffer.move_users_in_nicklist(moved_users)
 
     def handle_state_event(self, event):
         if isinstance(event, RoomMemberEvent):
@@ -1461,14 +1861,85 @@ class RoomBuffer(object):
         if (event.sender not in self.displayed_nicks and
             event.sender in self.room.users):
 
-            try:
-                self.unhandled_users.remove(event.sender)
-            except ValueError:
-                pass
-
+            self.unhandled_users.discard(event.sender)
             self.add_user(event.sender, 0, True, True)
 
     def handle_timeline_event(self, event, extra_tags=None):
+        # Once an event is deferred all the following ones need to be
+        # deferred as well, otherwise they would be printed out of order.
+        if self.deferred_events or (
+            G.CONFIG.look.deferred_rendering
+            and not self.weechat_buffer.displayed
+        ):
+            self._defer_timeline_event(event, extra_tags)
+        else:
+            self._handle_timeline_event(event, extra_tags)
+
+    def _defer_timeline_event(self, event, extra_tags):
+        self.deferred_events.append((event, extra_tags))
+
+        # Update the hotlist right away, the line is printed without
+        # notifying once the event is rendered.
+        self._add_to_hotlist([event])
+
+    def _add_to_hotlist(self, events):
+        # type: (Iterable[Event]) -> None
+        """Add the messages among the events to the hotlist without printing
+        them.
+
+        The priority is picked like weechat does it for printed lines:
+        highlights need a notify level of at least 1, other messages a level
+        of at least 2 and messages in private buffers get the private
+        priority. Every message is added on its own so the hotlist counts
+        match the number of messages.
+        """
+        ptr = self.weechat_buffer._ptr
+        notify = W.buffer_get_integer(ptr, "notify")
+        private = self.weechat_buffer.type == "private"
+
+        for event in events:
+            unread, highlights = count_unread(self.room, [event])
+
+            if highlights and notify >= 1:
+                priority = 3
+            elif unread and notify >= 2:
+                priority = 2 if private else 1
+            else:
+                continue
+
+            W.buffer_set(ptr, "hotlist", str(priority))
+
+    def render_deferred_events(self, deadline=None):
+        # type: (Optional[float]) -> bool
+        """Render the deferred timeline events in order.
+
+        Args:
+            deadline (float, optional): Stop rendering once this point in
+                time has passed.
+
+        Returns True if no events are left to render.
+        """
+        if not self.deferred_events:
+            return True
+
+        # The hotlist was already updated when the events were deferred.
+        notify_tags = (
+            [] if self.weechat_buffer.displayed else ["notify_none"]
+        )
+
+        while self.deferred_events:
+            event, extra_tags = self.deferred_events.popleft()
+            self._handle_timeline_event(
+                event,
+                (extra_tags or []) + notify_tags
+            )
+
+            if deadline and time.time() >= deadline:
+                break
+
+        return not self.deferred_events
+
+    def _handle_timeline_event(self, event, extra_tags=None):
         # TODO this should be done for every messagetype that gets printed in
         # the buffer
         if isinstance(event, (RoomMessage, MegolmEvent)):
@@ -1541,6 +2012,7 @@ class RoomBuffer(object):
 
     def self_message(self, message):
         # type: (OwnMessage) -> None
+        self.render_deferred_events()
         nick = self.find_nick(self.room.own_user_id)
         data = message.formatted_message.to_weechat()
         if message.event_id:
@@ -1553,6 +2025,7 @@ class RoomBuffer(object):
 
     def self_action(self, message):
         # type: (OwnMessage) -> None
+        self.render_deferred_events()
         nick = self.find_nick(self.room.own_user_id)
         date = message.age
         if message.event_id:
@@ -1625,6 +2098,8 @@ class RoomBuffer(object):
     def replace_undecrypted_line(self, event):
         """Find an undecrypted message in the buffer and replace it with the now
         decrypted event."""
+        self.render_deferred_events()
+
         # TODO different messages need different formatting
         # To implement this, refactor out the different formatting code
         # snippets to a Formatter class and reuse them here.
@@ -1680,6 +2155,15 @@ class RoomBuffer(object):
 
     def sort_messages(self):
         class LineCopy(object):
+            __slots__ = (
+                "date",
+                "date_printed",
+                "tags",
+                "prefix",
+                "message",
+                "highlight",
+            )
+
             def __init__(
                 self, date, date_printed, tags, prefix, message, highlight
             ):
@@ -1713,6 +2197,12 @@ class RoomBuffer(object):
             )
 
     def handle_backlog(self, response):
+        self.render_deferred_events()
+
+        if self.gap_batch:
+            self._handle_gap_backlog(response)
+            return
+
         self.prev_batch = response.end
 
         for event in response.chunk:
@@ -1734,7 +2224,128 @@ class RoomBuffer(object):
         self.first_backlog_request = False
         self.backlog_pending = False
 
-    def handle_joined_room(self, info):
+    def _handle_gap_backlog(self, response):
+        printed_event_ids = set(self.printed_event_ids)
+        gap_closed = not response.chunk or not response.end
+
+        for event in response.chunk:
+            if event.event_id == self.gap_stop_event_id:
+                gap_closed = True
+                break
+
+            # The events that were printed after the gap come back as well.
+            if event.event_id in printed_event_ids:
+                continue
+
+            self.old_message(event)
+
+        self.sort_messages()
+
+        if gap_closed:
+            self._close_gap(response.end)
+        else:
+            self.gap_batch = response.end
+
+        self.backlog_pending = False
+
+    def _close_gap(self, end):
+        # type: (Optional[str]) -> None
+        # If nothing was printed before the gap, the history continues where
+        # the gap ended.
+        if not self.gap_stop_event_id and end:
+            self.prev_batch = end
+
+        self.gap_batch = None
+        self.gap_stop_event_id = None
+
+        gap_tag = SCRIPT_NAME + "_gap"
+
+        for line in self.weechat_buffer.find_lines(
+            lambda line: gap_tag in line.tags
+        ):
+            line.message = "{color}Skipped events loaded{ncolor}".format(
+                color=W.color("chat_delimiters"),
+                ncolor=W.color("reset"),
+            )
+
+    @property
+    def muted(self):
+        # type: () -> bool
+        """Is the notify level of the buffer set to none while it isn't
+        displayed."""
+        ptr = self.weechat_buffer._ptr
+        return (W.buffer_get_integer(ptr, "notify") == 0
+                and not self.weechat_buffer.displayed)
+
+    def _open_gap(self, gap_batch):
+        # type: (str) -> None
+        if not self.gap_batch:
+            self.gap_stop_event_id = self.last_event_id or None
+
+        self.gap_batch = gap_batch
+
+    def _skip_events(self, events):
+        # type: (List[Event]) -> None
+        """Apply the state changes and redactions of timeline events that
+        aren't printed."""
+        for event in events:
+            if isinstance(event, RedactionEvent):
+                self._redact_line(event)
+            else:
+                self.handle_state_event(event)
+
+    def _catch_up(self, events, gap_batch):
+        # type: (List[Event], str) -> List[Event]
+        """Skip all but the last catch_up_events timeline events.
+
+        The skipped events only update the room state and the hotlist, a
+        marker is printed in their place and they can be fetched with the
+        history pager later on.
+
+        Returns the events that should be printed.
+        """
+        limit = G.CONFIG.network.catch_up_events
+        skipped, events = events[:-limit], events[-limit:]
+
+        # The marker needs to be printed after everything that came before it.
+        self.render_deferred_events()
+
+        self._skip_events(skipped)
+        self._open_gap(gap_batch)
+
+        self._add_to_hotlist(skipped)
+        unread, highlights = count_unread(self.room, skipped)
+
+        message = (
+            "{color}{count} events were skipped ({unread} messages, "
+            "{highlights} highlights), page up to load them{ncolor}"
+        ).format(
+            color=W.color("chat_delimiters"),
+            ncolor=W.color("reset"),
+            count=len(skipped),
+            unread=unread,
+            highlights=highlights,
+        )
+        self.weechat_buffer.print_date_tags(
+            message,
+            server_ts_to_weechat(skipped[0].server_timestamp),
+            [SCRIPT_NAME + "_gap", "no_log", "notify_none"]
+        )
+
+        return events
+
+    def handle_joined_room(self, info, gap_batch=None, skip_timeline=False):
+        """Handle the timeline and state of a joined room from a sync.
+
+        Args:
+            info (RoomInfo): The room info from the sync response.
+            gap_batch (str, optional): The token from which the history of
+                the room can be fetched if events need to be skipped because
+                we're catching up, the catch up mode isn't used if None.
+            skip_timeline (bool): Print none of the timeline events, only
+                apply their state changes, used for muted rooms. Has no effect
+                if gap_batch is None.
+        """
         for event in info.state:
             self.handle_state_event(event)
 
@@ -1763,12 +2374,27 @@ class RoomBuffer(object):
         else:
             timeline_events = info.timeline.events
 
+        if gap_batch and skip_timeline:
+            if timeline_events:
+                self._skip_events(timeline_events)
+                self._open_gap(gap_batch)
+                timeline_events = []
+
+        elif (gap_batch and G.CONFIG.network.catch_up_events
+                and len(timeline_events) > G.CONFIG.network.catch_up_events):
+            timeline_events = self._catch_up(timeline_events, gap_batch)
+
         for event in timeline_events:
             self.handle_timeline_event(event)
 
         for event in info.account_data:
             if isinstance(event, FullyReadEvent):
-                if event.event_id == self.last_event_id:
+                last_event_id = (
+                    self.deferred_events[-1][0].event_id
+                    if self.deferred_events else self.last_event_id
+                )
+
+                if event.event_id == last_event_id:
                     current_buffer = W.buffer_search("", "")
 
                     if self.weechat_buffer._ptr == current_buffer:
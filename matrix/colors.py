@@ -47,13 +47,122 @@ try:
 except ImportError:
     from html.parser import HTMLParser
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+# The on/off attributes of a FormattedString, packed into a bitmask by
+# TextAttributes in this order.
+FLAG_ATTRIBUTES = (
+    "bold",
+    "italic",
+    "underline",
+    "strikethrough",
+    "preformatted",
+    "quote",
+)
+VALUE_ATTRIBUTES = ("code", "fgcolor", "bgcolor")
+ATTRIBUTE_NAMES = FLAG_ATTRIBUTES + VALUE_ATTRIBUTES
+FLAG_BITS = {name: 1 << i for i, name in enumerate(FLAG_ATTRIBUTES)}
+
+
+class TextAttributes(Mapping):
+    """Immutable set of formatting attributes of a FormattedString.
+
+    The on/off attributes are packed into a bitmask and instances are
+    interned, all the strings that share the same formatting share a single
+    object. Behaves like a read-only dict with the keys of DEFAULT_ATTRIBUTES.
+    """
+
+    __slots__ = ("flags", "code", "fgcolor", "bgcolor")
+
+    _interned = {}  # type: Dict[tuple, TextAttributes]
+
+    def __new__(cls, flags=0, code=None, fgcolor=None, bgcolor=None):
+        key = (flags, code, fgcolor, bgcolor)
+
+        try:
+            return cls._interned[key]
+        except KeyError:
+            pass
+
+        self = super(TextAttributes, cls).__new__(cls)
+        object.__setattr__(self, "flags", flags)
+        object.__setattr__(self, "code", code)
+        object.__setattr__(self, "fgcolor", fgcolor)
+        object.__setattr__(self, "bgcolor", bgcolor)
+        cls._interned[key] = self
+
+        return self
+
+    @classmethod
+    def from_dict(cls, attributes):
+        # type: (Mapping) -> TextAttributes
+        if isinstance(attributes, TextAttributes):
+            return attributes
+
+        flags = 0
+
+        for name, bit in FLAG_BITS.items():
+            if attributes.get(name):
+                flags |= bit
+
+        return cls(
+            flags,
+            attributes.get("code"),
+            attributes.get("fgcolor"),
+            attributes.get("bgcolor"),
+        )
+
+    def __setattr__(self, name, value):
+        raise AttributeError("TextAttributes objects are immutable")
+
+    def __getitem__(self, key):
+        if key in FLAG_BITS:
+            return bool(self.flags & FLAG_BITS[key])
 
-class FormattedString:
+        if key in VALUE_ATTRIBUTES:
+            return getattr(self, key)
+
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(ATTRIBUTE_NAMES)
+
+    def __len__(self):
+        return len(ATTRIBUTE_NAMES)
+
+    def __eq__(self, other):
+        if isinstance(other, TextAttributes):
+            return self is other
+        return super(TextAttributes, self).__eq__(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.flags, self.code, self.fgcolor, self.bgcolor))
+
+    def __reduce__(self):
+        return (TextAttributes,
+                (self.flags, self.code, self.fgcolor, self.bgcolor))
+
+    def __repr__(self):
+        return "TextAttributes({})".format(dict(self.items()))
+
+    def copy(self):
+        # type: () -> Dict[str, Union[bool, Optional[str]]]
+        """Return a mutable dict copy of the attributes."""
+        return dict(self.items())
+
+
+class FormattedString(object):
     __slots__ = ("text", "attributes")
 
     def __init__(self, text, attributes):
-        self.attributes = DEFAULT_ATTRIBUTES.copy()
-        self.attributes.update(attributes)
+        self.attributes = TextAttributes.from_dict(attributes)
         self.text = text
 
 
@@ -72,7 +181,7 @@ class Formatted(object):
     def is_formatted(self):
         # type: (Formatted) -> bool
         for string in self.substrings:
-            if string.attributes != DEFAULT_ATTRIBUTES:
+            if string.attributes is not TextAttributes():
                 return True
         return False
 
@@ -533,20 +642,18 @@ class Formatted(object):
             # We need to handle strikethrough first, since doing
             # a strikethrough followed by other attributes succeeds in the
             # terminal, but doing it the other way around results in garbage.
-            if "strikethrough" in attributes:
-                text = add_attribute(
-                    text,
-                    "strikethrough",
-                    attributes["strikethrough"],
-                    attributes
-                )
-                attributes.pop("strikethrough")
+            text = add_attribute(
+                text,
+                "strikethrough",
+                attributes["strikethrough"],
+                attributes
+            )
 
             def indent(text, prefix):
                 return prefix + text.replace("\n", "\n{}".format(prefix))
 
             for key, value in attributes.items():
-                if not value:
+                if not value or key == "strikethrough":
                     continue
 
                 # Don't use textwrap to quote the code
@@ -19,6 +19,7 @@ from __future__ import unicode_literals
 import argparse
 import os
 import re
+import time
 from builtins import str
 from future.moves.itertools import zip_longest
 from collections import defaultdict
@@ -26,12 +27,18 @@ from functools import partial
 from nio import EncryptionError, LocalProtocolError
 
 from . import globals as G
+from .bar_items import REDRAW
 from .colors import Formatted
-from .globals import SERVERS, W, UPLOADS, SCRIPT_NAME
+from .config import debug_buffer
+from .globals import SERVERS, W, SCRIPT_NAME
+from .scheduler import SCHEDULER
 from .server import MatrixServer
 from .utf import utf8_decode
 from .utils import key_from_value, parse_redact_args
-from .uploads import UploadsBuffer, Upload
+from .stats import (CALLBACK_STATS, format_profile, memory_census,
+                    top_allocations, tracemalloc, write_profile)
+from .uploads import (UPLOAD_QUEUE, UploadsBuffer, Upload,
+                      stop_upload_workers)
 
 try:
     from urllib.parse import urlparse
@@ -206,6 +213,9 @@ class WeechatCommandParser(object):
         subparsers.add_parser("listfull")
         subparsers.add_parser("up")
         subparsers.add_parser("down")
+        subparsers.add_parser("cancel")
+        subparsers.add_parser("remove")
+        subparsers.add_parser("purge")
 
         return WeechatCommandParser._run_parser(parser, args)
 
@@ -240,6 +250,9 @@ def hook_commands():
             "connect <server-name> ||"
             "disconnect <server-name> ||"
             "reconnect <server-name> ||"
+            "room list|open <room> ||"
+            "debug stats [reset]|profile start [<seconds>]|profile stop|"
+            "memory [<count>]|memory stop ||"
             "help <matrix-command>"
         ),
         # Description
@@ -248,6 +261,8 @@ def hook_commands():
             "   connect: connect to Matrix servers\n"
             "disconnect: disconnect from one or all Matrix servers\n"
             " reconnect: reconnect to server(s)\n"
+            "      room: list or open rooms that don't have a buffer\n"
+            "     debug: show debugging information about the plugin\n"
             "      help: show detailed command help\n\n"
             "Use /matrix help [command] to find out more.\n"
         ),
@@ -257,6 +272,8 @@ def hook_commands():
             "connect %(matrix_servers) ||"
             "disconnect %(matrix_servers) ||"
             "reconnect %(matrix_servers) ||"
+            "room list|open %(matrix_lazy_rooms) ||"
+            "debug %(matrix_debug_types) ||"
             "help %(matrix_commands)"
         ),
         # Function name
@@ -488,23 +505,35 @@ def hook_commands():
         "",
     )
 
-    # W.hook_command(
-    #     # Command name and short description
-    #     "uploads",
-    #     "Open the uploads buffer or list uploads in the core buffer",
-    #     # Synopsis
-    #     ("list||"
-    #      "listfull"
-    #      ),
-    #     # Description
-    #     (""),
-    #     # Completions
-    #     ("list ||"
-    #      "listfull"),
-    #     # Callback
-    #     "matrix_uploads_command_cb",
-    #     "",
-    # )
+    W.hook_command(
+        # Command name and short description
+        "uploads",
+        "Open the uploads buffer or manage the uploads in it",
+        # Synopsis
+        ("up||"
+         "down||"
+         "cancel||"
+         "remove||"
+         "purge"
+         ),
+        # Description
+        ("    up: move the selection up\n"
+         "  down: move the selection down\n"
+         "cancel: cancel the selected upload\n"
+         "remove: remove the selected upload if it's finished\n"
+         " purge: remove all the finished uploads\n"
+         "\n"
+         "Without an argument the uploads buffer is opened."),
+        # Completions
+        ("up ||"
+         "down ||"
+         "cancel ||"
+         "remove ||"
+         "purge"),
+        # Callback
+        "matrix_uploads_command_cb",
+        "",
+    )
 
     W.hook_command(
         # Command name and short description
@@ -911,8 +940,7 @@ def matrix_olm_command_cb(data, buffer, args):
                 prefix=W.prefix("error")))
             W.prnt(server.server_buffer, message)
 
-        W.bar_item_update("buffer_modes")
-        W.bar_item_update("matrix_modes")
+        REDRAW.update("buffer_modes", "matrix_modes")
 
         return W.WEECHAT_RC_OK
 
@@ -1085,7 +1113,10 @@ def matrix_command_pgup_cb(data, buffer, command):
 
             room_buffer = server.find_room_from_ptr(buffer)
 
-            if first_line_displayed or room_buffer.weechat_buffer.num_lines == 0:
+            # Events skipped while catching up are fetched before the older
+            # history, no matter where the gap is.
+            if (first_line_displayed or room_buffer.gap_batch
+                    or room_buffer.weechat_buffer.num_lines == 0):
                 room_id = key_from_value(server.buffers, buffer)
                 server.room_get_messages(room_id)
 
@@ -1226,6 +1257,15 @@ def matrix_uploads_command_cb(data, buffer, args):
     elif parsed_args.subcommand == "down":
         if G.CONFIG.upload_buffer:
             G.CONFIG.upload_buffer.move_line_down()
+    elif parsed_args.subcommand == "cancel":
+        if G.CONFIG.upload_buffer:
+            G.CONFIG.upload_buffer.cancel_selected()
+    elif parsed_args.subcommand == "remove":
+        if G.CONFIG.upload_buffer:
+            G.CONFIG.upload_buffer.remove_selected()
+    elif parsed_args.subcommand == "purge":
+        if G.CONFIG.upload_buffer:
+            G.CONFIG.upload_buffer.purge()
 
     return W.WEECHAT_RC_OK
 
@@ -1255,10 +1295,7 @@ def matrix_upload_command_cb(data, buffer, args):
             parsed_args.file,
             room_buffer.room.encrypted
         )
-        UPLOADS[upload.uuid] = upload
-
-        if G.CONFIG.upload_buffer:
-            G.CONFIG.upload_buffer.render()
+        UPLOAD_QUEUE.add(upload)
 
         break
 
@@ -1499,6 +1536,57 @@ def matrix_command_help(args):
                 ncolor=W.color("reset"),
             )
 
+        elif command == "room":
+            message = (
+                "{delimiter_color}[{ncolor}matrix{delimiter_color}]  "
+                "{ncolor}{cmd_color}/room{ncolor} "
+                "list|open <room>"
+                "\n\n"
+                "list or open joined rooms that don't have a buffer "
+                "(see the option matrix.look.lazy_room_buffers)"
+                "\n\n"
+                "list: list the rooms with their unread message and "
+                "highlight counts\n"
+                "open: create the buffer of a room and switch to it\n"
+                "room: room id, alias or name of the room"
+            ).format(
+                delimiter_color=W.color("chat_delimiters"),
+                cmd_color=W.color("chat_buffer"),
+                ncolor=W.color("reset"),
+            )
+
+        elif command == "debug":
+            message = (
+                "{delimiter_color}[{ncolor}matrix{delimiter_color}]  "
+                "{ncolor}{cmd_color}/debug{ncolor} "
+                "stats [reset]"
+                "\n                 "
+                "profile start [<seconds>]|stop"
+                "\n                 "
+                "memory [<count>]|stop"
+                "\n\n"
+                "show debugging information about the plugin"
+                "\n\n"
+                "  stats: show the number of calls and the latency "
+                "percentiles of the callbacks of the plugin, reset clears "
+                "them (see the options matrix.network.callback_stats and "
+                "matrix.network.slow_callback_threshold)\n"
+                "profile: profile the callbacks of the plugin until stopped "
+                "or for the given number of seconds, the results are written "
+                "to a pstats file in the matrix directory\n"
+                " memory: count the rooms, users, undecrypted events and "
+                "uploads of every server and show the <count> source lines "
+                "that allocated the most memory (tracing the allocations "
+                "starts with the first call), stop stops the tracing"
+                "\n\n"
+                "The output goes to the debug buffer if the option "
+                "matrix.network.debug_buffer is on."
+            ).format(
+                delimiter_color=W.color("chat_delimiters"),
+                cmd_color=W.color("chat_buffer"),
+                ncolor=W.color("reset"),
+            )
+
         elif command == "help":
             message = (
                 "{delimiter_color}[{ncolor}matrix{delimiter_color}]  "
@@ -1647,9 +1735,10 @@ def matrix_server_command_delete(args):
             for option in server.config._option_ptrs.values():
                 W.config_option_free(option)
 
-            if server.timer_hook:
-                W.unhook(server.timer_hook)
-                server.timer_hook = None
+            SCHEDULER.cancel(server.name)
+            stop_upload_workers(server.name)
+            REDRAW.forget("typing", server.name)
+            REDRAW.forget("lag", server.name)
 
             message = (
                 "matrix: server {color}{server}{ncolor} has been " "deleted"
@@ -1843,6 +1932,58 @@ def matrix_server_command(command, args):
         W.prnt("", message)
 
 
+def matrix_room_command(command, args, buffer):
+    # Prefer the server of the current buffer, the room might be joined on
+    # multiple servers.
+    servers = sorted(
+        SERVERS.values(),
+        key=lambda server: not (buffer == server.server_buffer
+                                or buffer in server.buffers.values())
+    )
+
+    def list_rooms():
+        W.prnt("", "\nRooms without a buffer:")
+
+        for server in servers:
+            for lazy_room in server.lazy_rooms.values():
+                W.prnt(
+                    "",
+                    "    {color}{server}{ncolor}: {room} ({unread} unread, "
+                    "{highlights} highlights)".format(
+                        color=W.color("chat_server"),
+                        ncolor=W.color("reset"),
+                        server=server.name,
+                        room=(lazy_room.room.display_name
+                              or lazy_room.room.room_id),
+                        unread=lazy_room.unread_count,
+                        highlights=lazy_room.highlight_count,
+                    ),
+                )
+
+    def open_room(name):
+        for server in servers:
+            lazy_room = server.find_lazy_room(name)
+
+            if lazy_room:
+                room_buffer = server.open_room(lazy_room.room.room_id)
+                W.buffer_set(room_buffer.weechat_buffer._ptr, "display", "1")
+                return
+
+        message = "{prefix}matrix: No such room without a buffer: {room}"
+        W.prnt("", message.format(prefix=W.prefix("error"), room=name))
+
+    if command == "list":
+        list_rooms()
+    elif command == "open" and args:
+        open_room(" ".join(args))
+    else:
+        message = (
+            "{prefix}matrix: Error: unknown or incomplete matrix room "
+            'command, "{command}" (type /matrix help room for help)'
+        ).format(prefix=W.prefix("error"), command=command)
+        W.prnt("", message)
+
+
 @utf8_decode
 def matrix_command_cb(data, buffer, args):
     def connect_server(args):
@@ -1856,8 +1997,6 @@ def matrix_command_cb(data, buffer, args):
             if check_server_existence(server_name, SERVERS):
                 server = SERVERS[server_name]
                 if server.connected or server.reconnect_time:
-                    # W.unhook(server.timer_hook)
-                    # server.timer_hook = None
                     server.access_token = ""
                     server.disconnect(reconnect=False)
 
@@ -1891,6 +2030,20 @@ def matrix_command_cb(data, buffer, args):
         else:
             matrix_server_command("list", "")
 
+    elif command == "room":
+        if len(args) >= 1:
+            subcommand, args = args[0], args[1:]
+            matrix_room_command(subcommand, args, buffer)
+        else:
+            matrix_room_command("list", [], buffer)
+
+    elif command == "debug":
+        if len(args) >= 1:
+            subcommand, args = args[0], args[1:]
+            matrix_debug_command(subcommand, args)
+        else:
+            matrix_debug_command("stats", [])
+
     elif command == "help":
         matrix_command_help(args)
 
@@ -1904,6 +2057,132 @@ def matrix_command_cb(data, buffer, args):
     return W.WEECHAT_RC_OK
 
 
+def matrix_debug_command(command, args):
+    buf = debug_buffer()
+
+    def error(message):
+        W.prnt(buf, "{prefix}matrix: {message}".format(
+            prefix=W.prefix("error"), message=message))
+
+    def show_stats():
+        if not CALLBACK_STATS.enabled:
+            error("Callback statistics are disabled, see the option "
+                  "matrix.network.callback_stats")
+
+        if not CALLBACK_STATS.histograms:
+            return
+
+        W.prnt(buf, "\nCallback statistics:")
+
+        for line in CALLBACK_STATS.format():
+            W.prnt(buf, "    " + line)
+
+    def start_profile(seconds):
+        if CALLBACK_STATS.profiler:
+            error("The callbacks are already being profiled")
+            return
+
+        CALLBACK_STATS.start_profile()
+
+        if seconds:
+            SCHEDULER.schedule(
+                "debug",
+                "profile",
+                time.time() + seconds,
+                stop_profile
+            )
+
+        W.prnt(buf, "matrix: Profiling the callbacks{}".format(
+            " for {} seconds".format(seconds) if seconds else ""))
+
+    def stop_profile():
+        SCHEDULER.cancel("debug", "profile")
+        profiler = CALLBACK_STATS.stop_profile()
+
+        if not profiler:
+            error("The callbacks aren't being profiled")
+            return
+
+        directory = os.path.join(W.info_get("weechat_dir", ""), "matrix")
+
+        try:
+            path, stats = write_profile(profiler, directory)
+        except TypeError:
+            error("No callback was called while profiling")
+            return
+        except (OSError, IOError) as e:
+            error("Error writing the profile: {}".format(e))
+            return
+
+        W.prnt(buf, "\nProfile written to {}:".format(path))
+
+        for line in format_profile(stats, 20):
+            W.prnt(buf, "    " + line)
+
+    def show_memory(count):
+        for server in SERVERS.values():
+            W.prnt(buf, "\nObjects of server {}:".format(server.name))
+
+            for name, number in memory_census(server).items():
+                W.prnt(buf, "    {:<24} {:>8}".format(name, number))
+
+        if not tracemalloc:
+            error("Tracing allocations needs the tracemalloc module")
+            return
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            W.prnt(buf, "\nmatrix: Tracing allocations, the top allocation "
+                        "sites are shown the next time")
+            return
+
+        W.prnt(buf, "\nTop allocation sites:")
+
+        for line in top_allocations(count):
+            W.prnt(buf, "    " + line)
+
+    def parse_number(args, default):
+        if not args:
+            return default
+
+        try:
+            number = int(args[0])
+        except ValueError:
+            number = 0
+
+        if number <= 0:
+            error("Invalid number: {}".format(args[0]))
+            return None
+
+        return number
+
+    if command == "stats" and not args:
+        show_stats()
+    elif command == "stats" and args == ["reset"]:
+        CALLBACK_STATS.reset()
+    elif command == "profile" and args[:1] == ["start"]:
+        seconds = parse_number(args[1:], 0)
+
+        if seconds is not None:
+            start_profile(seconds)
+    elif command == "profile" and args == ["stop"]:
+        stop_profile()
+    elif command == "memory" and args == ["stop"]:
+        if tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+    elif command == "memory":
+        count = parse_number(args, 10)
+
+        if count is not None:
+            show_memory(count)
+    else:
+        message = (
+            "{prefix}matrix: Error: unknown or incomplete matrix debug "
+            'command, "{command}" (type /matrix help debug for help)'
+        ).format(prefix=W.prefix("error"), command=command)
+        W.prnt(buf, message)
+
+
 @utf8_decode
 def matrix_send_anyways_cb(data, buffer, args):
     for server in SERVERS.values():
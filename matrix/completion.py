@@ -76,6 +76,7 @@ def matrix_command_completion_cb(data, completion_item, buffer, completion):
         "disconnect",
         "reconnect",
         "server",
+        "room",
         "help",
         "debug",
     ]:
@@ -87,7 +88,7 @@ def matrix_command_completion_cb(data, completion_item, buffer, completion):
 
 @utf8_decode
 def matrix_debug_completion_cb(data, completion_item, buffer, completion):
-    for debug_type in ["messaging", "network", "timing"]:
+    for debug_type in ["stats", "profile", "memory"]:
         W.hook_completion_list_add(
             completion, debug_type, 0, W.WEECHAT_LIST_POS_SORT
         )
@@ -297,6 +298,23 @@ def matrix_room_completion_cb(data, completion_item, buffer, completion):
     return W.WEECHAT_RC_OK
 
 
+@utf8_decode
+def matrix_lazy_room_completion_cb(data, completion_item, buffer, completion):
+    """Completion callback for rooms that don't have a buffer."""
+    for server in SERVERS.values():
+        for lazy_room in server.lazy_rooms.values():
+            room = lazy_room.room
+
+            W.hook_completion_list_add(
+                completion,
+                room.canonical_alias or room.room_id,
+                0,
+                W.WEECHAT_LIST_POS_SORT
+            )
+
+    return W.WEECHAT_RC_OK
+
+
 def init_completion():
     W.hook_completion(
         "matrix_server_commands",
@@ -367,3 +385,10 @@ def init_completion():
         "matrix_room_completion_cb",
         "",
     )
+
+    W.hook_completion(
+        "matrix_lazy_rooms",
+        "Matrix completion for rooms without a buffer",
+        "matrix_lazy_room_completion_cb",
+        "",
+    )
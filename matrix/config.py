@@ -24,9 +24,11 @@ To add configuration options refer to MatrixConfig.
 Server specific configuration options are handled in server.py
 """
 
+import re
 from builtins import super
 from collections import namedtuple
 from enum import IntEnum, Enum, unique
+from typing import Dict, Optional
 
 import logbook
 
@@ -35,6 +37,8 @@ from matrix.globals import SCRIPT_NAME, SERVERS, W
 from matrix.utf import utf8_decode
 
 from . import globals as G
+from .stats import CALLBACK_STATS
+from .users import DEFAULT_BRIDGE_NICKS, BridgeNickRules
 
 
 @unique
@@ -58,6 +62,13 @@ class NewChannelPosition(IntEnum):
     NEAR_SERVER = 2
 
 
+@unique
+class EncryptedUploadReuse(IntEnum):
+    NEVER = 0
+    ROOM = 1
+    SERVER = 2
+
+
 nio.logger_group.level = logbook.ERROR
 
 
@@ -132,9 +143,29 @@ class Option(
 
 @utf8_decode
 def matrix_config_reload_cb(data, config_file):
+    G.CONFIG.invalidate()
     return W.WEECHAT_RC_OK
 
 
+@utf8_decode
+def matrix_config_change_cb(data, option):
+    """Change callback for all the global options.
+
+    Drops the cached option values and runs the callback of the option, if
+    it has one. The callback data is the section and option name separated
+    by a dot."""
+    G.CONFIG.invalidate()
+
+    section_name, option_name = data.split(".", 1)
+    section = getattr(G.CONFIG, section_name)
+    callback = section._change_callbacks.get(option_name)
+
+    if callback:
+        return callback(data, option)
+
+    return 1
+
+
 def change_log_level(category, level):
     """Change the log level of the underlying nio lib
 
@@ -203,6 +234,121 @@ def config_pgup_cb(data, option):
     return 1
 
 
+class Condition(object):
+    """A condition option that is evaluated using the weechat evaluation
+    syntax.
+
+    Besides the expression the condition expands a single boolean variable.
+    If the expression doesn't reference anything else its result only depends
+    on the value of that variable, so both of the possible results are cached
+    and evaluating the condition becomes a dict lookup. Expressions that
+    reference other variables or use nested expressions are evaluated every
+    time."""
+
+    def __init__(self, expression, variable):
+        # type: (str, str) -> None
+        self.expression = expression
+        self.variable = variable
+        self.cacheable = set(
+            re.findall(r"\$\{([^}]*)\}", expression)
+        ) <= {variable}
+        self._results = {}  # type: Dict[bool, bool]
+
+    def evaluate(self, value):
+        # type: (bool) -> bool
+        value = bool(value)
+
+        try:
+            return self._results[value]
+        except KeyError:
+            pass
+
+        result = bool(int(W.string_eval_expression(
+            self.expression,
+            {},
+            {self.variable: str(int(value))},
+            {"type": "condition"}
+        )))
+
+        if self.cacheable:
+            self._results[value] = result
+
+        return result
+
+
+def update_conditions():
+    """Compile the typing notice and read marker condition options."""
+    G.CONFIG.typing_notice_conditions = Condition(
+        G.CONFIG.network.typing_notice_conditions,
+        "typing_enabled"
+    )
+    G.CONFIG.read_markers_conditions = Condition(
+        G.CONFIG.network.read_markers_conditions,
+        "markers_enabled"
+    )
+
+
+@utf8_decode
+def config_conditions_cb(data, option):
+    """Callback for the network.typing_notice_conditions and
+    network.read_markers_conditions options."""
+    update_conditions()
+    return 1
+
+
+def update_bridge_nicks():
+    """Compile the look.bridge_nicks option and pass the rules on to the
+    user registries of all the servers."""
+    G.CONFIG.bridge_nicks = BridgeNickRules.parse(G.CONFIG.look.bridge_nicks)
+
+    for server in SERVERS.values():
+        server.user_registry.set_bridge_nicks(G.CONFIG.bridge_nicks)
+
+
+@utf8_decode
+def config_bridge_nicks_cb(data, option):
+    """Callback for the look.bridge_nicks option."""
+    update_bridge_nicks()
+    return 1
+
+
+def debug_buffer():
+    """Get the buffer debugging output is printed to.
+
+    This is the core buffer unless the network.debug_buffer option is on, in
+    that case the "Matrix Debug" buffer is created if needed."""
+    if not G.CONFIG.network.debug_buffer:
+        return ""
+
+    if not G.CONFIG.debug_buffer:
+        G.CONFIG.debug_buffer = W.buffer_new(
+            "Matrix Debug", "", "", "debug_buffer_close_cb", ""
+        )
+
+    return G.CONFIG.debug_buffer
+
+
+def update_callback_stats():
+    """Enable or disable the callback statistics according to the
+    network.callback_stats and network.slow_callback_threshold options."""
+    CALLBACK_STATS.threshold = (
+        G.CONFIG.network.slow_callback_threshold / 1000.0
+    )
+
+    if G.CONFIG.network.callback_stats:
+        CALLBACK_STATS.enable()
+    else:
+        CALLBACK_STATS.disable()
+
+
+@utf8_decode
+def config_callback_stats_cb(data, option):
+    """Callback for the network.callback_stats and
+    network.slow_callback_threshold options."""
+    update_callback_stats()
+    return 1
+
+
 def level_to_logbook(value):
     if value == 0:
         return logbook.ERROR
@@ -333,8 +479,11 @@ class ConfigSection(object):
             self._ptr = W.config_new_section(
                 config_ptr, name, 0, 0, "", "", "", "", "", "", "", "", "", ""
             )
+            self._name = name
             self._config_ptr = config_ptr
             self._option_ptrs = {}
+            self._change_callbacks = {}
+            self._values = {}
 
             for option in options:
                 self._add_option(option)
@@ -354,8 +503,15 @@ class ConfigSection(object):
         W.config_section_free_options(self._ptr)
         W.config_section_free(self._ptr)
 
+    def invalidate(self):
+        """Drop the cached option values, they are read from weechat again the
+        next time they are accessed."""
+        self._values.clear()
+
     def _add_option(self, option):
-        cb = option.change_callback.__name__ if option.change_callback else ""
+        if option.change_callback:
+            self._change_callbacks[option.name] = option.change_callback
+
         option_ptr = W.config_new_option(
             self._config_ptr,
             self._ptr,
@@ -370,8 +526,8 @@ class ConfigSection(object):
             0,
             "",
             "",
-            cb,
-            "",
+            "matrix_config_change_cb",
+            "{}.{}".format(self._name, option.name),
             "",
             "",
         )
@@ -384,7 +540,10 @@ class ConfigSection(object):
         option values pythonic. The option will be available as a property with
         the name of the option.
         If a cast function was defined for the option the property will pass
-        the option value to the cast function and return its result."""
+        the option value to the cast function and return its result.
+        Option values are cached until the section is invalidated, evaluated
+        options are read every time since their value can change without the
+        option changing."""
 
         def bool_getter(self):
             return bool(W.config_boolean(self._option_ptrs[name]))
@@ -404,14 +563,24 @@ class ConfigSection(object):
                 return cast_func(W.config_integer(self._option_ptrs[name]))
             return W.config_integer(self._option_ptrs[name])
 
+        def cached(getter):
+            def cached_getter(self):
+                try:
+                    return self._values[name]
+                except KeyError:
+                    value = self._values[name] = getter(self)
+                    return value
+
+            return property(cached_getter)
+
         if option_type in ("string", "color"):
             if evaluate:
                 return property(str_evaluate_getter)
-            return property(str_getter)
+            return cached(str_getter)
         if option_type == "boolean":
-            return property(bool_getter)
+            return cached(bool_getter)
         if option_type == "integer":
-            return property(int_getter)
+            return cached(int_getter)
 
 
 class MatrixConfig(WeechatConfig):
@@ -441,6 +610,12 @@ class MatrixConfig(WeechatConfig):
         self.debug_category = "all"
         self.page_up_hook = None
         self.human_buffer_names = None
+        self.bridge_nicks = None
+        self.typing_notice_conditions = None  # type: Optional[Condition]
+        self.read_markers_conditions = None  # type: Optional[Condition]
+        # Incremented every time an option changes, caches of values derived
+        # from options can use it to find out if they are outdated.
+        self.generation = 0
 
         look_options = [
             Option(
@@ -607,6 +782,49 @@ class MatrixConfig(WeechatConfig):
                 ("If turned on, markdown usage in messages will be converted "
                  "to actual markup (**bold**, *italic*, _italic_, `code`)."),
             ),
+            Option(
+                "bridge_nicks",
+                "string",
+                "",
+                0,
+                0,
+                DEFAULT_BRIDGE_NICKS,
+                ("Comma separated list of rules for the nicks of bridged "
+                 "users. Format is \"prefix=rule\", where \"prefix\" is the "
+                 "start of the user id of the bridged users and \"rule\" is "
+                 "either \"displayname\" to use the display name of the "
+                 "users or the number of characters that are removed from "
+                 "the user name (the part between the @ and the :) to get "
+                 "the nick. Changes apply to users that are added to the "
+                 "nicklist afterwards."),
+                None,
+                config_bridge_nicks_cb,
+            ),
+            Option(
+                "lazy_room_buffers",
+                "boolean",
+                "",
+                0,
+                0,
+                "off",
+                ("If turned on, buffers are only created for rooms that "
+                 "need attention: rooms with a highlight, direct chats with "
+                 "new messages and rooms that are joined with /join. Other "
+                 "rooms can be listed with /matrix room list and opened "
+                 "with /matrix room open."),
+            ),
+            Option(
+                "deferred_rendering",
+                "boolean",
+                "",
+                0,
+                0,
+                "off",
+                ("If turned on, messages of rooms whose buffer isn't "
+                 "displayed are only printed once the buffer is displayed "
+                 "or while weechat is idle. The hotlist is still updated "
+                 "right away."),
+            ),
         ]
 
         network_options = [
@@ -670,6 +888,32 @@ class MatrixConfig(WeechatConfig):
                 "off",
                 ("Use a separate buffer for debug logs."),
             ),
+            Option(
+                "callback_stats",
+                "boolean",
+                "",
+                0,
+                0,
+                "off",
+                ("Measure how long the weechat callbacks of the plugin take, "
+                 "see /matrix debug stats"),
+                None,
+                config_callback_stats_cb,
+            ),
+            Option(
+                "slow_callback_threshold",
+                "integer",
+                "",
+                0,
+                60000,
+                "100",
+                ("Log the callbacks that take longer than this many "
+                 "milliseconds together with the active room and the "
+                 "response that was handled, if network.callback_stats is "
+                 "enabled (0 disables the logging)"),
+                None,
+                config_callback_stats_cb,
+            ),
             Option(
                 "lazy_load_room_users",
                 "boolean",
@@ -681,6 +925,113 @@ class MatrixConfig(WeechatConfig):
                  "proactively, they will be loaded when the user switches to "
                  "the room buffer. This only affects non-encrypted rooms."),
             ),
+            Option(
+                "catch_up_events",
+                "integer",
+                "",
+                0,
+                500,
+                "0",
+                ("Maximum number of new events that are printed per room "
+                 "after a sync, e.g. after a long disconnect. The skipped "
+                 "events are replaced by a marker and can be loaded with "
+                 "page up. 0 prints all events."),
+            ),
+            Option(
+                "skip_muted_rooms",
+                "boolean",
+                "",
+                0,
+                0,
+                "off",
+                ("If on, the messages of rooms whose buffer notify level is "
+                 "set to none aren't printed while the buffer isn't "
+                 "displayed, only the changes to the room state are "
+                 "applied. They are fetched when switching to the buffer "
+                 "instead."),
+            ),
+            Option(
+                "upload_cache_size",
+                "integer",
+                "",
+                0,
+                100000,
+                "1000",
+                ("Number of uploaded files whose content URI is remembered "
+                 "per server. Uploading a remembered file again only sends "
+                 "the message, the file isn't transferred again "
+                 "(0 disables the cache)"),
+            ),
+            Option(
+                "max_concurrent_uploads",
+                "integer",
+                "",
+                1,
+                64,
+                "4",
+                ("Maximum number of uploads that are running at the same "
+                 "time over all servers, further uploads are queued and the "
+                 "servers take turns starting them"),
+            ),
+            Option(
+                "max_finished_uploads",
+                "integer",
+                "",
+                0,
+                10000,
+                "50",
+                ("Number of finished, failed or cancelled uploads that are "
+                 "kept in the uploads buffer, older ones are removed"),
+            ),
+            Option(
+                "upload_thumbnail_size",
+                "integer",
+                "",
+                0,
+                4096,
+                "800",
+                ("Maximum width and height in pixels of the thumbnails that "
+                 "are created for uploaded images, only images bigger than "
+                 "this get a thumbnail (0 disables thumbnails, requires "
+                 "the Pillow python module)"),
+            ),
+            Option(
+                "upload_downscale_above",
+                "integer",
+                "",
+                0,
+                1048576,
+                "0",
+                ("Images bigger than this size in KiB are downscaled to "
+                 "upload_downscale_size and recompressed before they are "
+                 "uploaded (0 means images are never downscaled, requires "
+                 "the Pillow python module)"),
+            ),
+            Option(
+                "upload_downscale_size",
+                "integer",
+                "",
+                0,
+                16384,
+                "2048",
+                ("Maximum width and height in pixels of downscaled images "
+                 "(0 means images are only recompressed)"),
+            ),
+            Option(
+                "reuse_encrypted_uploads",
+                "integer",
+                "never|room|server",
+                min(EncryptedUploadReuse),
+                max(EncryptedUploadReuse),
+                "never",
+                ("Whether remembered uploads are reused in encrypted rooms "
+                 "(never = encrypted files are always uploaded again, "
+                 "room = reuse files uploaded to the same room, "
+                 "server = reuse files uploaded to any encrypted room of the "
+                 "server; note that room members can recognize a file that "
+                 "was sent to another room)"),
+                EncryptedUploadReuse,
+            ),
             Option(
                 "max_nicklist_users",
                 "integer",
@@ -755,6 +1106,8 @@ class MatrixConfig(WeechatConfig):
                  "variables the typing_enabled variable is also expanded; "
                  "the typing_enabled variable can be manipulated with the "
                  "/room command, see /help room"),
+                None,
+                config_conditions_cb,
             ),
             Option(
                 "read_markers_conditions",
@@ -768,6 +1121,8 @@ class MatrixConfig(WeechatConfig):
                  "variables the markers_enabled variable is also expanded; "
                  "the markers_enabled variable can be manipulated with the "
                  "/room command, see /help room"),
+                None,
+                config_conditions_cb,
             ),
             Option(
                 "resending_ignores_devices",
@@ -906,9 +1261,20 @@ class MatrixConfig(WeechatConfig):
             "",
         )
 
+    def invalidate(self):
+        """Drop the cached values of all the global options."""
+        self.generation += 1
+
+        for section in (self.network, self.look, self.color):
+            section.invalidate()
+
     def read(self):
         super().read()
+        self.invalidate()
         self.human_buffer_names = self.look.human_buffer_names
+        update_bridge_nicks()
+        update_conditions()
+        update_callback_stats()
 
     def free(self):
         section_ptr = W.config_search_section(self._ptr, "server")
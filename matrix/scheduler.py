@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2018, 2019 Damir Jelić <poljar@termina.org.uk>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER
+# RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF
+# CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Module implementing the timer shared by all the servers."""
+
+from __future__ import unicode_literals
+
+import heapq
+import math
+import time
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .globals import SCRIPT_NAME, W
+from .utf import utf8_decode
+
+# A pending task: its deadline, sequence number and callback.
+Task = Tuple[float, int, Callable[[], Any]]
+
+
+class Scheduler(object):
+    """Runs tasks at their deadline using a single weechat timer.
+
+    Tasks are identified by an owner (e.g. a server name) and a task name,
+    every task has at most one pending deadline. The deadlines are kept in a
+    heap and a one-shot weechat timer is armed for the earliest one, if no
+    task is pending no timer is armed at all.
+    """
+
+    def __init__(self):
+        # The heap contains (deadline, sequence number, key) tuples, entries
+        # of rescheduled or cancelled tasks are left in the heap and skipped
+        # once they are popped.
+        self._heap = []  # type: List[Tuple[float, int, Tuple[str, str]]]
+        self.tasks = dict()  # type: Dict[Tuple[str, str], Task]
+        self._sequence = 0
+        self._running = False
+        self.hook = None  # type: Optional[str]
+        self.hook_deadline = None  # type: Optional[float]
+
+    def schedule(self, owner, name, deadline, callback, keep_earlier=False):
+        # type: (str, str, float, Callable[[], Any], bool) -> None
+        """Run the callback at the given deadline.
+
+        Args:
+            owner (str): The owner of the task.
+            name (str): The name of the task, a pending task with the same
+                owner and name is replaced.
+            deadline (float): The time, as returned by time.time(), at which
+                the task should run.
+            callback (callable): The function that will be called.
+            keep_earlier (bool): Keep the deadline of the pending task if it
+                is earlier than the given one.
+        """
+        key = (owner, name)
+
+        if keep_earlier and key in self.tasks:
+            deadline = min(deadline, self.tasks[key][0])
+
+        self._sequence += 1
+        self.tasks[key] = (deadline, self._sequence, callback)
+        heapq.heappush(self._heap, (deadline, self._sequence, key))
+
+        if len(self._heap) > 2 * len(self.tasks) + 16:
+            self._compact()
+
+        self._arm()
+
+    def cancel(self, owner, name=None):
+        # type: (str, Optional[str]) -> None
+        """Cancel the named task of the owner or all of its tasks if no name
+        is given."""
+        if name is not None:
+            self.tasks.pop((owner, name), None)
+        else:
+            for key in [key for key in self.tasks if key[0] == owner]:
+                del self.tasks[key]
+
+        self._arm()
+
+    def deadline(self, owner, name):
+        # type: (str, str) -> Optional[float]
+        """Get the deadline of a pending task."""
+        task = self.tasks.get((owner, name))
+        return task[0] if task else None
+
+    def _compact(self):
+        self._heap = [
+            (deadline, sequence, key)
+            for key, (deadline, sequence, _) in self.tasks.items()
+        ]
+        heapq.heapify(self._heap)
+
+    def _next_deadline(self):
+        # type: () -> Optional[float]
+        while self._heap:
+            deadline, sequence, key = self._heap[0]
+            task = self.tasks.get(key)
+
+            if task and task[1] == sequence:
+                return deadline
+
+            heapq.heappop(self._heap)
+
+        return None
+
+    def _arm(self):
+        # type: () -> None
+        if self._running:
+            return
+
+        deadline = self._next_deadline()
+
+        if deadline == self.hook_deadline:
+            return
+
+        if self.hook:
+            W.unhook(self.hook)
+            self.hook = None
+
+        self.hook_deadline = deadline
+
+        if deadline is None:
+            return
+
+        delay = max(int(math.ceil((deadline - time.time()) * 1000)), 1)
+        self.hook = W.hook_timer(delay, 0, 1, "matrix_scheduler_cb", "")
+
+    def run(self, now=None):
+        # type: (Optional[float]) -> None
+        """Run all the tasks that are due and arm the timer for the next
+        deadline. Tasks scheduled by the callbacks run on the next call at
+        the earliest.
+
+        A task that raises is reported in the core buffer, the due tasks
+        after it still run."""
+        now = time.time() if now is None else now
+
+        # The timer is a one-shot timer, weechat removes it after it fires.
+        self.hook = None
+        self.hook_deadline = None
+
+        due = []
+
+        while self._heap and self._heap[0][0] <= now:
+            _, sequence, key = heapq.heappop(self._heap)
+            due.append((key, sequence))
+
+        self._running = True
+
+        try:
+            for key, sequence in due:
+                # The task might have been rescheduled or cancelled by one of
+                # the callbacks that ran before it.
+                task = self.tasks.get(key)
+
+                if task and task[1] == sequence:
+                    del self.tasks[key]
+
+                    try:
+                        task[2]()
+                    except Exception as e:
+                        self._report_error(key, e)
+        finally:
+            self._running = False
+            self._arm()
+
+    @staticmethod
+    def _report_error(key, error):
+        # type: (Tuple[str, str], Exception) -> None
+        owner, name = key
+        W.prnt("", "{prefix}{script}: task {name} of {owner} failed: "
+                   "{error}".format(
+                       prefix=W.prefix("error"),
+                       script=SCRIPT_NAME,
+                       name=name,
+                       owner=owner,
+                       error=repr(error)
+                   ))
+
+
+SCHEDULER = Scheduler()
+
+
+@utf8_decode
+def matrix_scheduler_cb(data, remaining_calls):
+    SCHEDULER.run()
+    return W.WEECHAT_RC_OK
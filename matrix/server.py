@@ -22,6 +22,7 @@ import socket
 import ssl
 import time
 import copy
+import heapq
 from collections import defaultdict, deque
 from atomicwrites import atomic_write
 from typing import (
@@ -32,6 +33,7 @@ from typing import (
     List,
     NamedTuple,
     DefaultDict,
+    Set,
     Type,
     Union,
 )
@@ -47,6 +49,7 @@ from nio import (
     LoginInfoResponse,
     Response,
     Rooms,
+    RoomInfo,
     RoomSendResponse,
     RoomSendError,
     SyncResponse,
@@ -66,6 +69,7 @@ from nio import (
     ErrorResponse,
     SyncError,
     LoginError,
+    JoinResponse,
     JoinedMembersResponse,
     JoinedMembersError,
     RoomKeyEvent,
@@ -80,12 +84,16 @@ from nio import (
 )
 
 from . import globals as G
-from .buffer import OwnAction, OwnMessage, RoomBuffer
+from .bar_items import REDRAW
+from .buffer import LazyRoom, OwnAction, OwnMessage, RoomBuffer
 from .config import ConfigSection, Option, ServerBufferType
 from .globals import SCRIPT_NAME, SERVERS, W, TYPING_NOTICE_TIMEOUT
 from .utf import utf8_decode
 from .utils import create_server_buffer, key_from_value, server_buffer_prnt
-from .uploads import Upload
+from .scheduler import SCHEDULER
+from .stats import CALLBACK_STATS
+from .uploads import Upload, stop_upload_workers
+from .users import UserRegistry
 
 from .colors import Formatted, FormattedString, DEFAULT_ATTRIBUTES
 
@@ -99,6 +107,44 @@ try:
 except NameError:
     FileNotFoundError = IOError
 
+# How often the lazy user loading timer fires in milliseconds and how much of
+# that time a single run may spend adding users to nicklists, in seconds.
+USER_LOADING_INTERVAL = 200
+USER_LOADING_BUDGET = 0.05
+
+# How long a single run of the nicklist garbage collection may take in
+# seconds, and the minimal time between two runs that are triggered by the
+# server wide nicklist limit.
+USER_GC_BUDGET = 0.02
+USER_GC_MIN_INTERVAL = 300
+
+# The interval of the periodic garbage collection and the pause between two
+# incremental garbage collection runs, in seconds.
+USER_GC_INTERVAL = 3600
+USER_GC_SLICE_INTERVAL = 1
+
+# How often the lag is checked while there is lag and while there isn't any,
+# in seconds.
+LAG_CHECK_INTERVAL = 1
+LAG_CHECK_IDLE_INTERVAL = 10
+
+# How long to wait between two syncs on a HTTP/1.1 connection, in seconds.
+# We can't use long polling there since the connection is blocked while the
+# sync request is in flight.
+HTTP_SYNC_INTERVAL = 1
+
+# How many to-device messages are sent at once.
+TO_DEVICE_BATCH = 5
+
+# The ephemeral and room account data event types we handle, other types are
+# filtered out of our syncs.
+SYNC_EPHEMERAL_TYPES = ["m.typing"]
+SYNC_ROOM_ACCOUNT_DATA_TYPES = ["m.fully_read"]
+
+# How long to wait after a sync before deferred events of hidden buffers are
+# rendered, and how long a single rendering run may take, in seconds.
+DEFERRED_RENDER_DELAY = 1
+DEFERRED_RENDER_BUDGET = 0.02
 
 EncryptionQueueItem = NamedTuple(
     "EncryptionQueueItem",
@@ -115,6 +161,7 @@ class ServerConfig(ConfigSection):
         self._server_name = server_name
         self._config_ptr = config_ptr
         self._option_ptrs = {}  # type: Dict[str, str]
+        self._values = {}  # type: Dict[str, Any]
 
         options = [
             Option(
@@ -210,6 +257,40 @@ class ServerConfig(ConfigSection):
                 "10",
                 ("Delay (in seconds) before trying to reconnect to server"),
             ),
+            Option(
+                "max_server_nicklist_users",
+                "integer",
+                "",
+                0,
+                1000000,
+                "0",
+                ("Limit the number of users shown in the nicklists of all the "
+                 "rooms of this server combined, the least recently active "
+                 "users of all rooms are removed once the limit is exceeded "
+                 "(0 means no limit)"),
+            ),
+            Option(
+                "upload_workers",
+                "integer",
+                "",
+                0,
+                16,
+                "0",
+                ("Number of concurrent uploads of a long-lived upload process "
+                 "that keeps its connections to the server open between "
+                 "uploads (0 means a new process is started for every "
+                 "upload)"),
+            ),
+            Option(
+                "max_concurrent_uploads",
+                "integer",
+                "",
+                1,
+                16,
+                "2",
+                ("Maximum number of uploads to this server that are running "
+                 "at the same time, further uploads are queued"),
+            ),
             Option(
                 "sso_helper_listening_port",
                 "integer",
@@ -266,6 +347,18 @@ class ServerConfig(ConfigSection):
         "sso_helper_listening_port",
         "integer"
     )
+    max_server_nicklist_users = ConfigSection.option_property(
+        "max_server_nicklist_users",
+        "integer"
+    )
+    upload_workers = ConfigSection.option_property(
+        "upload_workers",
+        "integer"
+    )
+    max_concurrent_uploads = ConfigSection.option_property(
+        "max_concurrent_uploads",
+        "integer"
+    )
 
     def free(self):
         W.config_section_free_options(self._ptr)
@@ -281,11 +374,18 @@ class MatrixServer(object):
         self.device_id = ""                  # type: str
 
         self.room_buffers = dict()  # type: Dict[str, RoomBuffer]
+        # Joined rooms that don't have a buffer, see the lazy_room_buffers
+        # option.
+        self.lazy_rooms = dict()  # type: Dict[str, LazyRoom]
+        # Rooms we joined using /join, they always get a buffer.
+        self.rooms_to_open = set()  # type: Set[str]
+        # The id of the room whose buffer was created last.
+        self.last_room_id = None  # type: Optional[str]
+        self.user_registry = UserRegistry(G.CONFIG.bridge_nicks)
         self.buffers = dict()                # type: Dict[str, str]
         self.server_buffer = None            # type: Optional[str]
         self.fd_hook = None                  # type: Optional[str]
         self.ssl_hook = None                 # type: Optional[str]
-        self.timer_hook = None               # type: Optional[str]
         self.numeric_address = ""            # type: Optional[str]
 
         self._connected = False     # type: bool
@@ -329,9 +429,14 @@ class MatrixServer(object):
         self.backlog_queue = dict()      # type: Dict[str, str]
 
         self.user_gc_time = time.time()    # type: float
+        self.user_gc_rooms = []            # type: List[RoomBuffer]
+        self.user_gc_server = False        # type: bool
         self.member_request_list = []         # type: List[str]
         self.rooms_with_missing_members = []  # type: List[str]
         self.lazy_load_hook = None       # type: Optional[str]
+        # Estimate of how many users per second we can add to nicklists,
+        # used to size the batches of the lazy user loading timer.
+        self.user_loading_rate = 2000.0  # type: float
 
         # These flags remember if we made some requests so that we don't
         # make them again while we wait on a response, the flags need to be
@@ -364,9 +469,20 @@ class MatrixServer(object):
 
     @connected.setter
     def connected(self, value):
+        if value == self._connected:
+            return
+
         self._connected = value
-        W.bar_item_update("buffer_modes")
-        W.bar_item_update("matrix_modes")
+        REDRAW.update("buffer_modes", "matrix_modes")
+
+    def _set_lag(self, lag, done):
+        # type: (float, bool) -> None
+        self.lag = lag
+        self.lag_done = done
+        # The lag is shown with millisecond precision.
+        REDRAW.update_if_changed(
+            ("lag", self.name), (int(lag), done), "lag"
+        )
 
     def get_session_path(self):
         home_dir = W.info_get("weechat_dir", "")
@@ -543,6 +659,9 @@ class MatrixServer(object):
                 self.client.user = value
                 if self.device_id:
                     self.client.device_id = self.device_id
+        elif option_name == "upload_workers":
+            # A new worker is started on the next upload if needed.
+            stop_upload_workers(self.name)
         else:
             pass
 
@@ -661,6 +780,7 @@ class MatrixServer(object):
         server_buffer_prnt(self, message)
 
         self.reconnect_time = None
+        SCHEDULER.cancel(self.name, "reconnect")
 
         if not self.connect():
             self.schedule_reconnect()
@@ -682,6 +802,13 @@ class MatrixServer(object):
             self.reconnect_delay = min(self.reconnect_delay,
                 G.CONFIG.network.autoreconnect_delay_max)
 
+        SCHEDULER.schedule(
+            self.name,
+            "reconnect",
+            self.reconnect_time + self.reconnect_delay,
+            self._reconnect_task
+        )
+
         message = (
             "{prefix}matrix: reconnecting to server in {t} " "seconds"
         ).format(prefix=W.prefix("network"), t=self.reconnect_delay)
@@ -723,9 +850,10 @@ class MatrixServer(object):
             except LocalProtocolError:
                 pass
 
-        self.lag = 0
-        W.bar_item_update("lag")
+        self._set_lag(0, False)
         self.reconnect_time = None
+        self.sync_time = None
+        SCHEDULER.cancel(self.name)
 
         # Clear our request flags.
         self.keys_queried = False
@@ -760,11 +888,6 @@ class MatrixServer(object):
         if not self.server_buffer:
             create_server_buffer(self)
 
-        if not self.timer_hook:
-            self.timer_hook = W.hook_timer(
-                1 * 1000, 0, 0, "matrix_timer_cb", self.name
-            )
-
         ssl_message = " (SSL)" if self.ssl_context.check_hostname else ""
 
         message = (
@@ -791,20 +914,187 @@ class MatrixServer(object):
 
         return True
 
+    def build_sync_filter(self, limit):
+        # type: (int) -> Dict[str, Any]
+        """Build the filter for a sync request.
+
+        Presence, read receipts and account data we don't handle are never
+        synced. Muted rooms stay in the sync, their timelines carry the state
+        changes of the room which lazy loading doesn't send otherwise.
+
+        Args:
+            limit (int): The maximum number of timeline events per room.
+        """
+        room_filter = {
+            "timeline": {"limit": limit},
+            "state": {"lazy_load_members": True},
+            "ephemeral": {"types": SYNC_EPHEMERAL_TYPES},
+            "account_data": {"types": SYNC_ROOM_ACCOUNT_DATA_TYPES},
+        }  # type: Dict[str, Any]
+
+        return {
+            "presence": {"not_types": ["*"]},
+            "account_data": {"not_types": ["*"]},
+            "room": room_filter,
+        }
+
     def schedule_sync(self):
         self.sync_time = time.time()
 
+        if self.transport_type == TransportType.HTTP:
+            self.sync_time += HTTP_SYNC_INTERVAL
+
+        SCHEDULER.schedule(self.name, "sync", self.sync_time, self._sync_task)
+
     def sync(self, timeout=None, sync_filter=None):
         # type: (Optional[int], Optional[Dict[Any, Any]]) -> None
         if not self.client:
             return
 
         self.sync_time = None
+        SCHEDULER.cancel(self.name, "sync")
         _, request = self.client.sync(timeout, sync_filter,
             full_state=self.first_sync)
 
         self.send_or_queue(request)
 
+        # The sync request can't lag until its timeout passes, check the lag
+        # right after that.
+        self.schedule_lag_check(
+            time.time() + (timeout or 0) / 1000 + LAG_CHECK_INTERVAL
+        )
+
+    def schedule_lag_check(self, deadline=None):
+        # type: (Optional[float]) -> None
+        if deadline is None:
+            deadline = time.time() + (
+                LAG_CHECK_INTERVAL if self.lag else LAG_CHECK_IDLE_INTERVAL
+            )
+
+        SCHEDULER.schedule(
+            self.name,
+            "lag",
+            deadline,
+            self._lag_check_task,
+            keep_earlier=True
+        )
+
+    def schedule_to_device(self, delay=0):
+        # type: (float) -> None
+        if not self.client or not self.client.outgoing_to_device_messages:
+            return
+
+        SCHEDULER.schedule(
+            self.name,
+            "to_device",
+            time.time() + delay,
+            self._to_device_task,
+            keep_earlier=True
+        )
+
+    def schedule_garbage_collection(self):
+        # type: () -> None
+        """Schedule the next nicklist garbage collection run.
+
+        Runs follow each other quickly while there are rooms left from the
+        current collection, otherwise the collection runs every
+        USER_GC_INTERVAL seconds, or after USER_GC_MIN_INTERVAL seconds if
+        there are more users in our nicklists than the configured maximum.
+        """
+        if self.user_gc_rooms or self.user_gc_server:
+            deadline = time.time() + USER_GC_SLICE_INTERVAL
+        elif self.nicklist_limit_exceeded():
+            deadline = self.user_gc_time + USER_GC_MIN_INTERVAL
+        else:
+            deadline = self.user_gc_time + USER_GC_INTERVAL
+
+        SCHEDULER.schedule(
+            self.name,
+            "gc",
+            deadline,
+            self._garbage_collection_task,
+            keep_earlier=True
+        )
+
+    def schedule_deferred_rendering(self):
+        # type: () -> None
+        if not any(room_buffer.deferred_events
+                   for room_buffer in self.room_buffers.values()):
+            return
+
+        SCHEDULER.schedule(
+            self.name,
+            "render",
+            time.time() + DEFERRED_RENDER_DELAY,
+            self._deferred_rendering_task,
+            keep_earlier=True
+        )
+
+    def _deferred_rendering_task(self):
+        deadline = time.time() + DEFERRED_RENDER_BUDGET
+
+        for room_buffer in list(self.room_buffers.values()):
+            if not room_buffer.render_deferred_events(deadline):
+                # We ran out of time, continue after the main loop had a
+                # chance to run.
+                SCHEDULER.schedule(
+                    self.name,
+                    "render",
+                    time.time() + DEFERRED_RENDER_BUDGET,
+                    self._deferred_rendering_task
+                )
+                return
+
+    def _reconnect_task(self):
+        if not self.connected and self.reconnect_time:
+            self.reconnect()
+
+    def _sync_task(self):
+        if not self.connected or not self.client.logged_in:
+            return
+
+        timeout = 0 if self.transport_type == TransportType.HTTP else 30000
+        self.sync(timeout, self.build_sync_filter(500))
+
+    def _lag_check_task(self):
+        if not self.connected or not self.client.logged_in:
+            return
+
+        # check lag, disconnect if it's too big
+        self._set_lag(self.client.lag * 1000, False)
+
+        if self.lag > G.CONFIG.network.lag_reconnect * 1000:
+            self.disconnect()
+            return
+
+        self.schedule_lag_check()
+
+    def _to_device_task(self):
+        if not self.connected or not self.client.logged_in:
+            return
+
+        messages = [
+            message for message in self.client.outgoing_to_device_messages
+            if message not in self.to_device_sent
+        ]
+
+        for message in messages[:TO_DEVICE_BATCH]:
+            self.to_device(message)
+            self.to_device_sent.append(message)
+
+        if len(messages) > TO_DEVICE_BATCH:
+            self.schedule_to_device(1)
+
+    def _garbage_collection_task(self):
+        if not self.connected or not self.client.logged_in:
+            return
+
+        if not self.user_gc_rooms and not self.user_gc_server:
+            self.start_garbage_collection()
+
+        self.garbage_collect_users()
+        self.schedule_garbage_collection()
+
     def login_info(self):
         # type: () -> None
         if not self.client:
@@ -851,13 +1141,7 @@ class MatrixServer(object):
             W.prnt(self.server_buffer, msg)
             timeout = 0 if self.transport_type == TransportType.HTTP else 30000
             limit = (G.CONFIG.network.max_initial_sync_events if self.first_sync else 500)
-            sync_filter = {
-                "room": {
-                    "timeline": {"limit": limit},
-                    "state": {"lazy_load_members": True}
-                }
-            }
-            self.sync(timeout, sync_filter)
+            self.sync(timeout, self.build_sync_filter(limit))
             return
 
         if (not self.config.username or not self.config.password) and not token:
@@ -941,14 +1225,21 @@ class MatrixServer(object):
         if room_buffer.backlog_pending:
             return False
 
-        if not room_buffer.prev_batch:
+        if room_buffer.gap_batch:
+            # The events printed after the gap are fetched again, make sure
+            # we get some of the skipped ones as well.
+            uuid, request = self.client.room_messages(
+                room_id,
+                room_buffer.gap_batch,
+                limit=G.CONFIG.network.catch_up_events + 10)
+        elif room_buffer.prev_batch:
+            uuid, request = self.client.room_messages(
+                room_id,
+                room_buffer.prev_batch,
+                limit=10)
+        else:
             return False
 
-        uuid, request = self.client.room_messages(
-            room_id,
-            room_buffer.prev_batch,
-            limit=10)
-
         room_buffer.backlog_pending = True
         self.backlog_queue[uuid] = room_id
         self.send_or_queue(request)
@@ -982,18 +1273,15 @@ class MatrixServer(object):
         if not self.connected or not self.client.logged_in:
             return
 
-        input = room_buffer.weechat_buffer.input
-
-        typing_enabled = bool(int(W.string_eval_expression(
-            G.CONFIG.network.typing_notice_conditions,
-            {},
-            {"typing_enabled": str(int(room_buffer.typing_enabled))},
-            {"type": "condition"}
-        )))
+        typing_enabled = G.CONFIG.typing_notice_conditions.evaluate(
+            room_buffer.typing_enabled
+        )
 
         if not typing_enabled:
             return
 
+        input = room_buffer.weechat_buffer.input
+
         # Don't send a typing notice if the user is typing in a weechat command
         if input.startswith("/") and not input.startswith("//"):
             return
@@ -1356,15 +1644,12 @@ class MatrixServer(object):
         if not self.client.olm_account_shared:
             self.keys_upload()
 
-        sync_filter = {
-            "room": {
-                "timeline": {
-                    "limit": G.CONFIG.network.max_initial_sync_events
-                },
-                "state": {"lazy_load_members": True}
-            }
-        }
-        self.sync(timeout=0, sync_filter=sync_filter)
+        self.sync(
+            timeout=0,
+            sync_filter=self.build_sync_filter(
+                G.CONFIG.network.max_initial_sync_events
+            )
+        )
 
     def _handle_room_info(self, response):
         for room_id, info in response.rooms.invite.items():
@@ -1396,50 +1681,123 @@ class MatrixServer(object):
                 ))
 
         for room_id, info in response.rooms.leave.items():
+            self.lazy_rooms.pop(room_id, None)
+            self.rooms_to_open.discard(room_id)
+            REDRAW.forget("typing", self.name, room_id)
+
             if room_id not in self.buffers:
                 continue
 
             room_buffer = self.find_room_from_id(room_id)
             room_buffer.handle_left_room(info)
 
+        # Rooms are caught up on every sync but the initial one, events that
+        # are skipped can be fetched using the token of this sync.
+        gap_batch = response.next_batch if self.next_batch else None
+
         for room_id, info in response.rooms.join.items():
             if room_id not in self.buffers:
-                self.create_room_buffer(room_id, info.timeline.prev_batch)
+                if self._keep_room_lazy(room_id, info):
+                    continue
+
+                self.open_room(room_id, info.timeline.prev_batch)
 
             room_buffer = self.find_room_from_id(room_id)
-            room_buffer.handle_joined_room(info)
+            room_buffer.handle_joined_room(
+                info,
+                gap_batch,
+                G.CONFIG.network.skip_muted_rooms and room_buffer.muted
+            )
 
-    def add_unhandled_users(self, rooms, n):
-        # type: (List[RoomBuffer], int) -> bool
-        total_users = 0
+    def _keep_room_lazy(self, room_id, info):
+        # type: (str, RoomInfo) -> bool
+        if not G.CONFIG.look.lazy_room_buffers:
+            return False
 
-        while total_users <= n:
-            try:
-                room_buffer = rooms.pop()
-            except IndexError:
-                return False
+        if room_id in self.rooms_to_open:
+            self.rooms_to_open.discard(room_id)
+            return False
 
-            handled_users = 0
+        lazy_room = self.lazy_rooms.get(room_id)
 
-            users = room_buffer.unhandled_users
+        if not lazy_room:
+            lazy_room = LazyRoom(self.client.rooms[room_id])
+            self.lazy_rooms[room_id] = lazy_room
 
-            for user_id in users:
-                room_buffer.add_user(user_id, 0, True)
-                handled_users += 1
-                total_users += 1
+        return not lazy_room.handle_joined_room(info)
 
-                if total_users >= n:
-                    room_buffer.unhandled_users = users[handled_users:]
-                    rooms.append(room_buffer)
-                    return True
+    def open_room(self, room_id, prev_batch=None):
+        # type: (str, Optional[str]) -> RoomBuffer
+        """Get the buffer of a joined room, creating it if the room doesn't
+        have one yet.
 
-            room_buffer.unhandled_users = []
+        Args:
+            room_id (str): The id of the room.
+            prev_batch (str, optional): The token used to fetch the history
+                of the room, defaults to the token of our last sync since the
+                events of a lazy room weren't printed.
+        """
+        if room_id in self.room_buffers:
+            return self.room_buffers[room_id]
 
-        return False
+        lazy_room = self.lazy_rooms.pop(room_id, None)
+        self.create_room_buffer(room_id, prev_batch or self.next_batch)
+        room_buffer = self.room_buffers[room_id]
+
+        if lazy_room:
+            room_buffer.update_buffer_name()
+            priority = lazy_room.hotlist_priority
+
+            if priority:
+                W.buffer_set(
+                    room_buffer.weechat_buffer._ptr, "hotlist", priority
+                )
+
+        return room_buffer
+
+    def find_lazy_room(self, name):
+        # type: (str) -> Optional[LazyRoom]
+        """Find a room without a buffer by its id, alias or name."""
+        if name in self.lazy_rooms:
+            return self.lazy_rooms[name]
+
+        for lazy_room in self.lazy_rooms.values():
+            room = lazy_room.room
+
+            if name in (room.canonical_alias, room.name, room.display_name):
+                return lazy_room
+
+        return None
+
+    def _handle_join(self, response):
+        # type: (JoinResponse) -> None
+        if response.room_id in self.lazy_rooms:
+            room_buffer = self.open_room(response.room_id)
+            W.buffer_set(room_buffer.weechat_buffer._ptr, "display", "1")
+        elif response.room_id not in self.room_buffers:
+            self.rooms_to_open.add(response.room_id)
+
+    def add_unhandled_users(self, rooms, n):
+        # type: (List[RoomBuffer], int) -> int
+        """Add up to n queued users to the nicklists of the given rooms.
+
+        Rooms that have no queued users left are removed from the list.
+        Returns the number of users that were added.
+        """
+        total_users = 0
+
+        while rooms and total_users < n:
+            room_buffer = rooms[-1]
+            total_users += room_buffer.add_unhandled_users(n - total_users)
+
+            if not room_buffer.unhandled_users:
+                rooms.pop()
+
+        return total_users
 
     def _hook_lazy_user_adding(self):
         if not self.lazy_load_hook:
-            hook = W.hook_timer(1 * 1000, 0, 0,
+            hook = W.hook_timer(USER_LOADING_INTERVAL, 0, 0,
                                 "matrix_load_users_cb", self.name)
             self.lazy_load_hook = hook
 
@@ -1553,7 +1911,22 @@ class MatrixServer(object):
 
         self.next_batch = response.next_batch
         self.schedule_sync()
-        W.bar_item_update("matrix_typing_notice")
+
+        # Only the rooms that are part of the sync can have new typing
+        # notices.
+        for room_id in response.rooms.join:
+            room = self.client.rooms.get(room_id)
+
+            if room:
+                REDRAW.update_if_changed(
+                    ("typing", self.name, room_id),
+                    sorted(room.typing_users),
+                    "matrix_typing_notice"
+                )
+
+        self.schedule_to_device()
+        self.schedule_garbage_collection()
+        self.schedule_deferred_rendering()
 
         if self.rooms_with_missing_members:
             self.get_joined_members(self.rooms_with_missing_members.pop())
@@ -1602,8 +1975,13 @@ class MatrixServer(object):
             except ValueError:
                 pass
 
+            # Retry sending the message.
+            self.schedule_to_device(1)
+
     def handle_response(self, response):
         # type: (Response) -> None
+        CALLBACK_STATS.response_type = type(response).__name__
+
         response_lag = response.elapsed
 
         current_lag = 0
@@ -1612,9 +1990,7 @@ class MatrixServer(object):
             current_lag = self.client.lag
 
         if response_lag >= current_lag:
-            self.lag = response_lag * 1000
-            self.lag_done = True
-            W.bar_item_update("lag")
+            self._set_lag(response_lag * 1000, True)
 
         if isinstance(response, ErrorResponse):
             self.handle_error_response(response)
@@ -1628,6 +2004,9 @@ class MatrixServer(object):
         elif isinstance(response, LoginResponse):
             self._handle_login(response)
 
+        elif isinstance(response, JoinResponse):
+            self._handle_join(response)
+
         elif isinstance(response, LoginInfoResponse):
             self._handle_login_info(response)
 
@@ -1654,8 +2033,7 @@ class MatrixServer(object):
 
         elif isinstance(response, KeysQueryResponse):
             self.keys_queried = False
-            W.bar_item_update("buffer_modes")
-            W.bar_item_update("matrix_modes")
+            REDRAW.update("buffer_modes", "matrix_modes")
 
             for user_id, device_dict in response.changed.items():
                 for device in device_dict.values():
@@ -1674,7 +2052,7 @@ class MatrixServer(object):
             users = [user.user_id for user in response.members]
 
             # Don't add the users directly use the lazy load hook.
-            room_buffer.unhandled_users += users
+            room_buffer.queue_users(users)
             self._hook_lazy_user_adding()
             room_buffer.members_fetched = True
             room_buffer.update_buffer_name()
@@ -1757,7 +2135,13 @@ class MatrixServer(object):
 
     def create_room_buffer(self, room_id, prev_batch):
         room = self.client.rooms[room_id]
-        buf = RoomBuffer(room, self.name, self.homeserver, prev_batch)
+        buf = RoomBuffer(
+            room,
+            self.name,
+            self.homeserver,
+            prev_batch,
+            self.user_registry
+        )
 
         # We sadly don't get a correct summary on full_state from synapse so we
         # can't trust it that the members are fully synced
@@ -1766,6 +2150,25 @@ class MatrixServer(object):
 
         self.room_buffers[room_id] = buf
         self.buffers[room_id] = buf.weechat_buffer._ptr
+        self.last_room_id = room_id
+
+    def last_room_buffer_number(self):
+        # type: () -> int
+        """Get the number of the last room buffer of the server.
+
+        Room buffers are placed after each other, so this is the number of
+        the room buffer that was created last, as long as it's still open.
+        """
+        room_buffer = self.room_buffers.get(self.last_room_id)
+
+        if room_buffer:
+            return room_buffer.weechat_buffer.number
+
+        return max(
+            (room.weechat_buffer.number for room
+                in self.room_buffers.values()),
+            default=W.buffer_get_integer(self.server_buffer, "number")
+        )
 
     def find_room_from_ptr(self, pointer):
         try:
@@ -1780,49 +2183,117 @@ class MatrixServer(object):
         room_buffer = self.room_buffers[room_id]
         return room_buffer
 
+    def start_garbage_collection(self):
+        """Queue the rooms with too many users in their nicklist for the
+        nicklist garbage collection."""
+        self.user_gc_time = time.time()
+        self.user_gc_rooms = [
+            room_buffer for room_buffer in self.room_buffers.values()
+            if (len(room_buffer.displayed_nicks) >
+                G.CONFIG.network.max_nicklist_users)
+        ]
+        self.user_gc_server = self.nicklist_limit_exceeded()
+
+        # Forget about users that aren't in any of our rooms anymore.
+        self.user_registry.prune(
+            user_id
+            for room_buffer in self.room_buffers.values()
+            for user_id in room_buffer.room.users
+        )
+
     def garbage_collect_users(self):
         """ Remove inactive users.
         This tries to keep the number of users added to the nicklist less than
             the configuration option matrix.network.max_nicklist_users. It
-            removes users that have not been active for a day until there are
-            less than max_nicklist_users or no users are left for removal.
-            It never removes users that have a bigger power level than the
-            default one.
-        This function is run every hour by the server timer callback"""
+            removes users that have not been active for a day, least recently
+            active first, until there are less than max_nicklist_users or no
+            users are left for removal.
+        If the nicklists of all rooms combined still hold more users than
+            the server option max_server_nicklist_users afterwards, the
+            least recently active users across all rooms are removed as well.
+        The rooms queued by start_garbage_collection() are processed
+            incrementally, a single call doesn't take longer than
+            USER_GC_BUDGET. This function is run by the scheduler while there
+            are rooms or server wide removals left."""
+
+        deadline = time.time() + USER_GC_BUDGET
+        before = self.user_gc_time - 86400
+
+        while self.user_gc_rooms:
+            room_buffer = self.user_gc_rooms[-1]
+
+            # The room might have been left since the collection started.
+            if self.room_buffers.get(room_buffer.room.room_id) is room_buffer:
+                if not room_buffer.garbage_collect_users(before, deadline):
+                    return
+
+            self.user_gc_rooms.pop()
+
+        if self.user_gc_server:
+            self.user_gc_server = not self.garbage_collect_server_users(
+                before,
+                deadline
+            )
 
-        now = time.time()
-        self.user_gc_time = now
+    def garbage_collect_server_users(self, before, deadline):
+        # type: (float, float) -> bool
+        """Remove the least recently active users of all rooms combined.
 
-        def day_passed(t1, t2):
-            return (t2 - t1) > 86400
+        Users that didn't speak since the given time are removed until the
+        nicklists hold no more than max_server_nicklist_users users. Returns
+        False if the deadline was reached before that.
+        """
+        limit = self.config.max_server_nicklist_users
 
-        for room_buffer in self.room_buffers.values():
-            to_remove = max(
-                (len(room_buffer.displayed_nicks) -
-                    G.CONFIG.network.max_nicklist_users),
-                0
-            )
+        if not limit:
+            return True
 
-            if not to_remove:
-                continue
+        total = sum(
+            len(room_buffer.displayed_nicks)
+            for room_buffer in self.room_buffers.values()
+        )
 
-            removed = 0
-            removed_user_ids = []
+        # The stalest user of every room, the root is the stalest overall.
+        candidates = []
+        for room_id, room_buffer in self.room_buffers.items():
+            stale_user = room_buffer.weechat_buffer.peek_stale_user(before)
 
-            for user_id, nick in room_buffer.displayed_nicks.items():
-                user = room_buffer.weechat_buffer.users[nick]
+            if stale_user:
+                speaking_time, nick = stale_user
+                candidates.append((speaking_time, room_id, nick))
 
-                if (not user.speaking_time or
-                        day_passed(user.speaking_time, now)):
-                    room_buffer.weechat_buffer.part(nick, 0, False)
-                    removed_user_ids.append(user_id)
-                    removed += 1
+        heapq.heapify(candidates)
 
-                if removed >= to_remove:
-                    break
+        while total > limit and candidates:
+            if time.time() >= deadline:
+                return False
 
-            for user_id in removed_user_ids:
-                del room_buffer.displayed_nicks[user_id]
+            _, room_id, nick = heapq.heappop(candidates)
+            room_buffer = self.room_buffers[room_id]
+
+            room_buffer.weechat_buffer.pop_stale_user(before)
+            room_buffer.evict_user(nick)
+            total -= 1
+
+            stale_user = room_buffer.weechat_buffer.peek_stale_user(before)
+
+            if stale_user:
+                speaking_time, nick = stale_user
+                heapq.heappush(candidates, (speaking_time, room_id, nick))
+
+        return True
+
+    def nicklist_limit_exceeded(self):
+        # type: () -> bool
+        limit = self.config.max_server_nicklist_users
+
+        if not limit:
+            return False
+
+        return sum(
+            len(room_buffer.displayed_nicks)
+            for room_buffer in self.room_buffers.values()
+        ) > limit
 
     def buffer_merge(self):
         if not self.server_buffer:
@@ -1904,6 +2375,7 @@ def matrix_config_server_change_cb(server_name, option):
     # properties from a config option, sadly it's only available in the plugin
     # API of weechat.
     option_name = key_from_value(server.config._option_ptrs, option)
+    server.config.invalidate()
     server.update_option(option, option_name)
 
     return 1
@@ -1916,67 +2388,31 @@ def matrix_load_users_cb(server_name, remaining_calls):
 
     rooms = [x for x in server.room_buffers.values() if x.unhandled_users]
 
-    while server.add_unhandled_users(rooms, 100):
-        current = time.time()
+    while rooms:
+        remaining = USER_LOADING_BUDGET - (time.time() - start)
 
-        if current - start >= 0.1:
+        if remaining <= 0:
             return W.WEECHAT_RC_OK
 
-    # We are done adding users, we can unhook now.
-    W.unhook(server.lazy_load_hook)
-    server.lazy_load_hook = None
-
-    return W.WEECHAT_RC_OK
+        # Size the batch so that it fits into the remaining time budget
+        # according to the rate measured in previous batches.
+        batch_size = max(int(server.user_loading_rate * remaining), 10)
 
+        batch_start = time.time()
+        added = server.add_unhandled_users(rooms, batch_size)
+        batch_time = time.time() - batch_start
 
-@utf8_decode
-def matrix_timer_cb(server_name, remaining_calls):
-    server = SERVERS[server_name]
-
-    current_time = time.time()
+        if added and batch_time > 0:
+            server.user_loading_rate = (
+                server.user_loading_rate + added / batch_time
+            ) / 2
 
-    if (
-        (not server.connected)
-        and server.reconnect_time
-        and current_time >= (server.reconnect_time + server.reconnect_delay)
-    ):
-        server.reconnect()
-        return W.WEECHAT_RC_OK
-
-    if not server.connected or not server.client.logged_in:
-        return W.WEECHAT_RC_OK
-
-    # check lag, disconnect if it's too big
-    server.lag = server.client.lag * 1000
-    server.lag_done = False
-    W.bar_item_update("lag")
-
-    if server.lag > G.CONFIG.network.lag_reconnect * 1000:
-        server.disconnect()
-        return W.WEECHAT_RC_OK
-
-    for i, message in enumerate(server.client.outgoing_to_device_messages):
-        if i >= 5:
-            break
-
-        if message in server.to_device_sent:
-            continue
-
-        server.to_device(message)
-        server.to_device_sent.append(message)
-
-    if server.sync_time and current_time > server.sync_time:
-        timeout = 0 if server.transport_type == TransportType.HTTP else 30000
-        sync_filter = {
-            "room": {
-                "timeline": {"limit": 500},
-                "state": {"lazy_load_members": True}
-            }
-        }
-        server.sync(timeout, sync_filter)
+    # We are done adding users, we can unhook now.
+    W.unhook(server.lazy_load_hook)
+    server.lazy_load_hook = None
 
-    if current_time > (server.user_gc_time + 3600):
-        server.garbage_collect_users()
+    # The nicklists might have grown over the limit.
+    server.schedule_garbage_collection()
 
     return W.WEECHAT_RC_OK
 
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2018, 2019 Damir Jelić <poljar@termina.org.uk>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER
+# RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF
+# CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Module measuring how long the weechat callbacks of the plugin take and
+how much memory the plugin uses."""
+
+from __future__ import unicode_literals
+
+import cProfile
+import math
+import os
+import pstats
+import time
+from collections import OrderedDict
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from . import utf
+from .globals import SCRIPT_NAME, SERVERS, UPLOADS, W
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # type: ignore
+
+timer = getattr(time, "perf_counter", time.time)
+
+
+class LatencyHistogram(object):
+    """Counts latencies in buckets that grow by a quarter of a power of two.
+
+    Bucket n holds the latencies below 2^(n/4) microseconds, percentiles are
+    reported as the upper bound of their bucket and are off by at most 19%.
+    """
+
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = dict()  # type: Dict[int, int]
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        # type: (float) -> None
+        microseconds = seconds * 1000000
+
+        if microseconds < 1:
+            bucket = 0
+        else:
+            bucket = int(math.log(microseconds, 2) * 4) + 1
+
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent):
+        # type: (float) -> float
+        """Get the latency in seconds below which the given percentage of
+        the calls finished."""
+        if not self.count:
+            return 0.0
+
+        rank = math.ceil(self.count * percent / 100.0)
+        seen = 0
+
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+
+            if seen >= rank:
+                return min(2 ** (bucket / 4.0) / 1000000, self.max)
+
+        return self.max
+
+
+class CallbackStats(object):
+    """Collects the latency of the callbacks wrapped by utf8_decode.
+
+    While the statistics are collected or the callbacks are profiled every
+    call of a wrapped function goes through measure(). Callbacks that are
+    called from within another callback are measured as well, but only the
+    outermost callback, the one weechat called, is profiled and checked
+    against the slow callback threshold.
+    """
+
+    def __init__(self):
+        self.histograms = dict()  # type: Dict[str, LatencyHistogram]
+        # Slow callbacks are logged if the threshold, in seconds, is set.
+        self.threshold = 0.0
+        # The type of the response the server is currently handling.
+        self.response_type = None  # type: Optional[str]
+        self.collect = False
+        self.profiler = None  # type: Optional[cProfile.Profile]
+        self._depth = 0
+
+    @property
+    def enabled(self):
+        # type: () -> bool
+        return self.collect
+
+    def _install(self):
+        if self.collect or self.profiler:
+            if utf.CALLBACK_MONITOR is not self:
+                self.response_type = None
+                self._depth = 0
+                utf.CALLBACK_MONITOR = self
+        elif utf.CALLBACK_MONITOR is self:
+            utf.CALLBACK_MONITOR = None
+
+    def enable(self):
+        self.collect = True
+        self._install()
+
+    def disable(self):
+        self.collect = False
+        self._install()
+
+    def reset(self):
+        self.histograms.clear()
+
+    def start_profile(self):
+        # type: () -> None
+        """Profile the callbacks until stop_profile() is called."""
+        self.profiler = cProfile.Profile()
+        self._install()
+
+    def stop_profile(self):
+        # type: () -> Optional[cProfile.Profile]
+        """Stop profiling, returns the profiler holding the results."""
+        profiler, self.profiler = self.profiler, None
+
+        if profiler:
+            profiler.disable()
+
+        self._install()
+        return profiler
+
+    def measure(self, function, args, kwargs):
+        # type: (Callable, Any, Any) -> Any
+        outermost = not self._depth
+        profiler = self.profiler if outermost else None
+
+        self._depth += 1
+
+        if profiler:
+            profiler.enable()
+
+        start = timer()
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = timer() - start
+            self._depth -= 1
+
+            if profiler:
+                profiler.disable()
+
+            if self.collect:
+                self.record(function.__name__, elapsed)
+
+                if (outermost and self.threshold
+                        and elapsed >= self.threshold):
+                    self.log_slow_callback(function.__name__, elapsed)
+
+            if outermost:
+                self.response_type = None
+
+    def record(self, name, seconds):
+        # type: (str, float) -> None
+        histogram = self.histograms.get(name, None)
+
+        if not histogram:
+            histogram = LatencyHistogram()
+            self.histograms[name] = histogram
+
+        histogram.add(seconds)
+
+    def log_slow_callback(self, name, seconds):
+        # type: (str, float) -> None
+        room = active_room_name()
+
+        message = (
+            "{prefix}{script}: slow callback {name} took {ms:.1f} ms "
+            "(room: {room}, response: {response})"
+        ).format(
+            prefix=W.prefix("error"),
+            script=SCRIPT_NAME,
+            name=name,
+            ms=seconds * 1000,
+            room=room or "-",
+            response=self.response_type or "-",
+        )
+        W.prnt("", message)
+
+    def format(self):
+        # type: () -> List[str]
+        """Format the collected statistics as a table, the callbacks taking
+        up the most time come first."""
+        histograms = sorted(
+            self.histograms.items(),
+            key=lambda item: item[1].total,
+            reverse=True
+        )
+
+        lines = ["{:<40} {:>8} {:>9} {:>9} {:>9} {:>9} {:>10}".format(
+            "callback", "calls", "p50 ms", "p95 ms", "p99 ms", "max ms",
+            "total ms"
+        )]
+
+        for name, histogram in histograms:
+            lines.append(
+                "{:<40} {:>8} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} "
+                "{:>10.1f}".format(
+                    name,
+                    histogram.count,
+                    histogram.percentile(50) * 1000,
+                    histogram.percentile(95) * 1000,
+                    histogram.percentile(99) * 1000,
+                    histogram.max * 1000,
+                    histogram.total * 1000,
+                )
+            )
+
+        return lines
+
+
+def active_room_name():
+    # type: () -> Optional[str]
+    """Get the name of the room that is displayed in the current buffer."""
+    buffer = W.current_buffer()
+
+    for server in SERVERS.values():
+        room_buffer = server.find_room_from_ptr(buffer)
+
+        if room_buffer:
+            return room_buffer.room.display_name or room_buffer.room.room_id
+
+    return None
+
+
+CALLBACK_STATS = CallbackStats()
+
+
+def write_profile(profiler, directory):
+    # type: (cProfile.Profile, str) -> Tuple[str, pstats.Stats]
+    """Write the results of a profiler as a pstats file into the directory.
+
+    Returns the path of the file and the statistics, raises a TypeError if
+    nothing was profiled."""
+    stats = pstats.Stats(profiler)
+    path = os.path.join(
+        directory,
+        "profile-{}.pstats".format(time.strftime("%Y%m%d-%H%M%S"))
+    )
+    stats.dump_stats(path)
+
+    return path, stats
+
+
+def format_profile(stats, count):
+    # type: (pstats.Stats, int) -> List[str]
+    """Format the functions with the highest cumulative time."""
+    functions = sorted(
+        stats.stats.items(),  # type: ignore
+        key=lambda item: item[1][3],
+        reverse=True
+    )
+
+    lines = ["{:>8} {:>10} {:>10}  {}".format(
+        "calls", "own ms", "total ms", "function"
+    )]
+
+    for (file_name, line, name), (_, calls, own, total, _) in (
+            functions[:count]):
+        lines.append("{:>8} {:>10.1f} {:>10.1f}  {}:{}({})".format(
+            calls,
+            own * 1000,
+            total * 1000,
+            os.path.basename(file_name),
+            line,
+            name
+        ))
+
+    return lines
+
+
+def top_allocations(count):
+    # type: (int) -> List[str]
+    """Format the source lines that allocated the most memory since the
+    allocations are traced."""
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ))
+    statistics = snapshot.statistics("lineno")
+
+    lines = ["{:>10} {:>9}  {}".format("KiB", "blocks", "allocated at")]
+
+    for statistic in statistics[:count]:
+        frame = statistic.traceback[0]
+        lines.append("{:>10.1f} {:>9}  {}:{}".format(
+            statistic.size / 1024.0,
+            statistic.count,
+            frame.filename,
+            frame.lineno
+        ))
+
+    return lines
+
+
+def memory_census(server):
+    # type: (Any) -> OrderedDict
+    """Count the objects that grow with the rooms and users of a server."""
+    room_buffers = list(server.room_buffers.values())
+
+    return OrderedDict([
+        ("room buffers", len(room_buffers)),
+        ("rooms without a buffer", len(server.lazy_rooms)),
+        ("room members", sum(len(b.room.users) for b in room_buffers)),
+        ("nicklist users",
+         sum(len(b.weechat_buffer.users) for b in room_buffers)),
+        ("registered users", len(server.user_registry)),
+        ("undecrypted events",
+         sum(len(b.undecrypted_events) for b in room_buffers)),
+        ("deferred events",
+         sum(len(b.deferred_events) for b in room_buffers)),
+        ("uploads", sum(
+            upload.server_name == server.name for upload in UPLOADS.values()
+        )),
+    ])
@@ -21,7 +21,8 @@ from __future__ import unicode_literals
 import attr
 import time
 import json
-from typing import Dict, Any
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
 from uuid import uuid1, UUID
 from enum import Enum
 
@@ -32,19 +33,27 @@ except ImportError:
 
 from .globals import SCRIPT_NAME, SERVERS, W, UPLOADS
 from .utf import utf8_decode
+from .config import EncryptedUploadReuse
 from .message_renderer import Render
 from matrix import globals as G
 from nio import Api
 
 
 class UploadState(Enum):
-    created = 0
+    queued = 0
     active = 1
     finished = 2
     error = 3
     aborted = 4
 
 
+FINISHED_UPLOAD_STATES = (
+    UploadState.finished,
+    UploadState.error,
+    UploadState.aborted
+)
+
+
 @attr.s
 class Proxy(object):
     ptr = attr.ib(type=str)
@@ -74,6 +83,74 @@ class Proxy(object):
         return W.infolist_string(self.ptr, "password")
 
 
+def process_arguments(arguments):
+    # type: (List[str]) -> Dict[str, str]
+    """Convert a list of arguments to the options of hook_process_hashtable."""
+    return {
+        "arg{}".format(number): argument
+        for number, argument in enumerate(arguments, 1)
+    }
+
+
+def option_arguments():
+    # type: () -> List[str]
+    """Get the matrix_upload arguments for the upload cache and image
+    settings."""
+    reuse = EncryptedUploadReuse(G.CONFIG.network.reuse_encrypted_uploads)
+
+    return [
+        "--cache-size",
+        str(G.CONFIG.network.upload_cache_size),
+        "--reuse-encrypted",
+        reuse.name.lower(),
+        "--thumbnail-size",
+        str(G.CONFIG.network.upload_thumbnail_size),
+        "--downscale-above",
+        str(G.CONFIG.network.upload_downscale_above * 1024),
+        "--downscale-size",
+        str(G.CONFIG.network.upload_downscale_size),
+    ]
+
+
+def connection_arguments(server):
+    # type: (Any) -> List[str]
+    """Get the matrix_upload arguments for the SSL and proxy settings of a
+    server."""
+    arguments = []
+
+    if not server.config.ssl_verify:
+        arguments.append("--insecure")
+
+    proxy_name = server.config.proxy
+
+    if not proxy_name:
+        return arguments
+
+    proxies_list = W.infolist_get("proxy", "", proxy_name)
+
+    if not proxies_list:
+        return arguments
+
+    W.infolist_next(proxies_list)
+    proxy = Proxy(proxies_list)
+
+    arguments += [
+        "--proxy-type", proxy.type,
+        "--proxy-address", proxy.address,
+        "--proxy-port", proxy.port,
+    ]
+
+    if proxy.user:
+        arguments += ["--proxy-user", proxy.user]
+
+    if proxy.password:
+        arguments += ["--proxy-password", proxy.password]
+
+    W.infolist_free(proxies_list)
+
+    return arguments
+
+
 @attr.s
 class Upload(object):
     """Class representing an upload to a matrix server."""
@@ -86,77 +163,58 @@ class Upload(object):
     encrypt = attr.ib(type=bool, default=False)
     file_keys = attr.ib(type=Dict, default=None)
 
+    info = None
     done = 0
     total = 0
 
     uuid = None
     buffer = None
     upload_hook = None
+    worker = None
+    started_time = None
     content_uri = None
     file_name = None
     mimetype = "?"
-    state = UploadState.created
+    state = UploadState.queued
 
     def __attrs_post_init__(self):
         self.uuid = uuid1()
         self.buffer = ""
 
-        server = SERVERS[self.server_name]
-
-        proxy_name = server.config.proxy
-        proxy = None
-        proxies_list = None
-
-        if proxy_name:
-            proxies_list = W.infolist_get("proxy", "", proxy_name)
-            if proxies_list:
-                W.infolist_next(proxies_list)
-                proxy = Proxy(proxies_list)
-
-        process_args = {
-            "arg1": self.filepath,
-            "arg2": self.server_address,
-            "arg3": self.access_token,
-            "buffer_flush": "1",
-        }
-
-        arg_count = 3
+    def start(self):
+        """Start the upload process or hand the upload to the upload worker
+        of the server."""
+        server = SERVERS.get(self.server_name, None)
+
+        if not server:
+            self.finish(UploadState.error)
+            return
+
+        self.state = UploadState.active
+        self.started_time = time.time()
+
+        if server.config.upload_workers:
+            self.worker = upload_worker(server, self.server_address)
+            self.worker.submit(self)
+            return
+
+        arguments = [
+            self.filepath,
+            self.server_address,
+            self.access_token,
+            "--room-id",
+            self.room_id,
+            "--state-dir",
+            server.get_session_path(),
+        ]
 
         if self.encrypt:
-            arg_count += 1
-            process_args["arg{}".format(arg_count)] = "--encrypt"
-
-        if not server.config.ssl_verify:
-            arg_count += 1
-            process_args["arg{}".format(arg_count)] = "--insecure"
-
-        if proxy:
-            arg_count += 1
-            process_args["arg{}".format(arg_count)] = "--proxy-type"
-            arg_count += 1
-            process_args["arg{}".format(arg_count)] = proxy.type
-
-            arg_count += 1
-            process_args["arg{}".format(arg_count)] = "--proxy-address"
-            arg_count += 1
-            process_args["arg{}".format(arg_count)] = proxy.address
-
-            arg_count += 1
-            process_args["arg{}".format(arg_count)] = "--proxy-port"
-            arg_count += 1
-            process_args["arg{}".format(arg_count)] = proxy.port
-
-            if proxy.user:
-                arg_count += 1
-                process_args["arg{}".format(arg_count)] = "--proxy-user"
-                arg_count += 1
-                process_args["arg{}".format(arg_count)] = proxy.user
-
-            if proxy.password:
-                arg_count += 1
-                process_args["arg{}".format(arg_count)] = "--proxy-password"
-                arg_count += 1
-                process_args["arg{}".format(arg_count)] = proxy.password
+            arguments.append("--encrypt")
+
+        process_args = process_arguments(
+            arguments + option_arguments() + connection_arguments(server)
+        )
+        process_args["buffer_flush"] = "1"
 
         self.upload_hook = W.hook_process_hashtable(
             "matrix_upload",
@@ -166,11 +224,34 @@ class Upload(object):
             str(self.uuid)
         )
 
-        if proxies_list:
-            W.infolist_free(proxies_list)
+    def finish(self, state):
+        # type: (UploadState) -> None
+        """Mark the upload as finished and let the next queued one start."""
+        self.state = state
+        UPLOAD_QUEUE.release(self)
 
     def abort(self):
-        pass
+        # type: () -> None
+        if self.state in FINISHED_UPLOAD_STATES:
+            return
+
+        if self.worker:
+            self.worker.cancel(self)
+        elif self.upload_hook:
+            # Removing the hook kills the upload process.
+            W.unhook(self.upload_hook)
+            self.upload_hook = None
+
+        self.finish(UploadState.aborted)
+
+    @property
+    def throughput(self):
+        # type: () -> float
+        """The average number of bytes sent per second."""
+        if self.state != UploadState.active or not self.started_time:
+            return 0
+
+        return self.done / max(time.time() - self.started_time, 1)
 
     @property
     def msgtype(self):
@@ -192,15 +273,19 @@ class Upload(object):
             content["file"]["url"] = self.content_uri
             content["file"]["mimetype"] = self.mimetype
 
-            # TODO thumbnail if it's an image
+        else:
+            content = {
+                "msgtype": self.msgtype,
+                "body": self.file_name,
+                "url": self.content_uri,
+            }
 
-            return content
+        # The info contains the size of the file and for images their
+        # dimensions and thumbnail.
+        if self.info:
+            content["info"] = self.info
 
-        return {
-            "msgtype": self.msgtype,
-            "body": self.file_name,
-            "url": self.content_uri,
-        }
+        return content
 
     @property
     def render(self):
@@ -219,20 +304,121 @@ class Upload(object):
         return Render.media(self.content_uri, self.file_name)
 
 
+class UploadQueue(object):
+    """Starts the queued uploads while the number of active uploads is below
+    the global and the per server limit.
+
+    Every server has its own queue of uploads, the servers take turns
+    starting an upload so a server with many queued uploads doesn't hold up
+    the uploads of the others.
+    """
+
+    def __init__(self):
+        self.queued = OrderedDict()  # type: Dict[str, Deque[Upload]]
+        self.active = OrderedDict()  # type: Dict[UUID, Upload]
+
+    def add(self, upload):
+        # type: (Upload) -> None
+        UPLOADS[upload.uuid] = upload
+        self.queued.setdefault(upload.server_name, deque()).append(upload)
+        self.start_next()
+
+    def remove(self, upload):
+        # type: (Upload) -> None
+        queue = self.queued.get(upload.server_name, None)
+
+        if queue and upload in queue:
+            queue.remove(upload)
+
+    def release(self, upload):
+        # type: (Upload) -> None
+        """Forget an upload that finished, start the next ones."""
+        self.remove(upload)
+        self.active.pop(upload.uuid, None)
+        prune_uploads()
+        self.start_next()
+
+    def active_uploads(self, server_name):
+        # type: (str) -> int
+        return sum(
+            upload.server_name == server_name
+            for upload in self.active.values()
+        )
+
+    def _next(self):
+        # type: () -> Optional[Upload]
+        for server_name, queue in self.queued.items():
+            if not queue:
+                continue
+
+            server = SERVERS.get(server_name, None)
+            limit = server.config.max_concurrent_uploads if server else 1
+
+            if self.active_uploads(server_name) >= limit:
+                continue
+
+            upload = queue.popleft()
+
+            # The server goes to the back of the line.
+            del self.queued[server_name]
+
+            if queue:
+                self.queued[server_name] = queue
+
+            return upload
+
+        return None
+
+    def start_next(self):
+        # type: () -> None
+        while len(self.active) < G.CONFIG.network.max_concurrent_uploads:
+            upload = self._next()
+
+            if not upload:
+                break
+
+            self.active[upload.uuid] = upload
+            upload.start()
+
+        if G.CONFIG.upload_buffer:
+            G.CONFIG.upload_buffer.render()
+
+
+UPLOAD_QUEUE = UploadQueue()
+
+
+def prune_uploads():
+    # type: () -> None
+    """Forget the oldest finished uploads once there are more of them than
+    the configured limit."""
+    finished = [
+        uuid for uuid, upload in UPLOADS.items()
+        if upload.state in FINISHED_UPLOAD_STATES
+    ]
+
+    excess = len(finished) - G.CONFIG.network.max_finished_uploads
+
+    for uuid in finished[:max(excess, 0)]:
+        del UPLOADS[uuid]
+
+
 @attr.s
 class UploadsBuffer(object):
     """Weechat buffer showing the uploads for a server."""
 
     _ptr = ""           # type: str
     _selected_line = 0  # type: int
+    _lines = None       # type: Dict[int, str]
     uploads = UPLOADS
 
     def __attrs_post_init__(self):
+        self._lines = dict()
+
         self._ptr = W.buffer_new(
             SCRIPT_NAME + ".uploads",
+            "matrix_uploads_buffer_input_cb",
             "",
-            "",
-            "",
+            "matrix_uploads_buffer_close_cb",
             "",
         )
         W.buffer_set(self._ptr, "type", "free")
@@ -258,8 +444,64 @@ class UploadsBuffer(object):
         """Display the buffer."""
         W.buffer_set(self._ptr, "display", "1")
 
+    def close(self):
+        W.buffer_close(self._ptr)
+
+    @property
+    def selected_upload(self):
+        # type: () -> Optional[Upload]
+        uploads = list(self.uploads.values())
+
+        if not uploads:
+            return None
+
+        return uploads[min(self._selected_line, len(uploads) - 1)]
+
+    def cancel_selected(self):
+        upload = self.selected_upload
+
+        if upload:
+            upload.abort()
+
+        self.render()
+
+    def remove_selected(self):
+        upload = self.selected_upload
+
+        if upload and upload.state in FINISHED_UPLOAD_STATES:
+            del self.uploads[upload.uuid]
+
+        self.render()
+
+    def purge(self):
+        """Remove all the finished uploads."""
+        for upload in list(self.uploads.values()):
+            if upload.state in FINISHED_UPLOAD_STATES:
+                del self.uploads[upload.uuid]
+
+        self.render()
+
     def render(self):
-        """Render the new state of the upload buffer."""
+        """Render the new state of the upload buffer.
+
+        Only the lines that changed since the last render are printed, the
+        buffer is cleared only if uploads were removed from it.
+        """
+        lines = self.format_lines()
+
+        if len(lines) < len(self._lines):
+            W.buffer_clear(self._ptr)
+            self._lines = dict()
+
+        for y, line in lines.items():
+            if self._lines.get(y) != line:
+                W.prnt_y(self._ptr, y, line)
+
+        self._lines = lines
+
+    def format_lines(self):
+        # type: () -> Dict[int, str]
+        """Get the lines of the buffer, keyed by their line number."""
         # This function is under the MIT license.
         # Copyright (c) 2016 Vladimir Ignatev
         def progress(count, total):
@@ -275,20 +517,36 @@ class UploadsBuffer(object):
 
             return "[{}] {}%".format(bar, percents)
 
-        W.buffer_clear(self._ptr)
-        header = "{}{}{}{}{}{}{}{}".format(
+        lines = dict()
+
+        header = "{}{}{}{}{}{}{}".format(
             W.color("green"),
             "Actions (letter+enter):",
             W.color("lightgreen"),
-            "  [A] Accept",
             "  [C] Cancel",
             "  [R] Remove",
             "  [P] Purge finished",
             "  [Q] Close this buffer"
         )
-        W.prnt_y(self._ptr, 0, header)
+        lines[0] = header
+
+        uploads = list(self.uploads.values())
+        states = [upload.state for upload in uploads]
+        throughput = sum(upload.throughput for upload in uploads)
+
+        lines[1] = ("{}{} queued, {} active, {} finished, {} failed, "
+                    "{}/s").format(
+            W.color("default"),
+            states.count(UploadState.queued),
+            states.count(UploadState.active),
+            states.count(UploadState.finished),
+            states.count(UploadState.error) + states.count(
+                UploadState.aborted
+            ),
+            W.string_format_size(int(throughput))
+        )
 
-        for line_number, upload in enumerate(self.uploads.values()):
+        for line_number, upload in enumerate(uploads):
             line_color = "{},{}".format(
                 "white" if line_number == self._selected_line else "default",
                 "blue" if line_number == self._selected_line else "default",
@@ -304,7 +562,7 @@ class UploadsBuffer(object):
                           SCRIPT_NAME,
                           upload.server_name,
                           ))
-            W.prnt_y(self._ptr, (line_number * 2) + 2, first_line)
+            lines[(line_number * 2) + 2] = first_line
 
             status_color = "{},{}".format("green", "blue")
             status = "{}{}{}".format(
@@ -322,7 +580,169 @@ class UploadsBuffer(object):
                 done=W.string_format_size(upload.done),
                 total=W.string_format_size(upload.total))
 
-            W.prnt_y(self._ptr, (line_number * 2) + 3, second_line)
+            lines[(line_number * 2) + 3] = second_line
+
+        return lines
+
+
+@attr.s
+class UploadWorker(object):
+    """A long-lived matrix_upload process handling the uploads of a server.
+
+    Jobs are written to the stdin of the process as JSON lines, the process
+    keeps its connections to the homeserver open between uploads and runs up
+    to concurrency uploads at the same time. The messages it prints are the
+    ones of a single upload process tagged with the id of the upload.
+    """
+
+    server_name = attr.ib(type=str)
+    arguments = attr.ib(type=list)
+    concurrency = attr.ib(type=int)
+
+    uuid = None
+    hook = None
+    buffer = ""
+    stopping = False
+    uploads = None
+
+    def __attrs_post_init__(self):
+        self.uuid = uuid1()
+        self.uploads = OrderedDict()  # type: Dict[UUID, Upload]
+
+        process_args = process_arguments(
+            ["--worker", "--concurrency", str(self.concurrency)]
+            + self.arguments
+        )
+        process_args["buffer_flush"] = "1"
+        process_args["stdin"] = "1"
+
+        self.hook = W.hook_process_hashtable(
+            "matrix_upload",
+            process_args,
+            0,
+            "upload_worker_cb",
+            str(self.uuid)
+        )
+
+    def submit(self, upload):
+        # type: (Upload) -> None
+        job = {
+            "id": str(upload.uuid),
+            "file": upload.filepath,
+            "access_token": upload.access_token,
+            "room_id": upload.room_id,
+            "encrypt": upload.encrypt,
+        }
+
+        self.uploads[upload.uuid] = upload
+        W.hook_set(self.hook, "stdin", json.dumps(job) + "\n")
+
+    def cancel(self, upload):
+        # type: (Upload) -> None
+        """Stop an upload, the worker doesn't report anything for it
+        anymore."""
+        self.uploads.pop(upload.uuid, None)
+        W.hook_set(
+            self.hook,
+            "stdin",
+            json.dumps({"cancel": str(upload.uuid)}) + "\n"
+        )
+
+    def stop(self):
+        # type: () -> None
+        """Let the worker finish the submitted uploads and exit."""
+        self.stopping = True
+        W.hook_set(self.hook, "stdin_close", "")
+
+    def handle_output(self, out):
+        # type: (str) -> None
+        messages, self.buffer = parse_messages(self.buffer, out)
+
+        for message in messages:
+            try:
+                upload = self.uploads[UUID(message["id"])]
+            except (KeyError, TypeError, ValueError):
+                continue
+
+            if (message["type"] == "status"
+                    and message["status"] in ("done", "error")):
+                del self.uploads[upload.uuid]
+
+            handle_child_message(upload, message)
+
+    def handle_exit(self):
+        # type: () -> None
+        del UPLOAD_WORKERS[self.uuid]
+
+        # Whatever the worker didn't finish is lost.
+        uploads = list(self.uploads.values())
+        self.uploads.clear()
+
+        for upload in uploads:
+            upload.finish(UploadState.error)
+
+        if G.CONFIG.upload_buffer:
+            G.CONFIG.upload_buffer.render()
+
+
+UPLOAD_WORKERS = OrderedDict()  # type: Dict[UUID, UploadWorker]
+
+
+def upload_worker(server, address):
+    # type: (Any, str) -> UploadWorker
+    """Get the upload worker of a server, starting it if needed.
+
+    A worker that was started with other connection settings is stopped and
+    replaced, it still finishes the uploads it got before.
+    """
+    arguments = [
+        address,
+        "--state-dir",
+        server.get_session_path()
+    ] + option_arguments() + connection_arguments(server)
+    concurrency = server.config.upload_workers
+
+    for worker in UPLOAD_WORKERS.values():
+        if worker.server_name != server.name or worker.stopping:
+            continue
+
+        if (worker.arguments == arguments
+                and worker.concurrency == concurrency):
+            return worker
+
+        worker.stop()
+
+    worker = UploadWorker(server.name, arguments, concurrency)
+    UPLOAD_WORKERS[worker.uuid] = worker
+
+    return worker
+
+
+def stop_upload_workers(server_name):
+    # type: (str) -> None
+    for worker in UPLOAD_WORKERS.values():
+        if worker.server_name == server_name and not worker.stopping:
+            worker.stop()
+
+
+def parse_messages(buffer, out):
+    # type: (str, str) -> Tuple[List[Dict[str, Any]], str]
+    """Parse the complete JSON lines of the output of a matrix_upload process.
+
+    Returns the parsed messages and the incomplete last line, which should be
+    passed as the buffer together with the next output.
+    """
+    lines = (buffer + out).split("\n")
+    buffer = lines.pop()
+    messages = []
+
+    for line in lines:
+        try:
+            messages.append(json.loads(line))
+        except (JSONDecodeError, TypeError):
+            continue
+
+    return messages, buffer
 
 
 def find_upload(uuid):
@@ -341,19 +761,22 @@ def handle_child_message(upload, message):
             upload.file_name = message["file_name"]
 
         elif message["status"] == "done":
-            upload.state = UploadState.finished
             upload.content_uri = message["url"]
             upload.file_keys = message.get("file_keys", None)
+            upload.info = message.get("info", None)
+            upload.finish(UploadState.finished)
 
             server = SERVERS.get(upload.server_name, None)
 
-            if not server:
-                return
+            if server:
+                server.room_send_upload(upload)
 
-            server.room_send_upload(upload)
+        elif message["status"] == "retrying":
+            # The file is sent again from the start.
+            upload.done = 0
 
         elif message["status"] == "error":
-            upload.state = UploadState.error
+            upload.finish(UploadState.error)
 
     if G.CONFIG.upload_buffer:
         G.CONFIG.upload_buffer.render()
@@ -368,24 +791,69 @@ def upload_cb(data, command, return_code, out, err):
 
     if return_code == W.WEECHAT_HOOK_PROCESS_ERROR:
         W.prnt("", "Error with command '%s'" % command)
+        upload.finish(UploadState.error)
         return W.WEECHAT_RC_OK
 
     if err != "":
         W.prnt("", "Error with command '%s'" % err)
-        upload.state = UploadState.error
+        upload.finish(UploadState.error)
 
     if out != "":
-        upload.buffer += out
-        messages = upload.buffer.split("\n")
-        upload.buffer = ""
-
-        for m in messages:
-            try:
-                message = json.loads(m)
-            except (JSONDecodeError, TypeError):
-                upload.buffer += m
-                continue
+        messages, upload.buffer = parse_messages(upload.buffer, out)
 
+        for message in messages:
             handle_child_message(upload, message)
 
+    # The process exited without telling us that the upload is done.
+    if return_code >= 0 and upload.state not in FINISHED_UPLOAD_STATES:
+        upload.finish(UploadState.error)
+
+    return W.WEECHAT_RC_OK
+
+
+@utf8_decode
+def upload_worker_cb(data, command, return_code, out, err):
+    worker = UPLOAD_WORKERS.get(UUID(data), None)
+
+    if not worker:
+        return W.WEECHAT_RC_OK
+
+    if err != "":
+        W.prnt("", "Error with command '%s'" % err)
+
+    if out != "":
+        worker.handle_output(out)
+
+    if return_code == W.WEECHAT_HOOK_PROCESS_ERROR:
+        W.prnt("", "Error with command '%s'" % command)
+        worker.handle_exit()
+
+    elif return_code >= 0:
+        worker.handle_exit()
+
+    return W.WEECHAT_RC_OK
+
+
+@utf8_decode
+def matrix_uploads_buffer_input_cb(data, buffer, input_data):
+    if not G.CONFIG.upload_buffer:
+        return W.WEECHAT_RC_OK
+
+    action = input_data.strip().lower()
+
+    if action == "c":
+        G.CONFIG.upload_buffer.cancel_selected()
+    elif action == "r":
+        G.CONFIG.upload_buffer.remove_selected()
+    elif action == "p":
+        G.CONFIG.upload_buffer.purge()
+    elif action == "q":
+        G.CONFIG.upload_buffer.close()
+
+    return W.WEECHAT_RC_OK
+
+
+@utf8_decode
+def matrix_uploads_buffer_close_cb(data, buffer):
+    G.CONFIG.upload_buffer = None
     return W.WEECHAT_RC_OK
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2018, 2019 Damir Jelić <poljar@termina.org.uk>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER
+# RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF
+# CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Module implementing the per server registry of known users."""
+
+from __future__ import unicode_literals
+
+import re
+
+import attr
+from typing import Dict, Iterable, Optional
+
+from .utils import shorten_sender
+
+
+# The default bridge nick rules, see BridgeNickRules.parse() for the format.
+DEFAULT_BRIDGE_NICKS = ",".join([
+    "@_discord_=displayname",
+    "@_slack_=displayname",
+    "@whatsapp_=displayname",
+    "@facebook_=displayname",
+    "@telegram_=displayname",
+    "@_telegram_=displayname",
+    "@_xmpp_=displayname",
+    "@twilio_=7",
+    "@freenode_=9",
+    "@_ircnet_=8",
+    "@gitter_=7",
+])
+
+
+class BridgeNickRules(object):
+    """Rules deciding how the nicks of bridged users are computed.
+
+    Every rule maps a user id prefix to either the number of characters that
+    are stripped from the localpart of the user id or to None if the display
+    name of the user should be used. All the prefixes are compiled into a
+    single anchored regular expression, the longest matching prefix wins.
+    """
+
+    def __init__(self, rules):
+        # type: (Dict[str, Optional[int]]) -> None
+        self.rules = rules
+
+        prefixes = sorted(rules, key=len, reverse=True)
+        self._regex = (
+            re.compile("|".join(re.escape(prefix) for prefix in prefixes))
+            if prefixes else None
+        )
+
+    @classmethod
+    def parse(cls, value):
+        # type: (str) -> BridgeNickRules
+        """Parse the bridge nick rules setting string
+        ("@_discord_=displayname,@freenode_=9") into a rule set. Malformed
+        rules are skipped."""
+        rules = {}  # type: Dict[str, Optional[int]]
+
+        for setting in value.split(","):
+            if "=" not in setting:
+                continue
+
+            prefix, rule = (part.strip() for part in setting.rsplit("=", 1))
+
+            if not prefix:
+                continue
+
+            if rule == "displayname":
+                rules[prefix] = None
+                continue
+
+            try:
+                rules[prefix] = max(int(rule), 0)
+            except ValueError:
+                continue
+
+        return cls(rules)
+
+    def match(self, user_id):
+        # type: (str) -> Optional[str]
+        """Return the prefix of the rule matching the user id, if any."""
+        if not self._regex:
+            return None
+
+        match = self._regex.match(user_id)
+        return match.group(0) if match else None
+
+
+@attr.s(slots=True)
+class UserInfo(object):
+    """Room independent information about a user.
+
+    Attributes:
+        user_id (str): The canonical copy of the user id, shared between all
+            the rooms the user is in.
+        display_name (str, optional): The display name the nick was computed
+            from.
+        short_name (str): The nick of the user if there are no clashes with
+            other users in a room.
+        bridge (str, optional): The user id prefix of the bridge the user
+            belongs to, None if the user isn't a bridged user.
+    """
+
+    user_id = attr.ib(type=str)
+    display_name = attr.ib(type=Optional[str])
+    short_name = attr.ib(type=str)
+    bridge = attr.ib(type=Optional[str], default=None)
+
+
+class UserRegistry(object):
+    """Registry of the users of all the rooms of a server.
+
+    Computing the nick of a user only depends on the user id and the display
+    name, the result is stored once per server instead of once per room.
+    Entries are recomputed when the display name of a user changes.
+    """
+
+    def __init__(self, bridge_nicks=None):
+        # type: (Optional[BridgeNickRules]) -> None
+        self._users = dict()  # type: Dict[str, UserInfo]
+        self.bridge_nicks = (
+            bridge_nicks or BridgeNickRules.parse(DEFAULT_BRIDGE_NICKS)
+        )
+
+    def __len__(self):
+        return len(self._users)
+
+    def __contains__(self, user_id):
+        return user_id in self._users
+
+    def get(self, user_id, display_name=None):
+        # type: (str, Optional[str]) -> UserInfo
+        info = self._users.get(user_id)
+
+        if info is None:
+            info = self._create(user_id, display_name)
+            self._users[info.user_id] = info
+        elif info.display_name != display_name:
+            info = self._create(info.user_id, display_name)
+            self._users[info.user_id] = info
+
+        return info
+
+    def prune(self, user_ids):
+        # type: (Iterable[str]) -> None
+        """Remove all the users that aren't in the given user ids."""
+        user_ids = set(user_ids)
+        self._users = {
+            user_id: info for user_id, info in self._users.items()
+            if user_id in user_ids
+        }
+
+    def set_bridge_nicks(self, bridge_nicks):
+        # type: (BridgeNickRules) -> None
+        """Replace the bridge nick rules, the nicks of all the known users are
+        recomputed the next time they are needed."""
+        self.bridge_nicks = bridge_nicks
+        self._users.clear()
+
+    def _create(self, user_id, display_name):
+        # type: (str, Optional[str]) -> UserInfo
+        bridge = self.bridge_nicks.match(user_id)
+
+        if bridge is None:
+            return UserInfo(user_id, display_name, shorten_sender(user_id))
+
+        strip = self.bridge_nicks.rules[bridge]
+
+        if strip is None:
+            short_name = (
+                display_name[0:50] if display_name
+                else shorten_sender(user_id)
+            )
+        else:
+            short_name = shorten_sender("@" + user_id[strip + 1:])
+
+        return UserInfo(user_id, display_name, short_name, bridge)
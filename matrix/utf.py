@@ -75,6 +75,11 @@ class WeechatWrapper(object):
         )
 
 
+# The CallbackStats object of the stats module while the callback statistics
+# are enabled, it measures every call of a function wrapped by utf8_decode.
+CALLBACK_MONITOR = None
+
+
 def utf8_decode(function):
     """
     Decode all arguments from byte strings to unicode strings. Use this for
@@ -84,11 +89,15 @@ def utf8_decode(function):
     @wraps(function)
     def wrapper(*args, **kwargs):
 
-        # Don't do anything if we're python 3
-        if sys.hexversion >= 0x3000000:
+        # Don't decode anything if we're python 3
+        if sys.hexversion < 0x3000000:
+            args = decode_from_utf8(args)
+            kwargs = decode_from_utf8(kwargs)
+
+        if CALLBACK_MONITOR is None:
             return function(*args, **kwargs)
 
-        return function(*decode_from_utf8(args), **decode_from_utf8(kwargs))
+        return CALLBACK_MONITOR.measure(function, args, kwargs)
 
     return wrapper
 
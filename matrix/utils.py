@@ -18,7 +18,8 @@
 from __future__ import unicode_literals, division
 
 import time
-from typing import Any, Dict, List
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List
 
 from .globals import W
 
@@ -31,6 +32,52 @@ def key_from_value(dictionary, value):
     return list(dictionary.keys())[list(dictionary.values()).index(value)]
 
 
+class OrderedSet(object):
+    """A set that remembers the insertion order of its elements.
+
+    Membership tests, insertion and removal are O(1), the elements can be
+    consumed in insertion order using pop().
+    """
+
+    def __init__(self, iterable=()):
+        # type: (Iterable[Any]) -> None
+        self._items = OrderedDict()  # type: OrderedDict
+        self.update(iterable)
+
+    def add(self, item):
+        self._items[item] = None
+
+    def update(self, iterable):
+        for item in iterable:
+            self._items[item] = None
+
+    def discard(self, item):
+        self._items.pop(item, None)
+
+    def pop(self):
+        """Remove and return the oldest element of the set."""
+        try:
+            item, _ = self._items.popitem(last=False)
+        except KeyError:
+            raise KeyError("pop from an empty set")
+        return item
+
+    def clear(self):
+        self._items.clear()
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, list(self._items))
+
+
 def server_buffer_prnt(server, string):
     # type: (MatrixServer, str) -> None
     assert server.server_buffer
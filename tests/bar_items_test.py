@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from matrix.bar_items import RedrawScheduler
+from matrix.globals import W
+
+
+class TestClass(object):
+    def test_updates_are_coalesced(self, monkeypatch):
+        updated = []
+        timers = []
+        monkeypatch.setattr(W, "bar_item_update", updated.append,
+                            raising=False)
+        monkeypatch.setattr(W, "hook_timer",
+                            lambda *args: timers.append(args) or "hook")
+
+        scheduler = RedrawScheduler()
+        scheduler.update("lag")
+        scheduler.update("buffer_modes", "matrix_modes")
+        scheduler.update("lag")
+
+        assert len(timers) == 1
+        assert not updated
+
+        scheduler.flush()
+        assert updated == ["lag", "buffer_modes", "matrix_modes"]
+
+        scheduler.flush()
+        assert len(updated) == 3
+
+    def test_unchanged_values_dont_cause_updates(self, monkeypatch):
+        monkeypatch.setattr(W, "hook_timer", lambda *args: "hook")
+        scheduler = RedrawScheduler()
+
+        scheduler.update_if_changed(("lag", "server"), (100, True), "lag")
+        assert scheduler.dirty == ["lag"]
+        scheduler.dirty = []
+
+        scheduler.update_if_changed(("lag", "server"), (100, True), "lag")
+        assert not scheduler.dirty
+
+        scheduler.update_if_changed(("lag", "server"), (100, False), "lag")
+        assert scheduler.dirty == ["lag"]
+
+    def test_values_of_left_rooms_are_forgotten(self, monkeypatch):
+        monkeypatch.setattr(W, "hook_timer", lambda *args: "hook")
+        scheduler = RedrawScheduler()
+
+        for room_id in ["!a:example.org", "!b:example.org"]:
+            scheduler.update_if_changed(("typing", "server", room_id), [],
+                                        "matrix_typing_notice")
+        scheduler.update_if_changed(("typing", "other", "!a:example.org"),
+                                    [], "matrix_typing_notice")
+        scheduler.update_if_changed(("lag", "server"), (100, True), "lag")
+
+        scheduler.forget("typing", "server", "!a:example.org")
+        assert set(scheduler.values) == {
+            ("typing", "server", "!b:example.org"),
+            ("typing", "other", "!a:example.org"),
+            ("lag", "server"),
+        }
+
+        # Deleting a server forgets all of its values.
+        scheduler.forget("typing", "server")
+        scheduler.forget("lag", "server")
+        assert set(scheduler.values) == {("typing", "other", "!a:example.org")}
@@ -2,9 +2,46 @@
 
 from __future__ import unicode_literals
 
-from matrix.buffer import WeechatChannelBuffer
+import time
+
+from nio import (Client, FullyReadEvent, RoomInfo, RoomMessageText,
+                 SyncResponse, Timeline)
+from nio.rooms import MatrixRoom
+
+import matrix.globals as G
+from matrix.buffer import (LazyRoom, RoomBuffer, WeechatChannelBuffer,
+                           count_unread)
+from matrix.globals import W
+from matrix._weechat import MockConfig
 from matrix.utils import parse_redact_args
 
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+G.CONFIG = MockConfig()
+
+
+def text_event(event_id, sender, body):
+    return RoomMessageText.from_dict({
+        "event_id": event_id,
+        "sender": sender,
+        "origin_server_ts": 0,
+        "type": "m.room.message",
+        "content": {"msgtype": "m.text", "body": body},
+    })
+
+
+def create_room_buffer(own_user_id, user_ids):
+    room = MatrixRoom("!test:example.org", own_user_id)
+
+    for user_id in user_ids:
+        room.add_member(user_id, None, None)
+
+    return RoomBuffer(room, "example.org", urlparse("https://example.org"),
+                      None)
+
 
 class TestClass(object):
     def test_buffer(self):
@@ -66,3 +103,324 @@ class TestClass(object):
         event_id, reason = parse_redact_args(args)
         assert event_id == '$15677776791893pZSXx:example.org'
         assert reason == '"Hello world"'
+
+    def test_power_level_changes_only_move_changed_users(self, monkeypatch):
+        room_buffer = create_room_buffer("@alice:example.org", [
+            "@alice:example.org", "@bob:example.org", "@carol:example.org"
+        ])
+        room = room_buffer.room
+        for user_id in room.users:
+            room_buffer.add_user(user_id, 0, True)
+
+        room.power_levels.users = {
+            "@alice:example.org": 100,
+            "@bob:example.org": 50,
+        }
+        room_buffer._handle_power_level(None)
+
+        removed = []
+        monkeypatch.setattr(
+            W, "nicklist_remove_nick",
+            lambda buffer, nick: removed.append(nick)
+        )
+        monkeypatch.setattr(W, "nicklist_search_nick", lambda *_: "nick")
+
+        # Only bob changes his prefix, alice keeps hers.
+        room.power_levels.users = {
+            "@alice:example.org": 100,
+            "@bob:example.org": 10,
+        }
+        room_buffer._handle_power_level(None)
+
+        assert len(removed) == 1
+        assert room_buffer.weechat_buffer.users["bob"].prefix == "+"
+        assert room_buffer.weechat_buffer.users["alice"].prefix == "&"
+
+    def test_nick_disambiguation_after_leave(self):
+        room_buffer = create_room_buffer("@alice:example.org", [
+            "@bob:example.org", "@bob:example.com"
+        ])
+        room = room_buffer.room
+        room_buffer.add_user("@bob:example.org", 0, True)
+        room_buffer.add_user("@bob:example.com", 0, True)
+
+        assert room_buffer.displayed_nicks == {
+            "@bob:example.org": "bob",
+            "@bob:example.com": "bob:example.com",
+        }
+        assert room_buffer.displayed_users["bob"] == "@bob:example.org"
+
+        room_buffer.remove_displayed_nick("@bob:example.org")
+        room.remove_member("@bob:example.org")
+        room.add_member("@bob:example.net", None, None)
+        room_buffer.add_user("@bob:example.net", 0, True)
+
+        assert room_buffer.displayed_nicks["@bob:example.net"] == "bob"
+        assert "bob:example.com" in room_buffer.displayed_users
+
+    def test_unhandled_users_are_added_in_reverse_nicklist_order(
+        self,
+        monkeypatch
+    ):
+        room_buffer = create_room_buffer("@alice:example.org", [
+            "@dave:example.org", "@alice:example.org", "@Carol:example.org",
+            "@bob:example.org", "@eve:example.org"
+        ])
+        room = room_buffer.room
+        room.power_levels.users = {"@bob:example.org": 100}
+        room.users["@bob:example.org"].power_level = 100
+
+        added = []
+        monkeypatch.setattr(
+            W, "nicklist_search_group", lambda buffer, parent, name: name
+        )
+        monkeypatch.setattr(
+            W, "nicklist_add_nick",
+            lambda buffer, group, nick, *_: added.append((group, nick))
+        )
+
+        room_buffer.queue_users(room.users)
+
+        assert room_buffer.add_unhandled_users(2) == 2
+        assert room_buffer.add_unhandled_users(10) == 3
+        assert not room_buffer.unhandled_users
+
+        assert [nick for group, nick in added if group == "999|..."] == [
+            "eve", "dave", "Carol", "alice"
+        ]
+        assert ("000|o", "bob") in added
+
+    def test_garbage_collection_removes_stalest_users_first(
+            self, monkeypatch):
+        room_buffer = create_room_buffer("@zoe:example.org", [
+            "@{}:example.org".format(name)
+            for name in ["alice", "bob", "carol", "dave"]
+        ])
+        for user_id in room_buffer.room.users:
+            room_buffer.add_user(user_id, 0, True)
+
+        buf = room_buffer.weechat_buffer
+        buf.message("bob", "hello", 3000)
+        buf.message("alice", "hello", 1000)
+        buf.message("dave", "hello", 2000)
+        buf.message("alice", "hello again", 5000)
+
+        monkeypatch.setattr(G.CONFIG.network, "max_nicklist_users", 2)
+        assert room_buffer.garbage_collect_users(4000, time.time() + 60)
+
+        # Carol never spoke and dave spoke before bob.
+        assert set(room_buffer.displayed_nicks) == {
+            "@alice:example.org", "@bob:example.org"
+        }
+        assert set(room_buffer.inactive_users) == {
+            "@carol:example.org", "@dave:example.org"
+        }
+        assert buf.pop_stale_user(4000) == "bob"
+        assert buf.pop_stale_user(4000) is None
+
+    def test_lazy_room_counts_unread_messages_and_highlights(self):
+        room = MatrixRoom("!test:example.org", "@alice:example.org")
+        room.add_member("@alice:example.org", "Alice", None)
+        room.add_member("@bob:example.org", "Bob", None)
+        room.add_member("@carol:example.org", "Carol", None)
+        lazy_room = LazyRoom(room)
+
+        def info(events, account_data=None):
+            return RoomInfo(Timeline(events, False, "prev"), [], [],
+                            account_data or [])
+
+        assert not lazy_room.handle_joined_room(info([
+            text_event("$1", "@bob:example.org", "hello"),
+            text_event("$2", "@alice:example.org", "hi bob"),
+            text_event("$3", "@carol:example.org", "hey"),
+        ]))
+        assert lazy_room.unread_count == 2
+        assert lazy_room.hotlist_priority == "1"
+
+        # The messages up to the read marker were read on another client.
+        assert not lazy_room.handle_joined_room(info(
+            [text_event("$4", "@bob:example.org", "anyone?")],
+            [FullyReadEvent("$4")]
+        ))
+        assert lazy_room.unread_count == 0
+        assert lazy_room.hotlist_priority is None
+
+        assert lazy_room.handle_joined_room(info([
+            text_event("$5", "@bob:example.org", "Alice, are you there?"),
+        ]))
+        assert lazy_room.highlight_count == 1
+        assert lazy_room.hotlist_priority == "3"
+
+    def test_only_whole_words_are_highlights(self):
+        room = MatrixRoom("!test:example.org", "@al:example.org")
+
+        def highlights(body):
+            return count_unread(
+                room, [text_event("$1", "@bob:example.org", body)]
+            )[1]
+
+        assert highlights("al: ping")
+        assert highlights("Thanks AL!")
+        assert highlights("ask @al:example.org")
+        assert not highlights("malice")
+        assert not highlights("alright")
+
+    def test_events_of_hidden_buffers_are_rendered_in_order(
+            self, monkeypatch):
+        monkeypatch.setattr(G.CONFIG.look, "deferred_rendering", True,
+                            raising=False)
+        buf = create_room_buffer("@alice:example.org", ["@bob:example.org"])
+
+        handled = []
+        tags = []
+        monkeypatch.setattr(
+            buf, "_handle_timeline_event",
+            lambda event, extra_tags=None: (
+                handled.append(event.event_id) or tags.append(extra_tags)
+            )
+        )
+
+        for i in range(3):
+            buf.handle_timeline_event(
+                text_event("${}".format(i), "@bob:example.org", "hello")
+            )
+
+        assert not handled
+        assert len(buf.deferred_events) == 3
+
+        # Nothing is rendered past the deadline besides the first event.
+        assert not buf.render_deferred_events(time.time() - 1)
+        assert handled == ["$0"]
+
+        assert buf.render_deferred_events()
+        assert handled == ["$0", "$1", "$2"]
+        assert not buf.deferred_events
+        # The hotlist was updated when the events were deferred.
+        assert tags == [["notify_none"]] * 3
+
+    def test_deferred_events_respect_the_notify_level(self, monkeypatch):
+        monkeypatch.setattr(G.CONFIG.look, "deferred_rendering", True,
+                            raising=False)
+
+        def hotlist(notify, buffer_type, bodies):
+            buf = create_room_buffer("@alice:example.org",
+                                     ["@bob:example.org"])
+
+            priorities = []
+            monkeypatch.setattr(
+                W, "buffer_get_integer",
+                lambda ptr, name: notify if name == "notify" else 0
+            )
+            monkeypatch.setattr(W, "buffer_get_string",
+                                lambda ptr, name: buffer_type)
+            monkeypatch.setattr(
+                W, "buffer_set",
+                lambda ptr, name, value: (
+                    priorities.append(value) if name == "hotlist" else None
+                )
+            )
+
+            for i, body in enumerate(bodies):
+                buf.handle_timeline_event(
+                    text_event("${}".format(i), "@bob:example.org", body)
+                )
+
+            return priorities
+
+        bodies = ["hello", "hello again", "alice: hi"]
+
+        assert hotlist(3, "channel", bodies) == ["1", "1", "3"]
+        # Only highlights are added to the hotlist of highlight only buffers.
+        assert hotlist(1, "channel", bodies) == ["3"]
+        assert hotlist(1, "channel", bodies[:2]) == []
+        assert hotlist(0, "channel", bodies) == []
+        # Messages in direct chats get the private priority.
+        assert hotlist(3, "private", bodies) == ["2", "2", "3"]
+
+    def test_catch_up_skips_all_but_the_last_events(self, monkeypatch):
+        monkeypatch.setattr(G.CONFIG.network, "catch_up_events", 2,
+                            raising=False)
+        buf = create_room_buffer("@alice:example.org", ["@bob:example.org"])
+
+        handled = []
+        monkeypatch.setattr(
+            buf, "handle_timeline_event",
+            lambda event, extra_tags=None: handled.append(event.event_id)
+        )
+
+        def info(count):
+            return RoomInfo(Timeline([
+                text_event("${}".format(i), "@bob:example.org", "hello")
+                for i in range(count)
+            ], True, "prev"), [], [], [])
+
+        # The initial sync isn't caught up.
+        buf.handle_joined_room(info(5))
+        assert len(handled) == 5
+        assert buf.gap_batch is None
+
+        monkeypatch.setattr(RoomBuffer, "last_event_id",
+                            property(lambda self: "$4"))
+        handled = []
+        buf.handle_joined_room(info(5), "next_batch")
+        assert handled == ["$3", "$4"]
+        assert buf.gap_batch == "next_batch"
+        assert buf.gap_stop_event_id == "$4"
+
+    def test_members_joining_muted_rooms_are_added(self, monkeypatch):
+        monkeypatch.setattr(G.CONFIG, "human_buffer_names", False,
+                            raising=False)
+        room_id = "!test:example.org"
+        client = Client("@alice:example.org")
+
+        def sync(next_batch, user_id):
+            return SyncResponse.from_dict({
+                "next_batch": next_batch,
+                "rooms": {
+                    "join": {room_id: {
+                        "state": {"events": []},
+                        "timeline": {
+                            "events": [{
+                                "type": "m.room.member",
+                                "state_key": user_id,
+                                "sender": user_id,
+                                "event_id": "$" + next_batch,
+                                "origin_server_ts": 0,
+                                "content": {"membership": "join"},
+                            }],
+                            "limited": False,
+                            "prev_batch": "prev",
+                        },
+                        "ephemeral": {"events": []},
+                        "account_data": {"events": []},
+                    }},
+                    "invite": {},
+                    "leave": {},
+                },
+                "to_device": {"events": []},
+                "device_lists": {"changed": [], "left": []},
+                "device_one_time_keys_count": {},
+            })
+
+        client.receive_response(sync("s1", "@alice:example.org"))
+        buf = RoomBuffer(client.rooms[room_id], "example.org",
+                         urlparse("https://example.org"), None)
+        monkeypatch.setattr(RoomBuffer, "muted", property(lambda self: True))
+        monkeypatch.setattr(RoomBuffer, "last_event_id",
+                            property(lambda self: "$s1"))
+
+        printed = []
+        monkeypatch.setattr(
+            buf, "handle_timeline_event",
+            lambda event, extra_tags=None: printed.append(event.event_id)
+        )
+
+        # Bob joins while the room is muted.
+        response = sync("s2", "@bob:example.org")
+        client.receive_response(response)
+        buf.handle_joined_room(response.rooms.join[room_id], "s2", buf.muted)
+
+        assert "@bob:example.org" in client.rooms[room_id].users
+        assert "bob" in buf.weechat_buffer.users
+        assert not printed
+        assert buf.gap_batch == "s2"
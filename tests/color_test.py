@@ -7,8 +7,9 @@ from collections import OrderedDict
 from hypothesis import given
 from hypothesis.strategies import sampled_from, text, characters
 
-from matrix.colors import (G, Formatted, FormattedString,
-                           color_html_to_weechat, color_weechat_to_html)
+from matrix.colors import (G, DEFAULT_ATTRIBUTES, Formatted,
+                           FormattedString, color_html_to_weechat,
+                           color_weechat_to_html)
 from matrix._weechat import MockConfig
 
 G.CONFIG = MockConfig()
@@ -123,3 +124,19 @@ def test_conversion():
     formatted = Formatted.from_input_line("*Hello*")
     formatted2 = Formatted.from_html(formatted.to_html())
     formatted.to_weechat() == formatted2.to_weechat()
+
+
+def test_formatted_string_attributes_are_interned():
+    f1 = FormattedString('foo', {'bold': True, 'fgcolor': 'red'})
+    f2 = FormattedString('bar', OrderedDict([('fgcolor', 'red'),
+                                             ('bold', True)]))
+
+    assert f1.attributes is f2.attributes
+    assert f1.attributes == dict(DEFAULT_ATTRIBUTES, bold=True, fgcolor='red')
+    assert f1.attributes['bold'] and not f1.attributes['italic']
+
+
+def test_to_weechat_does_not_consume_attributes():
+    formatted = Formatted([FormattedString('foo', {'strikethrough': True})])
+
+    assert formatted.to_weechat() == formatted.to_weechat() == 'f̶o̶o̶'
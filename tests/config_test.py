@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from matrix.config import Condition, ConfigSection
+from matrix.globals import W
+
+
+class TestClass(object):
+    def test_condition_results_are_cached(self, monkeypatch):
+        calls = []
+        string_eval_expression = W.string_eval_expression
+
+        def counting_eval(*args):
+            calls.append(args)
+            return string_eval_expression(*args)
+
+        monkeypatch.setattr(W, "string_eval_expression", counting_eval)
+
+        condition = Condition("${typing_enabled}", "typing_enabled")
+        assert condition.cacheable
+
+        for _ in range(3):
+            assert condition.evaluate(True)
+            assert not condition.evaluate(False)
+
+        assert len(calls) == 2
+
+    def test_conditions_with_other_variables_are_not_cached(self):
+        assert not Condition(
+            "${typing_enabled} && ${buffer.full_name} =~ foo",
+            "typing_enabled"
+        ).cacheable
+        assert not Condition(
+            "${if:${typing_enabled}}", "typing_enabled"
+        ).cacheable
+        assert Condition("1", "typing_enabled").cacheable
+
+    def test_option_values_are_cached_until_invalidated(self, monkeypatch):
+        class Section(ConfigSection):
+            def __init__(self):
+                self._option_ptrs = {"max_nicklist_users": "ptr"}
+                self._values = {}
+
+            max_nicklist_users = ConfigSection.option_property(
+                "max_nicklist_users", "integer"
+            )
+
+        values = [5000]
+        monkeypatch.setattr(W, "config_integer", lambda ptr: values.pop(0),
+                            raising=False)
+
+        section = Section()
+        assert section.max_nicklist_users == 5000
+        assert section.max_nicklist_users == 5000
+
+        values.append(100)
+        section.invalidate()
+        assert section.max_nicklist_users == 100
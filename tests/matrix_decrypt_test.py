@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import importlib.util
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse
+
+import pytest
+
+pytest.importorskip("requests")
+
+from nio.crypto import encrypt_attachment
+
+spec = importlib.util.spec_from_file_location(
+    "matrix_decrypt",
+    os.path.join(os.path.dirname(__file__), "..", "contrib",
+                 "matrix_decrypt.py")
+)
+matrix_decrypt = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(matrix_decrypt)
+
+
+@pytest.fixture
+def media_server():
+    media = {}
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            data = media[self.path]
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    httpd.media = media
+    httpd.requests = requests
+    httpd.url = "http://127.0.0.1:{}".format(httpd.server_address[1])
+
+    yield httpd
+
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def upload(media_server, path, plaintext):
+    ciphertext, keys = encrypt_attachment(plaintext)
+    media_server.media[path] = ciphertext
+    return (media_server.url + path, keys["key"]["k"],
+            keys["hashes"]["sha256"], keys["iv"])
+
+
+class TestClass(object):
+    def test_download_is_decrypted_and_cached(self, media_server, tmp_path):
+        plaintext = os.urandom(300000)
+        http_url, key, hash, iv = upload(media_server, "/media/1", plaintext)
+
+        cache = matrix_decrypt.MediaCache(str(tmp_path), 1 << 20)
+        path = cache.path(urlparse("emxc://example.org/media/1"), hash)
+        assert not cache.get(path)
+
+        matrix_decrypt.download(
+            matrix_decrypt.requests.Session(), http_url, key, hash, iv, path
+        )
+
+        with open(path, "rb") as f:
+            assert f.read() == plaintext
+
+        assert cache.get(path) == path
+        assert os.listdir(str(tmp_path)) == [os.path.basename(path)]
+
+    def test_corrupted_download_leaves_no_file(self, media_server, tmp_path):
+        http_url, key, hash, iv = upload(media_server, "/media/1", b"secret")
+        media_server.media["/media/1"] = b"tampered"
+
+        path = str(tmp_path / "file")
+
+        with pytest.raises(matrix_decrypt.DecryptionError):
+            matrix_decrypt.download(
+                matrix_decrypt.requests.Session(),
+                http_url, key, hash, iv, path
+            )
+
+        assert os.listdir(str(tmp_path)) == []
+
+    def test_least_recently_used_files_are_evicted(self, tmp_path):
+        cache = matrix_decrypt.MediaCache(str(tmp_path), 250)
+
+        for number, age in enumerate((300, 200, 100)):
+            path = str(tmp_path / str(number))
+
+            with open(path, "wb") as f:
+                f.write(b"x" * 100)
+
+            mtime = os.path.getmtime(path) - age
+            os.utime(path, (mtime, mtime))
+
+        # Opening a file makes it the most recently used one.
+        assert cache.get(str(tmp_path / "0"))
+
+        stale = str(tmp_path / "download.part")
+        open(stale, "w").close()
+        os.utime(stale, (0, 0))
+
+        cache.evict(keep=str(tmp_path / "2"))
+
+        assert sorted(os.listdir(str(tmp_path))) == ["0", "2"]
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import argparse
+import importlib.util
+import io
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse
+
+import pytest
+
+pytest.importorskip("magic")
+pytest.importorskip("requests")
+
+from nio.crypto import decrypt_attachment
+
+spec = importlib.util.spec_from_file_location(
+    "matrix_upload",
+    os.path.join(os.path.dirname(__file__), "..", "contrib",
+                 "matrix_upload.py")
+)
+matrix_upload = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(matrix_upload)
+
+
+class MediaServer(object):
+    """A stand-in homeserver implementing the media upload endpoints."""
+
+    def __init__(self, versions):
+        self.versions = versions
+        self.media = {}
+        self.requests = []
+        # Number of PUT requests that fail before one succeeds.
+        self.put_failures = 0
+        # Store the content of failing PUT requests, as if only the response
+        # got lost.
+        self.store_failed = False
+        self.created = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def reply(self, code, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def body(self):
+                length = int(self.headers.get("Content-Length", 0))
+                return self.rfile.read(length)
+
+            def do_GET(self):
+                self.reply(200, {"versions": server.versions})
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                server.requests.append(("POST", path))
+                data = self.body()
+
+                if path.endswith("/create"):
+                    server.created += 1
+                    self.reply(200, {
+                        "content_uri": "mxc://example.org/{}".format(
+                            server.created
+                        )
+                    })
+                else:
+                    media_id = "legacy{}".format(len(server.media))
+                    server.media[media_id] = data
+                    self.reply(200, {
+                        "content_uri": "mxc://example.org/" + media_id
+                    })
+
+            def do_PUT(self):
+                path = urlparse(self.path).path
+                server.requests.append(("PUT", path))
+                media_id = path.rsplit("/", 1)[1]
+                data = self.body()
+
+                if media_id in server.media:
+                    self.reply(409, {"errcode": "M_CANNOT_OVERWRITE_MEDIA"})
+                    return
+
+                if server.put_failures:
+                    server.put_failures -= 1
+
+                    if server.store_failed:
+                        server.media[media_id] = data
+
+                    self.reply(502, {"errcode": "M_UNKNOWN"})
+                    return
+
+                server.media[media_id] = data
+                self.reply(200, {})
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.httpd.server_address[1])
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def media_file(tmp_path):
+    path = tmp_path / "file.txt"
+    path.write_bytes(os.urandom(1 << 20) + b"the end")
+    return str(path)
+
+
+def options(server, state_dir, **kwargs):
+    values = dict(
+        homeserver=server.url,
+        insecure=False,
+        proxy_address=None,
+        state_dir=str(state_dir),
+        chunk_size=1 << 16,
+        retries=2,
+        cache_size=0,
+        reuse_encrypted="never",
+        thumbnail_size=0,
+        downscale_above=0,
+        downscale_size=2048,
+    )
+    values.update(kwargs)
+    return argparse.Namespace(**values)
+
+
+def upload(server, state_dir, file, encrypt, room_id="!room:example.org",
+           **kwargs):
+    messages = []
+    matrix_upload.upload_file(
+        matrix_upload.new_session(),
+        options(server, state_dir, **kwargs),
+        "token",
+        file,
+        encrypt,
+        room_id,
+        messages.append
+    )
+    return messages
+
+
+class TestClass(object):
+    @pytest.mark.parametrize("size", [0, 1, 1000, 4096, 10000])
+    @pytest.mark.parametrize("chunk_size", [16, 1000, 4096])
+    def test_encrypted_files_can_be_decrypted(self, tmp_path, size,
+                                              chunk_size):
+        path = tmp_path / "file.bin"
+        data = os.urandom(size)
+        path.write_bytes(data)
+
+        encryptor = matrix_upload.StreamingEncryptor(str(path), chunk_size)
+        ciphertext = b"".join(bytes(chunk) for chunk in encryptor)
+        keys = encryptor.file_keys
+
+        assert len(ciphertext) == size
+        assert decrypt_attachment(
+            ciphertext,
+            keys["key"]["k"],
+            keys["hashes"]["sha256"],
+            keys["iv"]
+        ) == data
+
+        # A second pass with the same key produces the same ciphertext.
+        encryptor = matrix_upload.StreamingEncryptor(
+            str(path), chunk_size, encryptor.key, encryptor.iv
+        )
+        assert b"".join(bytes(chunk) for chunk in encryptor) == ciphertext
+
+    def test_failed_put_is_retried(self, tmp_path, media_file, monkeypatch):
+        monkeypatch.setattr(matrix_upload, "RETRY_DELAY", 0)
+        server = MediaServer(["r0.6.0", "v1.7"])
+        server.put_failures = 1
+
+        messages = upload(server, tmp_path, media_file, True)
+        server.shutdown()
+
+        statuses = [m["status"] for m in messages if m["type"] == "status"]
+        assert statuses == ["started", "retrying", "done"]
+        assert [r[0] for r in server.requests] == ["POST", "PUT", "PUT"]
+
+        done = messages[-1]
+        assert done["url"] == "mxc://example.org/1"
+
+        keys = done["file_keys"]
+        plaintext = decrypt_attachment(
+            server.media["1"],
+            keys["key"]["k"],
+            keys["hashes"]["sha256"],
+            keys["iv"]
+        )
+        with open(media_file, "rb") as f:
+            assert plaintext == f.read()
+
+        assert not os.listdir(str(tmp_path / "uploads"))
+
+    def test_upload_resumes_with_the_reserved_uri(self, tmp_path, media_file):
+        server = MediaServer(["v1.7"])
+        server.put_failures = 1
+        server.store_failed = True
+
+        with pytest.raises(matrix_upload.UploadFailed):
+            upload(server, tmp_path, media_file, True, retries=0)
+
+        assert len(os.listdir(str(tmp_path / "uploads"))) == 1
+
+        # The server got the content, only the response got lost. The new
+        # process reuses the URI and the keys and learns the upload is done.
+        matrix_upload.SUPPORTED_UPLOAD_PATHS.clear()
+        messages = upload(server, tmp_path, media_file, True, retries=0)
+        server.shutdown()
+
+        assert server.created == 1
+
+        done = messages[-1]
+        assert done["status"] == "done"
+        assert done["url"] == "mxc://example.org/1"
+
+        keys = done["file_keys"]
+        plaintext = decrypt_attachment(
+            server.media["1"],
+            keys["key"]["k"],
+            keys["hashes"]["sha256"],
+            keys["iv"]
+        )
+        with open(media_file, "rb") as f:
+            assert plaintext == f.read()
+
+        assert not os.listdir(str(tmp_path / "uploads"))
+
+    def test_old_servers_get_a_single_request(self, tmp_path, media_file):
+        server = MediaServer(["r0.6.0"])
+
+        messages = upload(server, tmp_path, media_file, False)
+        server.shutdown()
+
+        assert [r[0] for r in server.requests] == ["POST"]
+        assert server.requests[0][1].endswith("/upload")
+        assert messages[-1]["url"] == "mxc://example.org/legacy0"
+
+        with open(media_file, "rb") as f:
+            assert server.media["legacy0"] == f.read()
+
+    def test_cached_uploads_are_not_transferred(self, tmp_path, media_file):
+        server = MediaServer(["v1.7"])
+
+        first = upload(server, tmp_path, media_file, False, cache_size=2)
+        second = upload(server, tmp_path, media_file, False, cache_size=2)
+
+        assert len(server.requests) == 2
+        assert second[-1]["cached"]
+        assert second[-1]["url"] == first[-1]["url"]
+
+        # Encrypted uploads aren't reused by default.
+        upload(server, tmp_path, media_file, True, cache_size=2)
+        assert len(server.requests) == 4
+
+        # Unless the policy allows it, here only within the same room.
+        keys = upload(server, tmp_path, media_file, True, cache_size=2,
+                      reuse_encrypted="room")[-1]["file_keys"]
+        cached = upload(server, tmp_path, media_file, True, cache_size=2,
+                        reuse_encrypted="room")[-1]
+        assert len(server.requests) == 6
+        assert cached["cached"]
+        assert cached["file_keys"] == keys
+
+        upload(server, tmp_path, media_file, True, cache_size=2,
+               reuse_encrypted="room", room_id="!other:example.org")
+        assert len(server.requests) == 8
+
+        # The least recently used entry, the unencrypted one, got evicted.
+        upload(server, tmp_path, media_file, False, cache_size=2)
+        server.shutdown()
+        assert len(server.requests) == 10
+
+    def test_images_get_a_thumbnail(self, tmp_path):
+        Image = pytest.importorskip("PIL.Image")
+
+        path = str(tmp_path / "screenshot.png")
+        Image.new("RGB", (1600, 1200), "blue").save(path)
+        server = MediaServer(["v1.7"])
+
+        done = upload(server, tmp_path, path, True, thumbnail_size=800,
+                      downscale_above=1, downscale_size=1000)[-1]
+        server.shutdown()
+
+        assert server.created == 2
+        assert len(server.requests) == 4
+
+        info = done["info"]
+        assert info["mimetype"] == "image/png"
+        assert (info["w"], info["h"]) == (1000, 750)
+        assert info["thumbnail_info"]["w"] == 800
+        assert info["thumbnail_info"]["mimetype"] == "image/jpeg"
+
+        def decrypt(keys, url):
+            return decrypt_attachment(
+                server.media[url.rsplit("/", 1)[1]],
+                keys["key"]["k"],
+                keys["hashes"]["sha256"],
+                keys["iv"]
+            )
+
+        image = Image.open(io.BytesIO(decrypt(done["file_keys"],
+                                              done["url"])))
+        assert image.size == (1000, 750)
+
+        thumbnail_file = info["thumbnail_file"]
+        thumbnail = Image.open(io.BytesIO(decrypt(thumbnail_file,
+                                                  thumbnail_file["url"])))
+        assert thumbnail.size == (800, 600)
+
+    def test_cmyk_images_get_a_jpeg_thumbnail(self, tmp_path):
+        Image = pytest.importorskip("PIL.Image")
+
+        path = str(tmp_path / "print.jpg")
+        Image.new("CMYK", (1600, 1200), (0, 255, 255, 0)).save(path)
+        server = MediaServer(["v1.7"])
+
+        done = upload(server, tmp_path, path, False, thumbnail_size=800)[-1]
+        server.shutdown()
+
+        info = done["info"]
+        assert info["thumbnail_info"]["mimetype"] == "image/jpeg"
+
+        thumbnail_id = info["thumbnail_url"].rsplit("/", 1)[1]
+        thumbnail = Image.open(io.BytesIO(server.media[thumbnail_id]))
+        assert (thumbnail.mode, thumbnail.size) == ("RGB", (800, 600))
+
+    def test_failed_thumbnails_are_left_out(self, tmp_path, monkeypatch):
+        Image = pytest.importorskip("PIL.Image")
+
+        path = str(tmp_path / "screenshot.png")
+        Image.new("RGB", (1600, 1200), "blue").save(path)
+        server = MediaServer(["v1.7"])
+        formats = []
+
+        def save(self, image, image_format):
+            formats.append(image_format)
+            raise OSError("cannot write mode {}".format(image.mode))
+
+        monkeypatch.setattr(matrix_upload.PreparedImage, "save", save)
+
+        done = upload(server, tmp_path, path, False, thumbnail_size=800,
+                      downscale_above=1)[-1]
+        server.shutdown()
+
+        # The original file is uploaded on its own.
+        assert done["status"] == "done"
+        assert server.created == 1
+        assert (done["info"]["w"], done["info"]["h"]) == (1600, 1200)
+        assert "thumbnail_url" not in done["info"]
+        assert formats == ["PNG", "JPEG"]
+
+    def test_temporary_images_are_removed_on_failure(self, tmp_path,
+                                                     monkeypatch):
+        Image = pytest.importorskip("PIL.Image")
+
+        path = str(tmp_path / "screenshot.png")
+        Image.new("RGB", (1600, 1200), "blue").save(path)
+        temp_files = []
+
+        def create_thumbnail(self, image, size):
+            temp_files.extend(self.temp_files)
+            raise KeyboardInterrupt
+
+        monkeypatch.setattr(matrix_upload.PreparedImage, "create_thumbnail",
+                            create_thumbnail)
+        options = argparse.Namespace(thumbnail_size=800, downscale_above=1,
+                                     downscale_size=1000)
+
+        with pytest.raises(KeyboardInterrupt):
+            matrix_upload.PreparedImage(path, options)
+
+        assert len(temp_files) == 1
+        assert not os.path.exists(temp_files[0])
+
+    def test_cancelled_uploads_stop_sending(self, tmp_path, media_file):
+        server = MediaServer(["v1.7"])
+        cancelled = threading.Event()
+
+        def report(message):
+            if message.get("status") == "started":
+                cancelled.set()
+
+        with pytest.raises(matrix_upload.UploadCancelled):
+            matrix_upload.upload_file(
+                matrix_upload.new_session(),
+                options(server, tmp_path),
+                "token",
+                media_file,
+                False,
+                "!room:example.org",
+                report,
+                cancelled
+            )
+        server.shutdown()
+
+        # The request got cut off before any of the file was sent.
+        assert not any(server.media.values())
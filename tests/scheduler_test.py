@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import time
+
+from matrix.globals import W
+from matrix.scheduler import Scheduler
+
+
+class TestClass(object):
+    def test_single_timer_is_armed_for_earliest_deadline(self, monkeypatch):
+        timers = []
+        unhooked = []
+        monkeypatch.setattr(
+            W, "hook_timer",
+            lambda *args: timers.append(args) or "hook{}".format(len(timers))
+        )
+        monkeypatch.setattr(W, "unhook", unhooked.append)
+
+        now = time.time()
+        scheduler = Scheduler()
+        scheduler.schedule("server", "gc", now + 3600, lambda: None)
+        scheduler.schedule("other", "sync", now + 3600, lambda: None)
+
+        assert len(timers) == 1
+        assert timers[0][0] > 3500 * 1000
+        assert timers[0][2] == 1
+
+        scheduler.schedule("server", "sync", now + 1, lambda: None)
+        assert len(timers) == 2
+        assert timers[1][0] <= 1000
+        assert unhooked == ["hook1"]
+
+        scheduler.cancel("server")
+        scheduler.cancel("other")
+        assert scheduler.hook is None
+        assert not scheduler.tasks
+
+    def test_only_due_tasks_run(self, monkeypatch):
+        monkeypatch.setattr(W, "hook_timer", lambda *args: "hook")
+        monkeypatch.setattr(W, "unhook", lambda hook: None)
+
+        now = time.time()
+        ran = []
+        scheduler = Scheduler()
+        scheduler.schedule("server", "sync", now - 1,
+                           lambda: ran.append("sync"))
+        scheduler.schedule("server", "gc", now + 3600,
+                           lambda: ran.append("gc"))
+        scheduler.schedule("server", "lag", now + 10,
+                           lambda: ran.append("lag"))
+        # Rescheduling replaces the pending deadline.
+        scheduler.schedule("server", "lag", now - 2,
+                           lambda: ran.append("lag"))
+        # Unless the pending deadline is earlier and it should be kept.
+        scheduler.schedule("server", "sync", now + 10,
+                           lambda: ran.append("sync"), keep_earlier=True)
+
+        scheduler.run(now)
+
+        assert ran == ["lag", "sync"]
+        assert scheduler.deadline("server", "gc") == now + 3600
+        assert scheduler.hook == "hook"
+
+    def test_tasks_can_reschedule_themselves(self, monkeypatch):
+        monkeypatch.setattr(W, "hook_timer", lambda *args: "hook")
+        monkeypatch.setattr(W, "unhook", lambda hook: None)
+
+        now = time.time()
+        ran = []
+        scheduler = Scheduler()
+
+        def task():
+            ran.append(now)
+            scheduler.schedule("server", "gc", now, task)
+
+        scheduler.schedule("server", "gc", now, task)
+        scheduler.run(now)
+
+        assert len(ran) == 1
+        assert scheduler.deadline("server", "gc") == now
+
+    def test_failing_tasks_dont_stop_other_tasks(self, monkeypatch):
+        monkeypatch.setattr(W, "hook_timer", lambda *args: "hook")
+        monkeypatch.setattr(W, "unhook", lambda hook: None)
+        errors = []
+        monkeypatch.setattr(W, "prnt",
+                            lambda buffer, message: errors.append(message))
+
+        now = time.time()
+        ran = []
+        scheduler = Scheduler()
+
+        def lag_check():
+            raise ValueError("lag check failed")
+
+        scheduler.schedule("server", "lag", now - 2, lag_check)
+        scheduler.schedule("server", "sync", now - 1,
+                           lambda: ran.append("sync"))
+        scheduler.run(now)
+
+        assert ran == ["sync"]
+        assert not scheduler.tasks
+        assert len(errors) == 1
+        assert "lag" in errors[0] and "lag check failed" in errors[0]
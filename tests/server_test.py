@@ -1,7 +1,17 @@
+import time
+
+from nio.rooms import MatrixRoom
+
+from matrix.buffer import RoomBuffer
 from matrix.server import MatrixServer
 from matrix._weechat import MockConfig
 import matrix.globals as G
 
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
 G.CONFIG = MockConfig()
 
 class TestClass(object):
@@ -19,3 +29,95 @@ class TestClass(object):
         )
         assert homeserver.hostname == "example.org"
         assert homeserver.geturl() == "https://example.org:80/_matrix"
+
+    def test_sync_filter_leaves_out_unused_events(self, monkeypatch):
+        class Buffer(object):
+            def __init__(self, muted):
+                self.muted = muted
+
+        class Server(object):
+            build_sync_filter = MatrixServer.build_sync_filter
+
+            def __init__(self):
+                self.room_buffers = {
+                    "!muted:example.org": Buffer(True),
+                    "!loud:example.org": Buffer(False),
+                }
+
+        server = Server()
+        sync_filter = server.build_sync_filter(500)
+
+        assert sync_filter["presence"] == {"not_types": ["*"]}
+        assert sync_filter["room"]["ephemeral"] == {"types": ["m.typing"]}
+        assert sync_filter["room"]["timeline"] == {"limit": 500}
+
+        # Muted rooms are synced, the member events in their timelines are
+        # needed to keep the member lists up to date.
+        monkeypatch.setattr(G.CONFIG.network, "skip_muted_rooms", True)
+        sync_filter = server.build_sync_filter(500)
+
+        assert sync_filter["room"]["timeline"] == {"limit": 500}
+
+    def test_garbage_collection_removes_stalest_users_of_the_server(self):
+        class Config(object):
+            max_server_nicklist_users = 3
+
+        class Server(object):
+            garbage_collect_server_users = (
+                MatrixServer.garbage_collect_server_users
+            )
+
+            def __init__(self):
+                self.config = Config()
+                self.room_buffers = {}
+
+        def room_buffer(room_id, speaking_times):
+            room = MatrixRoom(room_id, "@zoe:example.org")
+            for name in speaking_times:
+                room.add_member("@{}:example.org".format(name), None, None)
+
+            room_buffer = RoomBuffer(
+                room, "example", urlparse("https://example.org"), None
+            )
+            for user_id in room.users:
+                room_buffer.add_user(user_id, 0, True)
+
+            for name, speaking_time in speaking_times.items():
+                room_buffer.weechat_buffer.message(
+                    name, "hello", speaking_time
+                )
+
+            return room_buffer
+
+        server = Server()
+        server.room_buffers = {
+            "!first:example.org": room_buffer(
+                "!first:example.org", {"alice": 1000, "bob": 4000}
+            ),
+            "!second:example.org": room_buffer(
+                "!second:example.org", {"carol": 3000, "dave": 2000}
+            ),
+            "!third:example.org": room_buffer(
+                "!third:example.org", {"eve": 5000, "frank": 6000}
+            ),
+        }
+
+        # Every room is below the per room limit, the server limit is not.
+        assert server.garbage_collect_server_users(5500, time.time() + 60)
+
+        displayed = {
+            room_id: set(room_buffer.displayed_nicks)
+            for room_id, room_buffer in server.room_buffers.items()
+        }
+        # Alice, dave and carol are the stalest users, frank is too recent
+        # to be removed.
+        assert displayed == {
+            "!first:example.org": {"@bob:example.org"},
+            "!second:example.org": set(),
+            "!third:example.org": {"@eve:example.org", "@frank:example.org"},
+        }
+        assert set(
+            server.room_buffers["!second:example.org"].inactive_users
+        ) == {
+            "@carol:example.org", "@dave:example.org"
+        }
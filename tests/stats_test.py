@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import pstats
+import time
+
+import pytest
+
+import matrix.globals as G
+from matrix import utf
+from matrix._weechat import MockConfig
+from matrix.commands import matrix_debug_command
+from matrix.globals import UPLOADS, W
+from matrix.stats import (CALLBACK_STATS, CallbackStats, LatencyHistogram,
+                          memory_census)
+from matrix.utf import utf8_decode
+
+G.CONFIG = MockConfig()
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    monkeypatch.setattr(utf, "CALLBACK_MONITOR", None)
+    stats = CallbackStats()
+    stats.enable()
+    return stats
+
+
+class TestClass(object):
+    def test_percentiles_are_within_a_bucket(self):
+        histogram = LatencyHistogram()
+
+        for milliseconds in range(1, 101):
+            histogram.add(milliseconds / 1000.0)
+
+        assert histogram.count == 100
+        assert histogram.max == 0.1
+        assert 0.050 <= histogram.percentile(50) <= 0.050 * 1.19
+        assert 0.095 <= histogram.percentile(95) <= 0.1
+        assert histogram.percentile(100) == 0.1
+        assert LatencyHistogram().percentile(50) == 0
+
+    def test_wrapped_callbacks_are_measured(self, stats):
+        @utf8_decode
+        def inner_cb():
+            return 1
+
+        @utf8_decode
+        def outer_cb(data):
+            return inner_cb() + data
+
+        assert outer_cb(1) == 2
+        assert outer_cb(2) == 3
+
+        assert stats.histograms["outer_cb"].count == 2
+        assert stats.histograms["inner_cb"].count == 2
+
+        stats.disable()
+        outer_cb(1)
+        assert stats.histograms["outer_cb"].count == 2
+
+        lines = stats.format()
+        assert len(lines) == 3
+        assert lines[1].startswith("outer_cb")
+
+    def test_slow_callbacks_are_logged(self, stats, monkeypatch):
+        printed = []
+        monkeypatch.setattr(W, "prnt",
+                            lambda buffer, message: printed.append(message))
+        stats.threshold = 0.001
+
+        @utf8_decode
+        def receive_cb():
+            stats.response_type = "SyncResponse"
+            time.sleep(0.002)
+            raise ValueError()
+
+        with pytest.raises(ValueError):
+            receive_cb()
+
+        assert len(printed) == 1
+        assert "receive_cb" in printed[0]
+        assert "response: SyncResponse" in printed[0]
+        assert stats.response_type is None
+
+        stats.threshold = 10
+
+        with pytest.raises(ValueError):
+            receive_cb()
+
+        assert len(printed) == 1
+        assert stats.histograms["receive_cb"].count == 2
+
+    def test_profiles_are_written(self, stats, tmp_path, monkeypatch):
+        printed = []
+        monkeypatch.setattr(W, "prnt",
+                            lambda buffer, message: printed.append(message))
+        monkeypatch.setattr(W, "info_get", lambda info, arguments: str(
+            tmp_path))
+        (tmp_path / "matrix").mkdir()
+        stats.disable()
+
+        @utf8_decode
+        def busy_cb():
+            return sum(range(1000))
+
+        matrix_debug_command("profile", ["stop"])
+        assert "aren't being profiled" in printed[-1]
+
+        matrix_debug_command("profile", ["start"])
+        assert utf.CALLBACK_MONITOR is CALLBACK_STATS
+
+        busy_cb()
+        matrix_debug_command("profile", ["stop"])
+        assert utf.CALLBACK_MONITOR is None
+
+        profiles = os.listdir(str(tmp_path / "matrix"))
+        assert len(profiles) == 1
+        assert profiles[0].endswith(".pstats")
+
+        functions = pstats.Stats(
+            str(tmp_path / "matrix" / profiles[0])
+        ).stats.keys()
+        assert "busy_cb" in [name for _, _, name in functions]
+        assert any("busy_cb" in line for line in printed)
+
+    def test_memory_census(self, monkeypatch):
+        class Room(object):
+            users = {"@alice:example.org": None, "@bob:example.org": None}
+
+        class WeechatBuffer(object):
+            users = {"alice": None}
+
+        class RoomBuffer(object):
+            room = Room()
+            weechat_buffer = WeechatBuffer()
+            undecrypted_events = [None] * 3
+            deferred_events = []
+
+        class Upload(object):
+            server_name = "example"
+
+        class Server(object):
+            name = "example"
+            room_buffers = {"!a": RoomBuffer(), "!b": RoomBuffer()}
+            lazy_rooms = {"!c": None}
+            user_registry = [None] * 5
+
+        monkeypatch.setitem(UPLOADS, "upload", Upload())
+
+        census = memory_census(Server())
+        assert census["room buffers"] == 2
+        assert census["rooms without a buffer"] == 1
+        assert census["room members"] == 4
+        assert census["nicklist users"] == 2
+        assert census["registered users"] == 5
+        assert census["undecrypted events"] == 6
+        assert census["deferred events"] == 0
+        assert census["uploads"] == 1
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import json
+from collections import OrderedDict
+
+import pytest
+
+import matrix.globals as G
+import matrix.uploads
+from matrix._weechat import MockConfig
+from matrix.globals import SERVERS, W
+from matrix.uploads import (UPLOAD_WORKERS, Upload, UploadQueue,
+                            UploadsBuffer, UploadState, parse_messages,
+                            upload_cb, upload_worker_cb)
+
+G.CONFIG = MockConfig()
+
+
+class ServerConfig(object):
+    ssl_verify = True
+    proxy = ""
+    upload_workers = 2
+    max_concurrent_uploads = 2
+
+
+class Server(object):
+    def __init__(self, name):
+        self.name = name
+        self.config = ServerConfig()
+        self.sent = []
+
+    def get_session_path(self):
+        return "/tmp/{}".format(self.name)
+
+    def room_send_upload(self, upload):
+        self.sent.append(upload)
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    queue = UploadQueue()
+    monkeypatch.setattr(matrix.uploads, "UPLOAD_QUEUE", queue)
+    monkeypatch.setattr(matrix.uploads, "UPLOADS", OrderedDict())
+    monkeypatch.setattr(G.CONFIG, "upload_buffer", None, raising=False)
+    monkeypatch.setattr(W, "WEECHAT_HOOK_PROCESS_ERROR", -2, raising=False)
+    return queue
+
+
+@pytest.fixture
+def processes(monkeypatch):
+    processes = []
+
+    def hook_process_hashtable(command, options, timeout, cb, data):
+        processes.append(options)
+        return "hook{}".format(len(processes))
+
+    monkeypatch.setattr(W, "hook_process_hashtable",
+                        hook_process_hashtable, raising=False)
+    return processes
+
+
+class TestClass(object):
+    def test_uploads_share_a_worker(self, monkeypatch, queue, processes):
+        stdin = []
+
+        monkeypatch.setattr(W, "hook_set",
+                            lambda hook, key, value: stdin.append(value),
+                            raising=False)
+
+        server = Server("example")
+        monkeypatch.setitem(SERVERS, server.name, server)
+
+        first = Upload(server.name, "example.org", "token", "!room",
+                       "first.png")
+        second = Upload(server.name, "example.org", "token", "!room",
+                        "second.png", encrypt=True)
+        queue.add(first)
+        queue.add(second)
+
+        assert len(processes) == 1
+        assert processes[0]["arg1"] == "--worker"
+        assert processes[0]["stdin"] == "1"
+        assert "--cache-size" in processes[0].values()
+
+        jobs = [json.loads(line) for line in stdin]
+        assert [job["id"] for job in jobs] == [str(first.uuid),
+                                               str(second.uuid)]
+        assert jobs[1]["encrypt"]
+        assert jobs[1]["room_id"] == "!room"
+
+        worker = list(UPLOAD_WORKERS.values())[0]
+        messages = [
+            {"id": str(first.uuid), "type": "status", "status": "started",
+             "total": 10, "mimetype": "image/png", "file_name": "first.png"},
+            {"id": str(second.uuid), "type": "progress", "data": 5},
+            {"id": str(first.uuid), "type": "status", "status": "done",
+             "url": "mxc://example.org/first",
+             "info": {"w": 10, "h": 10,
+                      "thumbnail_url": "mxc://example.org/thumbnail"}},
+        ]
+        out = "".join(json.dumps(message) + "\n" for message in messages)
+
+        # The output may be cut at any point.
+        upload_worker_cb(str(worker.uuid), "matrix_upload", -1, out[:30], "")
+        upload_worker_cb(str(worker.uuid), "matrix_upload", -1, out[30:], "")
+
+        assert first.state == UploadState.finished
+        assert first.content_uri == "mxc://example.org/first"
+        assert first.content["info"]["thumbnail_url"] == (
+            "mxc://example.org/thumbnail"
+        )
+        assert server.sent == [first]
+        assert second.done == 5
+
+        upload_worker_cb(str(worker.uuid), "matrix_upload", 1, "", "")
+
+        assert second.state == UploadState.error
+        assert worker.uuid not in UPLOAD_WORKERS
+        assert not queue.active
+
+    def test_servers_take_turns_within_the_limits(self, monkeypatch, queue,
+                                                  processes):
+        monkeypatch.setattr(G.CONFIG.network, "max_concurrent_uploads", 3)
+
+        busy = Server("busy")
+        busy.config.upload_workers = 0
+        other = Server("other")
+        other.config.upload_workers = 0
+        monkeypatch.setitem(SERVERS, busy.name, busy)
+        monkeypatch.setitem(SERVERS, other.name, other)
+
+        busy_uploads = [
+            Upload(busy.name, "busy.org", "token", "!room", str(i))
+            for i in range(4)
+        ]
+        for upload in busy_uploads:
+            queue.add(upload)
+
+        # The per server limit holds back the third upload.
+        assert [u.state for u in busy_uploads] == [
+            UploadState.active, UploadState.active,
+            UploadState.queued, UploadState.queued
+        ]
+
+        other_uploads = [
+            Upload(other.name, "other.org", "token", "!room", str(i))
+            for i in range(2)
+        ]
+        for upload in other_uploads:
+            queue.add(upload)
+
+        # The global limit holds back the second upload of the other server.
+        assert other_uploads[0].state == UploadState.active
+        assert other_uploads[1].state == UploadState.queued
+        assert len(processes) == 3
+
+        busy_uploads[0].finish(UploadState.finished)
+        assert busy_uploads[2].state == UploadState.active
+        assert other_uploads[1].state == UploadState.queued
+
+        # The busy server started the last upload, now it's the turn of the
+        # other server.
+        busy_uploads[1].finish(UploadState.finished)
+        assert other_uploads[1].state == UploadState.active
+        assert busy_uploads[3].state == UploadState.queued
+
+        other_uploads[0].finish(UploadState.finished)
+        assert busy_uploads[3].state == UploadState.active
+        assert not queue.queued
+
+    def test_uploads_can_be_aborted(self, monkeypatch, queue, processes):
+        unhooked = []
+        monkeypatch.setattr(W, "unhook", unhooked.append, raising=False)
+        monkeypatch.setattr(G.CONFIG.network, "max_concurrent_uploads", 1)
+        monkeypatch.setattr(G.CONFIG.network, "max_finished_uploads", 1)
+
+        server = Server("example")
+        server.config.upload_workers = 0
+        monkeypatch.setitem(SERVERS, server.name, server)
+
+        uploads = [
+            Upload(server.name, "example.org", "token", "!room", str(i))
+            for i in range(3)
+        ]
+        for upload in uploads:
+            queue.add(upload)
+
+        # A queued upload never starts.
+        uploads[1].abort()
+        assert uploads[1].state == UploadState.aborted
+        assert len(processes) == 1
+
+        # Aborting the running upload kills its process.
+        uploads[0].abort()
+        assert unhooked == ["hook1"]
+        assert uploads[0].state == UploadState.aborted
+        assert uploads[2].state == UploadState.active
+
+        # Only the most recently added finished upload is kept around.
+        assert list(matrix.uploads.UPLOADS) == [uploads[1].uuid,
+                                                uploads[2].uuid]
+
+        # The process exits without reporting that the upload is done.
+        upload_cb(str(uploads[2].uuid), "matrix_upload", 1, "", "")
+        assert uploads[2].state == UploadState.error
+        assert list(matrix.uploads.UPLOADS) == [uploads[2].uuid]
+
+    def test_output_is_parsed_line_by_line(self):
+        messages, buffer = parse_messages("", '{"type": "progress", "da')
+        assert messages == []
+
+        messages, buffer = parse_messages(
+            buffer, 'ta": 1}\n{"type": "progress", "data": 2}\n{"ty'
+        )
+        assert [message["data"] for message in messages] == [1, 2]
+        assert buffer == '{"ty'
+
+    def test_uploads_buffer_prints_only_changed_lines(self, monkeypatch):
+        printed = []
+        cleared = []
+
+        monkeypatch.setattr(W, "prnt_y",
+                            lambda buffer, y, line: printed.append(y),
+                            raising=False)
+        monkeypatch.setattr(W, "buffer_clear", cleared.append, raising=False)
+        monkeypatch.setattr(W, "string_format_size", str, raising=False)
+
+        class FakeUpload(object):
+            room_id = "!room"
+            mimetype = "image/png"
+            server_name = "example"
+            state = UploadState.active
+            done = 0
+            total = 100
+            throughput = 0
+
+            def __init__(self, filepath):
+                self.filepath = filepath
+
+        uploads = OrderedDict(
+            (name, FakeUpload(name)) for name in ("first", "second")
+        )
+        monkeypatch.setattr(UploadsBuffer, "uploads", uploads)
+
+        buffer = UploadsBuffer()
+        assert printed == [0, 1, 2, 3, 4, 5]
+
+        del printed[:]
+        uploads["second"].done = 50
+        buffer.render()
+        assert printed == [5]
+
+        del printed[:]
+        buffer.render()
+        assert printed == []
+
+        del uploads["first"]
+        buffer.render()
+        assert len(cleared) == 1
+        assert printed == [0, 1, 2, 3]
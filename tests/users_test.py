@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from nio.rooms import MatrixRoom
+
+import matrix.globals as G
+from matrix.buffer import RoomBuffer
+from matrix.users import BridgeNickRules, UserRegistry
+from matrix._weechat import MockConfig
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+G.CONFIG = MockConfig()
+
+
+class TestClass(object):
+    def test_short_names(self):
+        registry = UserRegistry()
+
+        alice = registry.get("@alice:example.org")
+        assert alice.short_name == "alice"
+        assert alice.bridge is None
+
+        discord = registry.get("@_discord_1234:example.org", "Bob")
+        assert discord.short_name == "Bob"
+        assert discord.bridge == "@_discord_"
+
+        freenode = registry.get("@freenode_carol:example.org")
+        assert freenode.short_name == "carol"
+        assert freenode.bridge == "@freenode_"
+
+    def test_display_name_change(self):
+        registry = UserRegistry()
+        user_id = "@_discord_1234:example.org"
+
+        info = registry.get(user_id, "Bob")
+        assert registry.get(user_id, "Bob") is info
+
+        assert registry.get(user_id, "Robert").short_name == "Robert"
+        assert len(registry) == 1
+
+    def test_registry_is_shared_between_rooms(self):
+        registry = UserRegistry()
+        homeserver = urlparse("https://example.org")
+        buffers = []
+
+        for room_id in ["!a:example.org", "!b:example.org"]:
+            room = MatrixRoom(room_id, "@alice:example.org")
+            room.add_member("@_slack_bob:example.org", "Bob", None)
+            room_buffer = RoomBuffer(room, "example", homeserver, None,
+                                     registry)
+            room_buffer.add_user("@_slack_bob:example.org", 0, True)
+            buffers.append(room_buffer)
+
+        assert len(registry) == 1
+
+        user_id = registry.get("@_slack_bob:example.org", "Bob").user_id
+        for room_buffer in buffers:
+            assert room_buffer.displayed_nicks == {user_id: "Bob"}
+            assert next(iter(room_buffer.displayed_nicks)) is user_id
+
+        registry.prune([])
+        assert "@_slack_bob:example.org" not in registry
+
+    def test_bridge_nick_rules(self):
+        rules = BridgeNickRules.parse(
+            "@_irc_=5, @_irc_oftc_=10,@_discord_=displayname,broken,@x=y"
+        )
+
+        assert rules.rules == {
+            "@_irc_": 5,
+            "@_irc_oftc_": 10,
+            "@_discord_": None,
+        }
+        assert rules.match("@_irc_oftc_bob:example.org") == "@_irc_oftc_"
+        assert rules.match("@_irc_bob:example.org") == "@_irc_"
+        assert rules.match("@bob:example.org") is None
+
+        registry = UserRegistry(rules)
+        assert registry.get("@_irc_oftc_bob:example.org").short_name == "bob"
+        assert registry.get("@_irc_bob:example.org").short_name == "bob"
+        assert registry.get("@_discord_1:example.org", "Bob").short_name == \
+            "Bob"
+
+        registry.set_bridge_nicks(BridgeNickRules.parse(""))
+        assert registry.get("@_irc_bob:example.org").short_name == \
+            "_irc_bob"